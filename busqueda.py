@@ -0,0 +1,86 @@
+"""Búsqueda indexada de productos por código, nombre y categoría.
+
+Con la extensión ``pg_trgm`` la búsqueda tolera errores de tipeo: un índice
+GIN de trigramas sobre el texto de búsqueda (código, nombre y categoría en
+minúsculas) resuelve ``word_similarity``, de modo que "compresro" encuentra
+"Compresor 1/2 HP". Los prefijos de código y nombre van por índices btree
+``text_pattern_ops``, que también sirven a términos de menos de tres letras,
+demasiado cortos para los trigramas.
+
+El orden es: código exacto, prefijo de código, prefijo de nombre y después la
+similitud. Si la extensión no se puede crear (falta de permisos) se busca por
+subcadena, sin tolerancia a errores.
+"""
+import logging
+import os
+
+logger = logging.getLogger("el_unificador.busqueda")
+
+UMBRAL_SIMILITUD = float(os.getenv("BUSQUEDA_UMBRAL_SIMILITUD", "0.3"))
+MINIMO_TRIGRAMAS = 3
+
+# Debe coincidir exactamente con la expresión del índice para que el planificador lo use
+TEXTO_BUSQUEDA = "lower(codigo || ' ' || nombre || ' ' || COALESCE(categoria, ''))"
+
+COLUMNAS = "id, codigo, nombre, categoria, precio_compra, precio_venta, stock_actual, stock_minimo"
+
+# Lo decide crear_indices al iniciar; sin la extensión se usa la búsqueda por subcadena
+TRIGRAMAS = False
+
+
+def crear_indices(cur):
+    global TRIGRAMAS
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_productos_codigo_prefijo ON productos (lower(codigo) text_pattern_ops) WHERE activo = true")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_productos_nombre_prefijo ON productos (lower(nombre) text_pattern_ops) WHERE activo = true")
+
+    # Sin permisos para crear la extensión falla la sentencia; el savepoint evita
+    # abortar el resto de init_db
+    cur.execute("SAVEPOINT busqueda_trigramas")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_productos_busqueda_trgm ON productos USING GIN (({TEXTO_BUSQUEDA}) gin_trgm_ops) WHERE activo = true")
+        cur.execute("RELEASE SAVEPOINT busqueda_trigramas")
+        TRIGRAMAS = True
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT busqueda_trigramas")
+        TRIGRAMAS = False
+        logger.warning("pg_trgm no disponible, la búsqueda de productos será por subcadena: %s", e)
+
+
+def _escapar_like(texto):
+    return texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def buscar(cur, q, limite):
+    """Productos activos que coinciden con ``q``, del más al menos relevante."""
+    q = " ".join(q.lower().split())
+    parametros = {
+        "q": q,
+        "prefijo": _escapar_like(q) + "%",
+        "subcadena": "%" + _escapar_like(q) + "%",
+        "limite": limite,
+    }
+    condiciones = ["lower(codigo) LIKE %(prefijo)s", "lower(nombre) LIKE %(prefijo)s"]
+    if TRIGRAMAS and len(q) >= MINIMO_TRIGRAMAS:
+        # El umbral de <% vale solo para esta transacción
+        cur.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", (str(UMBRAL_SIMILITUD),))
+        condiciones.append(f"%(q)s <%% {TEXTO_BUSQUEDA}")
+        similitud = f"word_similarity(%(q)s, {TEXTO_BUSQUEDA})"
+    else:
+        condiciones.append(f"{TEXTO_BUSQUEDA} LIKE %(subcadena)s")
+        similitud = "0"
+
+    cur.execute(f"""
+        SELECT {COLUMNAS},
+            CASE
+                WHEN lower(codigo) = %(q)s THEN 3
+                WHEN lower(codigo) LIKE %(prefijo)s THEN 2
+                WHEN lower(nombre) LIKE %(prefijo)s THEN 1
+                ELSE 0
+            END + {similitud} as relevancia
+        FROM productos
+        WHERE activo = true AND ({" OR ".join(condiciones)})
+        ORDER BY relevancia DESC, nombre
+        LIMIT %(limite)s
+    """, parametros)
+    return cur.fetchall()
@@ -0,0 +1,183 @@
+"""Compresión negociada de respuestas (brotli o gzip).
+
+``MiddlewareCompresion`` comprime las respuestas cuyo cliente lo acepte
+(``Accept-Encoding``), prefiriendo brotli si el paquete está instalado. Las
+respuestas de un solo cuerpo por debajo de ``COMPRESION_MINIMO_BYTES`` o de
+tipos ya comprimidos se envían tal cual.
+
+Las respuestas en streaming se comprimen por partes, vaciando el compresor en
+cada parte para que el cliente reciba los datos a medida que se generan.
+
+No hay caché de respuestas en la aplicación, así que el middleware guarda
+los últimos cuerpos comprimidos indexados por (codificación, hash del cuerpo):
+si ``/inventario`` no cambió entre dos peticiones, la segunda reutiliza los
+bytes ya comprimidos en lugar de volver a comprimir varios MB.
+"""
+import gzip
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MINIMO_BYTES = int(os.getenv("COMPRESION_MINIMO_BYTES", "1024"))
+NIVEL_GZIP = int(os.getenv("COMPRESION_NIVEL_GZIP", "6"))
+NIVEL_BROTLI = int(os.getenv("COMPRESION_NIVEL_BROTLI", "5"))
+MAX_CACHE_BYTES = int(float(os.getenv("COMPRESION_CACHE_MB", "32")) * 1024 * 1024)
+
+_TIPOS_SIN_COMPRIMIR = ("image/", "video/", "audio/", "application/zip", "application/gzip", "application/octet-stream", "application/vnd.apache.parquet")
+
+
+def elegir_codificacion(accept_encoding):
+    """Devuelve ``br``, ``gzip`` o None según lo que acepte el cliente."""
+    aceptadas = {}
+    for parte in accept_encoding.split(","):
+        nombre, _, parametros = parte.strip().partition(";")
+        calidad = 1.0
+        parametros = parametros.strip()
+        if parametros.startswith("q="):
+            try:
+                calidad = float(parametros[2:])
+            except ValueError:
+                calidad = 0.0
+        aceptadas[nombre.strip().lower()] = calidad
+
+    if brotli is not None and aceptadas.get("br", 0) > 0:
+        return "br"
+    if aceptadas.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+def comprimir(cuerpo, codificacion):
+    if codificacion == "br":
+        return brotli.compress(cuerpo, quality=NIVEL_BROTLI)
+    return gzip.compress(cuerpo, compresslevel=NIVEL_GZIP, mtime=0)
+
+
+class CompresorIncremental:
+    def __init__(self, codificacion):
+        if codificacion == "br":
+            self._compresor = brotli.Compressor(quality=NIVEL_BROTLI)
+            self.comprimir = lambda datos: self._compresor.process(datos) + self._compresor.flush()
+            self.terminar = self._compresor.finish
+        else:
+            self._compresor = zlib.compressobj(NIVEL_GZIP, zlib.DEFLATED, 31)
+            self.comprimir = lambda datos: self._compresor.compress(datos) + self._compresor.flush(zlib.Z_SYNC_FLUSH)
+            self.terminar = self._compresor.flush
+
+
+class CacheComprimidos:
+    """LRU de cuerpos comprimidos, acotado por el total de bytes guardados."""
+
+    def __init__(self, maximo_bytes=MAX_CACHE_BYTES):
+        self.maximo_bytes = maximo_bytes
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._candado = threading.Lock()
+
+    def obtener(self, clave):
+        with self._candado:
+            valor = self._entradas.get(clave)
+            if valor is not None:
+                self._entradas.move_to_end(clave)
+            return valor
+
+    def guardar(self, clave, valor):
+        if len(valor) > self.maximo_bytes:
+            return
+        with self._candado:
+            anterior = self._entradas.pop(clave, None)
+            if anterior is not None:
+                self._bytes -= len(anterior)
+            self._entradas[clave] = valor
+            self._bytes += len(valor)
+            while self._bytes > self.maximo_bytes:
+                _, descartado = self._entradas.popitem(last=False)
+                self._bytes -= len(descartado)
+
+
+cache = CacheComprimidos()
+
+
+def _comprimir_con_cache(cuerpo, codificacion):
+    clave = (codificacion, hashlib.blake2b(cuerpo, digest_size=16).digest())
+    comprimido = cache.obtener(clave)
+    if comprimido is None:
+        comprimido = comprimir(cuerpo, codificacion)
+        cache.guardar(clave, comprimido)
+    return comprimido
+
+
+class MiddlewareCompresion:
+    def __init__(self, app, minimo_bytes=MINIMO_BYTES):
+        self.app = app
+        self.minimo_bytes = minimo_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        codificacion = None
+        for nombre, valor in scope["headers"]:
+            if nombre == b"accept-encoding":
+                codificacion = elegir_codificacion(valor.decode("latin-1"))
+                break
+        if codificacion is None:
+            await self.app(scope, receive, send)
+            return
+
+        inicio = None
+        compresor = None
+        directo = False
+
+        async def enviar(mensaje):
+            nonlocal inicio, compresor, directo
+            if mensaje["type"] == "http.response.start":
+                inicio = mensaje
+                return
+            if mensaje["type"] != "http.response.body" or directo:
+                await send(mensaje)
+                return
+
+            cuerpo = mensaje.get("body", b"")
+            mas = mensaje.get("more_body", False)
+
+            if compresor is not None:
+                datos = compresor.comprimir(cuerpo) if cuerpo else b""
+                if not mas:
+                    datos += compresor.terminar()
+                await send({"type": "http.response.body", "body": datos, "more_body": mas})
+                return
+
+            cabeceras = [(nombre.lower(), valor) for nombre, valor in inicio.get("headers", [])]
+            tipo = next((valor.decode("latin-1") for nombre, valor in cabeceras if nombre == b"content-type"), "")
+            ya_codificada = any(nombre == b"content-encoding" for nombre, _ in cabeceras)
+            if ya_codificada or tipo.startswith(_TIPOS_SIN_COMPRIMIR) or (not mas and len(cuerpo) < self.minimo_bytes):
+                directo = True
+                await send(inicio)
+                await send(mensaje)
+                return
+
+            cabeceras = [(nombre, valor) for nombre, valor in cabeceras if nombre != b"content-length"]
+            cabeceras.append((b"content-encoding", codificacion.encode()))
+            cabeceras.append((b"vary", b"Accept-Encoding"))
+
+            if not mas:
+                comprimido = _comprimir_con_cache(cuerpo, codificacion)
+                cabeceras.append((b"content-length", str(len(comprimido)).encode()))
+                await send(dict(inicio, headers=cabeceras))
+                await send({"type": "http.response.body", "body": comprimido, "more_body": False})
+                return
+
+            compresor = CompresorIncremental(codificacion)
+            await send(dict(inicio, headers=cabeceras))
+            await send({"type": "http.response.body", "body": compresor.comprimir(cuerpo), "more_body": True})
+
+        await self.app(scope, receive, enviar)
@@ -0,0 +1,253 @@
+"""Exportaciones masivas en streaming (CSV y Parquet).
+
+CSV: ``COPY (...) TO STDOUT`` escribe en un hilo aparte sobre una cola acotada
+y la respuesta va enviando lo que llega, así que la memoria queda limitada a
+unos pocos bloques sin importar el tamaño de la exportación (si el cliente es
+más lento que PostgreSQL, el ``COPY`` espera).
+
+Parquet (requiere ``pyarrow``): un cursor con nombre trae
+``EXPORTACION_FILAS_GRUPO`` filas por vez y cada lote se escribe como un row
+group, que se envía apenas queda escrito. El esquema sale de los tipos de las
+columnas de PostgreSQL, no de los datos, para que todos los row groups
+coincidan aunque un lote traiga solo nulos.
+"""
+import contextvars
+import json
+import os
+import queue
+import threading
+from datetime import timedelta
+
+from fastapi.responses import StreamingResponse
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PARQUET_DISPONIBLE = pyarrow is not None
+
+FILAS_GRUPO = int(os.getenv("EXPORTACION_FILAS_GRUPO", "50000"))
+BLOQUE_CSV = 64 * 1024
+MAX_BLOQUES_COLA = 16
+
+TIPO_CSV = "text/csv; charset=utf-8"
+TIPO_PARQUET = "application/vnd.apache.parquet"
+FORMATOS = ("csv", "parquet")
+
+# Tabla exportable -> (consulta, columna de fecha para el filtro por rango)
+TABLAS = {
+    "productos": ("SELECT * FROM productos", "fecha_creacion"),
+    "movimientos": ("SELECT * FROM movimientos_inventario", "fecha_movimiento"),
+    "auditoria": ("SELECT * FROM auditoria_sistema", "fecha"),
+    "cierres": ("SELECT * FROM cierres_diarios", "fecha_cierre"),
+}
+
+
+class _Fin:
+    pass
+
+
+class ExportacionCancelada(Exception):
+    pass
+
+
+def consulta_exportacion(cur, tabla, desde=None, hasta=None):
+    """Arma el SELECT de ``tabla`` filtrado por [desde, hasta] (fechas inclusivas; ``desde`` también puede ser un instante), con los valores ya interpolados."""
+    sql, columna = TABLAS[tabla]
+    condiciones = []
+    parametros = []
+    if desde is not None:
+        condiciones.append(f"{columna} >= %s")
+        parametros.append(desde)
+    if hasta is not None:
+        condiciones.append(f"{columna} < %s")
+        parametros.append(hasta + timedelta(days=1))
+    if condiciones:
+        sql += " WHERE " + " AND ".join(condiciones)
+    sql += f" ORDER BY {columna}, id"
+    # COPY no acepta parámetros: se interpolan con mogrify, que escapa igual que execute
+    return cur.mogrify(sql, parametros).decode("utf-8")
+
+
+class _EscritorCola:
+    """Destino de ``copy_expert``: agrupa las filas en bloques y los pone en la cola."""
+
+    def __init__(self, cola, cancelado):
+        self.cola = cola
+        self.cancelado = cancelado
+        self.partes = []
+        self.tamano = 0
+
+    def write(self, datos):
+        if self.cancelado.is_set():
+            raise ExportacionCancelada()
+        if isinstance(datos, str):
+            datos = datos.encode("utf-8")
+        self.partes.append(datos)
+        self.tamano += len(datos)
+        if self.tamano >= BLOQUE_CSV:
+            self.vaciar()
+        return len(datos)
+
+    def vaciar(self):
+        if self.partes:
+            self.cola.put(b"".join(self.partes))
+            self.partes = []
+            self.tamano = 0
+
+
+def _bloques_csv(conn, sql):
+    cola = queue.Queue(maxsize=MAX_BLOQUES_COLA)
+    cancelado = threading.Event()
+
+    def copiar():
+        try:
+            escritor = _EscritorCola(cola, cancelado)
+            cur = conn.cursor()
+            cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)", escritor, size=BLOQUE_CSV)
+            escritor.vaciar()
+            conn.commit()
+            cola.put(_Fin)
+        except Exception as e:
+            cola.put(e)
+
+    # El hilo hereda el contexto para que sus sentencias cuenten en la petición
+    hilo = threading.Thread(target=contextvars.copy_context().run, args=(copiar,), name="exportacion-csv", daemon=True)
+    hilo.start()
+    try:
+        while True:
+            bloque = cola.get()
+            if bloque is _Fin:
+                break
+            if isinstance(bloque, Exception):
+                raise bloque
+            yield bloque
+    finally:
+        # Si el cliente cortó, el COPY se aborta en su próxima escritura; se vacía la
+        # cola para que el hilo no quede bloqueado en put()
+        cancelado.set()
+        while hilo.is_alive():
+            try:
+                cola.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        conn.close()
+
+
+def exportar_csv(conn, tabla, desde=None, hasta=None):
+    """Respuesta CSV en streaming; se queda con ``conn`` y la cierra al terminar."""
+    sql = consulta_exportacion(conn.cursor(), tabla, desde, hasta)
+    return StreamingResponse(
+        _bloques_csv(conn, sql),
+        media_type=TIPO_CSV,
+        headers={"Content-Disposition": f'attachment; filename="{_nombre_archivo(tabla, desde, hasta)}.csv"'}
+    )
+
+
+# OID de tipo de PostgreSQL -> tipo de Arrow; el resto se exporta como texto
+def _tipo_arrow(columna):
+    oid = columna.type_code
+    if oid == 16:
+        return pyarrow.bool_()
+    if oid == 21:
+        return pyarrow.int16()
+    if oid == 23:
+        return pyarrow.int32()
+    if oid == 20:
+        return pyarrow.int64()
+    if oid in (700, 701):
+        return pyarrow.float64()
+    if oid == 1700:
+        if columna.precision and columna.scale is not None and columna.precision <= 38:
+            return pyarrow.decimal128(columna.precision, columna.scale)
+        return pyarrow.float64()
+    if oid == 1082:
+        return pyarrow.date32()
+    if oid == 1114:
+        return pyarrow.timestamp("us")
+    if oid == 1184:
+        return pyarrow.timestamp("us", tz="UTC")
+    return pyarrow.string()
+
+
+def _a_texto(valor):
+    if valor is None or isinstance(valor, str):
+        return valor
+    if isinstance(valor, (dict, list)):
+        return json.dumps(valor, ensure_ascii=False, default=str)
+    return str(valor)
+
+
+class _BufferSalida:
+    """Archivo de solo escritura para ``ParquetWriter``: acumula lo escrito hasta que se retira."""
+
+    closed = False
+
+    def __init__(self):
+        self.partes = []
+        self.posicion = 0
+
+    def write(self, datos):
+        self.partes.append(bytes(datos))
+        self.posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self.posicion
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def retirar(self):
+        datos = b"".join(self.partes)
+        self.partes = []
+        return datos
+
+
+def _grupos_parquet(conn, cur, filas_grupo):
+    try:
+        # En un cursor con nombre la descripción de las columnas llega con la primera lectura
+        filas = cur.fetchmany(filas_grupo)
+        esquema = pyarrow.schema([(columna.name, _tipo_arrow(columna)) for columna in cur.description])
+        texto = [i for i, campo in enumerate(esquema) if pyarrow.types.is_string(campo.type)]
+        flotantes = [i for i, campo in enumerate(esquema) if pyarrow.types.is_floating(campo.type)]
+
+        salida = _BufferSalida()
+        escritor = pyarrow.parquet.ParquetWriter(salida, esquema, compression="zstd")
+        while filas:
+            valores = [list(columna) for columna in zip(*filas)]
+            for i in texto:
+                valores[i] = [_a_texto(valor) for valor in valores[i]]
+            for i in flotantes:
+                valores[i] = [None if valor is None else float(valor) for valor in valores[i]]
+            escritor.write_table(pyarrow.Table.from_arrays(valores, schema=esquema), row_group_size=filas_grupo)
+            yield salida.retirar()
+            filas = cur.fetchmany(filas_grupo)
+        escritor.close()
+        yield salida.retirar()
+        cur.close()
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def exportar_parquet(conn, tabla, desde=None, hasta=None, filas_grupo=FILAS_GRUPO):
+    """Respuesta Parquet en streaming, un row group por lote; se queda con ``conn`` y la cierra al terminar."""
+    sql = consulta_exportacion(conn.cursor(), tabla, desde, hasta)
+    cur = conn.cursor(name="exportacion_parquet")
+    cur.itersize = filas_grupo
+    cur.execute(sql)
+    return StreamingResponse(
+        _grupos_parquet(conn, cur, filas_grupo),
+        media_type=TIPO_PARQUET,
+        headers={"Content-Disposition": f'attachment; filename="{_nombre_archivo(tabla, desde, hasta)}.parquet"'}
+    )
+
+
+def _nombre_archivo(tabla, desde, hasta):
+    return "_".join([tabla] + [str(fecha) for fecha in (desde, hasta) if fecha is not None])
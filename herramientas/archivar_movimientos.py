@@ -0,0 +1,61 @@
+"""Archiva en Parquet los movimientos de inventario más viejos que el horizonte.
+
+Pensado para correr periódicamente (p. ej. un cron nocturno). Cada mes se
+mueve en su propia transacción, así que se puede interrumpir y volver a
+correr sin perder ni duplicar movimientos; ver ``historico``.
+
+Uso (desde la raíz del repositorio, con DATABASE_URL configurada):
+
+    python -m herramientas.archivar_movimientos --horizonte-dias 365 --directorio /datos/archivo_movimientos
+"""
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+from dotenv import load_dotenv
+
+# Antes de importar historico, que lee su configuración del entorno
+load_dotenv()
+
+import historico
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archiva movimientos antiguos en Parquet")
+    parser.add_argument("--horizonte-dias", type=int, default=historico.HORIZONTE_DIAS, help="Se archivan los movimientos anteriores a hoy menos estos días")
+    parser.add_argument("--directorio", default=historico.DIRECTORIO)
+    parser.add_argument("--filas-grupo", type=int, default=historico.FILAS_GRUPO, help="Filas por row group")
+    args = parser.parse_args()
+
+    if historico.pyarrow is None:
+        print("❌ ERROR: pyarrow no está instalado")
+        return 2
+    if args.directorio != historico.DIRECTORIO:
+        print(f"⚠️ La aplicación lee el archivo desde {historico.DIRECTORIO}; configurar ARCHIVO_MOVIMIENTOS_DIR={args.directorio}")
+
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        print("❌ ERROR: DATABASE_URL no configurada")
+        return 2
+
+    conn = psycopg2.connect(database_url)
+    inicio = time.perf_counter()
+    try:
+        archivados = historico.archivar(conn, args.horizonte_dias, args.directorio, args.filas_grupo)
+    except Exception as e:
+        print(f"❌ {e}")
+        return 1
+    finally:
+        conn.close()
+
+    for mes, filas in archivados:
+        print(f"💾 {mes:%Y-%m}: {filas} movimientos")
+    total = sum(filas for _, filas in archivados)
+    print(f"✅ {total} movimientos archivados en {time.perf_counter() - inicio:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,396 @@
+"""Micro-benchmarks de las rutas de la API sobre datos sembrados.
+
+Siembra la base (productos ``BENCH-*``, movimientos, auditoría y mermas
+pendientes) hasta los tamaños pedidos y mide cada ruta de ``main.py`` con
+``TestClient``: las lecturas tal cual, y las escrituras con su preparación
+fuera del tiempo medido (p. ej. se registra una merma antes de medir su
+aprobación, y se procesa un cierre antes de medir su reversión). El cierre
+se mide con varios tamaños de CSV, tanto el análisis (``subir-csv``) como el
+procesamiento y la reversión.
+
+El resultado se escribe en JSON (latencias p50/p95/p99, media y
+peticiones por segundo de cada caso). Con ``--comparar`` se compara contra
+una corrida anterior y el proceso termina con código 1 si algún caso empeoró
+su p50 o p95 más que ``--tolerancia``.
+
+Uso (desde la raíz del repositorio, con DATABASE_URL apuntando a una base de
+pruebas; conviene una base por escala, la siembra solo agrega filas):
+
+    python -m herramientas.benchmark --productos 10000 --movimientos 1000000 --salida bench_10k.json
+    python -m herramientas.benchmark --productos 10000 --movimientos 1000000 --comparar bench_10k.json
+"""
+import argparse
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+import uuid
+from datetime import date, datetime
+
+from fastapi.testclient import TestClient
+
+from main import app, get_db
+
+PREFIJO_CODIGO = "BENCH-"
+# Los productos que crean los cierres medidos no cuentan para la escala sembrada
+PREFIJO_CIERRE = "BENCHC-"
+MOTIVO_SEMBRADO = "Benchmark"
+CATEGORIAS = 20
+
+
+def sembrar(conn, productos, movimientos, auditorias, mermas, semilla):
+    """Completa los datos de benchmark hasta los tamaños pedidos (idempotente)."""
+    cur = conn.cursor()
+    cur.execute("SELECT setseed(%s)", (((semilla % 1000) / 1000.0),))
+    cur.execute("SELECT id FROM usuarios WHERE activo = true ORDER BY id LIMIT 1")
+    usuario_id = cur.fetchone()[0]
+
+    cur.execute("SELECT COUNT(*) FROM productos WHERE codigo LIKE %s", (PREFIJO_CODIGO + "%",))
+    existentes = cur.fetchone()[0]
+    if existentes < productos:
+        print(f"🌱 Sembrando {productos - existentes} productos")
+        cur.execute("""
+            INSERT INTO productos (codigo, nombre, categoria, precio_compra, precio_venta, costo_promedio, stock_actual, stock_minimo)
+            SELECT %(prefijo)s || i, 'Producto benchmark ' || i, 'Categoría ' || (i %% %(categorias)s),
+                   p.compra, round(p.compra * (1.2 + random() * 0.6), 2), p.compra,
+                   100 + floor(random() * 900)::int, 10
+            FROM generate_series(%(desde)s, %(hasta)s) AS i
+            CROSS JOIN LATERAL (SELECT round((1 + random() * 99)::numeric, 2) AS compra) p
+            ON CONFLICT (codigo) DO NOTHING
+        """, {"prefijo": PREFIJO_CODIGO, "categorias": CATEGORIAS, "desde": existentes + 1, "hasta": productos})
+
+    cur.execute("SELECT COUNT(*) FROM movimientos_inventario WHERE motivo = %s", (MOTIVO_SEMBRADO,))
+    faltantes = movimientos - cur.fetchone()[0]
+    if faltantes > 0:
+        print(f"🌱 Sembrando {faltantes} movimientos")
+        # Popularidad sesgada: power(random(), 3) concentra los movimientos en los primeros productos
+        cur.execute("""
+            WITH p AS (
+                SELECT array_agg(id ORDER BY id) AS ids FROM productos WHERE codigo LIKE %(prefijo)s
+            )
+            INSERT INTO movimientos_inventario
+                (producto_id, tipo_movimiento, cantidad, motivo, fecha_movimiento, usuario_id, precio_unitario, costo_unitario)
+            SELECT m.producto_id, m.tipo, 1 + floor(random() * 10)::int, %(motivo)s,
+                   CURRENT_TIMESTAMP - random() * INTERVAL '365 days', %(usuario_id)s,
+                   pr.precio_venta, pr.costo_promedio
+            FROM p, generate_series(1, %(faltantes)s) AS g
+            -- La referencia a g obliga a evaluar random() una vez por fila
+            CROSS JOIN LATERAL (
+                SELECT p.ids[1 + floor(power(random(), 3) * array_length(p.ids, 1))::int] AS producto_id,
+                       CASE WHEN random() < 0.7 THEN 'salida' ELSE 'entrada' END AS tipo
+                WHERE g > 0
+            ) m
+            JOIN productos pr ON pr.id = m.producto_id
+        """, {"prefijo": PREFIJO_CODIGO + "%", "motivo": MOTIVO_SEMBRADO, "usuario_id": usuario_id, "faltantes": faltantes})
+
+    cur.execute("SELECT COUNT(*) FROM auditoria_sistema WHERE detalles @> jsonb_build_object('mensaje', %s::text)", (MOTIVO_SEMBRADO,))
+    faltantes = auditorias - cur.fetchone()[0]
+    if faltantes > 0:
+        print(f"🌱 Sembrando {faltantes} registros de auditoría")
+        cur.execute("""
+            INSERT INTO auditoria_sistema (usuario_id, accion, tabla_afectada, detalles, fecha)
+            SELECT %(usuario_id)s,
+                   (ARRAY['LOGIN', 'LOGIN', 'LOGIN', 'CIERRE_DIARIO', 'APROBAR_MERMA', 'REGISTRAR_MERMA'])[1 + floor(random() * 6)::int],
+                   'productos', jsonb_build_object('mensaje', %(detalles)s::text), CURRENT_TIMESTAMP - random() * INTERVAL '365 days'
+            FROM generate_series(1, %(faltantes)s)
+        """, {"usuario_id": usuario_id, "detalles": MOTIVO_SEMBRADO, "faltantes": faltantes})
+
+    cur.execute("SELECT COUNT(*) FROM mermas_pendientes WHERE motivo = %s AND estado = 'pendiente'", (MOTIVO_SEMBRADO,))
+    faltantes = mermas - cur.fetchone()[0]
+    if faltantes > 0:
+        cur.execute("""
+            INSERT INTO mermas_pendientes (producto_id, cantidad, motivo, usuario_solicitud_id)
+            SELECT id, 1, %(motivo)s, %(usuario_id)s
+            FROM productos WHERE codigo LIKE %(prefijo)s
+            ORDER BY id LIMIT %(faltantes)s
+        """, {"prefijo": PREFIJO_CODIGO + "%", "motivo": MOTIVO_SEMBRADO, "usuario_id": usuario_id, "faltantes": faltantes})
+
+    conn.commit()
+    cur.execute("ANALYZE")
+
+
+def cargar_contexto(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM usuarios WHERE activo = true AND rol = 'dueño' ORDER BY id LIMIT 1")
+    dueno_id = cur.fetchone()[0]
+    cur.execute("SELECT email, hash_contrasena FROM usuarios WHERE id = %s", (dueno_id,))
+    email, contrasena = cur.fetchone()
+    cur.execute("SELECT id FROM usuarios WHERE activo = true AND rol = 'empleado' ORDER BY id LIMIT 1")
+    empleado_id = cur.fetchone()[0]
+    cur.execute("SELECT id, codigo FROM productos WHERE codigo LIKE %s ORDER BY id LIMIT 1000", (PREFIJO_CODIGO + "%",))
+    productos = cur.fetchall()
+    # Las escrituras de mermas descuentan del producto con más stock
+    cur.execute("SELECT id FROM productos WHERE codigo LIKE %s ORDER BY stock_actual DESC LIMIT 1", (PREFIJO_CODIGO + "%",))
+    producto_escritura = cur.fetchone()[0]
+    return {
+        "dueno_id": dueno_id,
+        "empleado_id": empleado_id,
+        "email": email,
+        "contrasena": contrasena,
+        "productos": productos,
+        "producto_escritura": producto_escritura,
+    }
+
+
+def filas_cierre(contexto, tamano, lote):
+    """Filas de un cierre: la mitad actualiza productos existentes y la otra mitad crea nuevos."""
+    existentes = contexto["productos"]
+    filas = []
+    for i in range(tamano):
+        if i % 2 == 0 and existentes:
+            codigo = existentes[(i // 2) % len(existentes)][1]
+        else:
+            codigo = f"{PREFIJO_CIERRE}{lote}-{i}"
+        filas.append({
+            "codigo": codigo,
+            "nombre": f"Producto benchmark {codigo}",
+            "categoria": f"Categoría {i % CATEGORIAS}",
+            "cantidad": 1 + i % 10,
+            "precio_compra": 10.0,
+            "precio_venta": 15.0,
+        })
+    return filas
+
+
+def csv_cierre(filas):
+    salida = io.StringIO()
+    salida.write("codigo,nombre,categoria,cantidad,precio_compra,precio_venta\n")
+    for fila in filas:
+        salida.write(f"{fila['codigo']},{fila['nombre']},{fila['categoria']},{fila['cantidad']},{fila['precio_compra']},{fila['precio_venta']}\n")
+    return salida.getvalue().encode("utf-8")
+
+
+def proceso_de_cierre(cierre_id):
+    conn = get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM auditoria_sistema WHERE accion = 'CIERRE_DIARIO' AND registro_id = %s", (cierre_id,))
+        return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def casos_lectura(contexto):
+    dueno_id = contexto["dueno_id"]
+    producto_popular = contexto["productos"][0][0]
+    return [
+        ("GET /", "GET", "/", {}),
+        ("GET /inventario", "GET", "/inventario", {}),
+        ("GET /inventario/al", "GET", f"/inventario/al?fecha={date.today().isoformat()}", {}),
+        ("GET /productos/{id}/movimientos", "GET", f"/productos/{producto_popular}/movimientos", {}),
+        ("GET /auditoria", "GET", "/auditoria", {}),
+        ("GET /mermas/pendientes", "GET", "/mermas/pendientes", {}),
+        ("GET /reportes/metricas", "GET", "/reportes/metricas", {}),
+        ("GET /reportes/ventas", "GET", "/reportes/ventas", {}),
+        ("GET /reportes/stock-critico", "GET", "/reportes/stock-critico", {}),
+        ("GET /reportes/productos-mas-vendidos", "GET", "/reportes/productos-mas-vendidos", {}),
+        ("GET /usuarios", "GET", "/usuarios", {}),
+        ("GET /configuraciones", "GET", "/configuraciones", {}),
+        ("GET /metrics", "GET", "/metrics", {}),
+        ("GET /admin/consultas-lentas", "GET", f"/admin/consultas-lentas?usuario_id={dueno_id}", {}),
+        ("POST /auth/login", "POST", "/auth/login", {"json": {"username": contexto["email"], "password": contexto["contrasena"]}}),
+        ("POST /configuraciones/actualizar", "POST", "/configuraciones/actualizar", {"json": {"clave": "benchmark", "valor": "1"}}),
+    ]
+
+
+def medir(cliente, nombre, peticion, repeticiones, calentamiento):
+    """Mide ``peticion()`` (que devuelve (metodo, url, kwargs)) ``repeticiones`` veces."""
+    latencias = []
+    errores = 0
+    for i in range(calentamiento + repeticiones):
+        metodo, url, kwargs = peticion()
+        inicio = time.perf_counter()
+        respuesta = cliente.request(metodo, url, **kwargs)
+        duracion = time.perf_counter() - inicio
+        if i < calentamiento:
+            continue
+        latencias.append(duracion * 1000)
+        if respuesta.status_code >= 400:
+            errores += 1
+
+    latencias.sort()
+    resultado = {
+        "repeticiones": repeticiones,
+        "errores": errores,
+        "p50_ms": round(percentil(latencias, 50), 3),
+        "p95_ms": round(percentil(latencias, 95), 3),
+        "p99_ms": round(percentil(latencias, 99), 3),
+        "media_ms": round(statistics.fmean(latencias), 3),
+        "max_ms": round(latencias[-1], 3),
+        "peticiones_por_segundo": round(1000 * len(latencias) / sum(latencias), 1),
+    }
+    marca = "❌" if errores else "✅"
+    print(f"{marca} {nombre}: p50 {resultado['p50_ms']} ms, p95 {resultado['p95_ms']} ms, {resultado['peticiones_por_segundo']} req/s")
+    return resultado
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return 0.0
+    indice = (len(ordenados) - 1) * p / 100
+    inferior = int(indice)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (indice - inferior)
+
+
+def ejecutar(cliente, contexto, args):
+    resultados = {}
+    for nombre, metodo, url, kwargs in casos_lectura(contexto):
+        resultados[nombre] = medir(cliente, nombre, lambda: (metodo, url, kwargs), args.repeticiones, args.calentamiento)
+
+    dueno_id = contexto["dueno_id"]
+    producto_id = contexto["producto_escritura"]
+
+    def merma(usuario_id):
+        return {"producto_id": producto_id, "cantidad": 1, "motivo": "Benchmark escritura", "usuario_id": usuario_id}
+
+    # Registrada por el empleado queda pendiente; por el dueño se aplica al momento
+    resultados["POST /mermas/registrar"] = medir(
+        cliente, "POST /mermas/registrar", lambda: ("POST", "/mermas/registrar", {"json": merma(contexto["empleado_id"])}),
+        args.repeticiones, args.calentamiento
+    )
+
+    def pendiente():
+        return cliente.post("/mermas/registrar", json=merma(contexto["empleado_id"])).json()["merma_id"]
+
+    def aprobar():
+        return "POST", f"/mermas/aprobar?merma_id={pendiente()}&usuario_id={dueno_id}", {}
+
+    resultados["POST /mermas/aprobar"] = medir(cliente, "POST /mermas/aprobar", aprobar, args.repeticiones, args.calentamiento)
+
+    def rechazar():
+        return "POST", f"/mermas/rechazar?merma_id={pendiente()}&usuario_id={dueno_id}&motivo_rechazo=benchmark", {}
+
+    resultados["POST /mermas/rechazar"] = medir(cliente, "POST /mermas/rechazar", rechazar, args.repeticiones, args.calentamiento)
+
+    def usuario_nuevo():
+        return {"nombre": "Benchmark", "email": f"bench-{uuid.uuid4().hex}@ejemplo.com", "password": "x", "rol": "empleado"}
+
+    resultados["POST /usuarios"] = medir(
+        cliente, "POST /usuarios", lambda: ("POST", "/usuarios", {"json": usuario_nuevo()}),
+        args.repeticiones, args.calentamiento
+    )
+
+    def eliminar_usuario():
+        nuevo_id = cliente.post("/usuarios", json=usuario_nuevo()).json()["id"]
+        return "DELETE", f"/usuarios/{nuevo_id}?usuario_actual_id={dueno_id}", {}
+
+    resultados["DELETE /usuarios/{id}"] = medir(cliente, "DELETE /usuarios/{id}", eliminar_usuario, args.repeticiones, args.calentamiento)
+
+    def eliminar_producto():
+        return "DELETE", f"/productos/{producto_id}?usuario_id={dueno_id}&cantidad=1", {}
+
+    resultados["DELETE /productos/{id}"] = medir(cliente, "DELETE /productos/{id}", eliminar_producto, args.repeticiones, args.calentamiento)
+
+    for tamano in args.tamanos_cierre:
+        repeticiones = max(3, args.repeticiones // max(1, tamano // 100))
+        calentamiento = min(args.calentamiento, 1)
+
+        def subir():
+            contenido = csv_cierre(filas_cierre(contexto, tamano, uuid.uuid4().hex[:8]))
+            return "POST", "/cierres-diarios/subir-csv", {
+                "files": {"archivo": ("cierre.csv", contenido, "text/csv")},
+                "data": {"usuario_id": str(dueno_id)},
+            }
+
+        nombre = f"POST /cierres-diarios/subir-csv [{tamano}]"
+        resultados[nombre] = medir(cliente, nombre, subir, repeticiones, calentamiento)
+
+        def procesar():
+            lote = uuid.uuid4().hex[:8]
+            return "POST", "/cierres-diarios/procesar", {
+                "json": {"productos": filas_cierre(contexto, tamano, lote), "nombre_archivo": f"bench-{lote}.csv", "usuario_id": dueno_id}
+            }
+
+        nombre = f"POST /cierres-diarios/procesar [{tamano}]"
+        resultados[nombre] = medir(cliente, nombre, procesar, repeticiones, calentamiento)
+
+        def revertir():
+            metodo, url, kwargs = procesar()
+            cierre_id = cliente.request(metodo, url, **kwargs).json()["cierre_id"]
+            return "POST", "/revertir-proceso", {"json": {"proceso_id": proceso_de_cierre(cierre_id), "proceso_tipo": "CIERRE_DIARIO"}}
+
+        nombre = f"POST /revertir-proceso [{tamano}]"
+        resultados[nombre] = medir(cliente, nombre, revertir, repeticiones, calentamiento)
+
+    return resultados
+
+
+def comparar(actual, anterior, tolerancia):
+    """Devuelve la lista de casos cuyo p50 o p95 empeoró más que ``tolerancia`` (fracción)."""
+    regresiones = []
+    for nombre, resultado in actual.items():
+        base = anterior.get(nombre)
+        if not base:
+            continue
+        for metrica in ("p50_ms", "p95_ms"):
+            if base[metrica] > 0 and resultado[metrica] > base[metrica] * (1 + tolerancia):
+                cambio = (resultado[metrica] / base[metrica] - 1) * 100
+                regresiones.append(f"{nombre} {metrica}: {base[metrica]} → {resultado[metrica]} ms (+{cambio:.0f}%)")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks de las rutas de la API")
+    parser.add_argument("--productos", type=int, default=1000)
+    parser.add_argument("--movimientos", type=int, default=100000)
+    parser.add_argument("--auditorias", type=int, default=50000)
+    parser.add_argument("--mermas", type=int, default=100, help="Mermas pendientes sembradas")
+    parser.add_argument("--tamanos-cierre", type=lambda valor: [int(t) for t in valor.split(",")], default=[10, 100, 1000])
+    parser.add_argument("--repeticiones", type=int, default=30)
+    parser.add_argument("--calentamiento", type=int, default=3)
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--salida", help="Archivo JSON donde guardar los resultados")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior contra el cual comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="Empeoramiento permitido (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    conn = get_db()
+    if not conn:
+        print("❌ ERROR: no se pudo conectar a PostgreSQL (¿DATABASE_URL?)")
+        return 2
+    try:
+        sembrar(conn, args.productos, args.movimientos, args.auditorias, args.mermas, args.semilla)
+        contexto = cargar_contexto(conn)
+    finally:
+        conn.close()
+
+    cliente = TestClient(app)
+    inicio = time.perf_counter()
+    resultados = ejecutar(cliente, contexto, args)
+
+    informe = {
+        "fecha": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "duracion_s": round(time.perf_counter() - inicio, 1),
+        "escala": {
+            "productos": args.productos,
+            "movimientos": args.movimientos,
+            "auditorias": args.auditorias,
+            "mermas": args.mermas,
+        },
+        "resultados": resultados,
+    }
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as archivo:
+            json.dump(informe, archivo, ensure_ascii=False, indent=2)
+        print(f"💾 Resultados guardados en {args.salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as archivo:
+            anterior = json.load(archivo)
+        if anterior.get("escala") != informe["escala"]:
+            print(f"⚠️ La corrida anterior usó otra escala: {anterior.get('escala')}")
+        regresiones = comparar(resultados, anterior["resultados"], args.tolerancia)
+        for regresion in regresiones:
+            print(f"❌ Regresión: {regresion}")
+        if regresiones:
+            return 1
+        print("✅ Sin regresiones respecto a la corrida anterior")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
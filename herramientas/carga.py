@@ -0,0 +1,369 @@
+"""Generador de carga por escenarios que imita el tráfico del frontend.
+
+Cada sesión simula a un usuario del frontend React con su rol:
+
+- ``dueno_dashboard``: login, las tres peticiones en paralelo de
+  ``DashboardDueño.jsx`` (inventario, usuarios, configuraciones), mermas
+  pendientes y la aprobación o el rechazo de una.
+- ``administrador_dashboard``: login, las tres peticiones en paralelo de
+  ``DashboardAdministrador.jsx`` y la auditoría completa.
+- ``empleado_dashboard``: login y las tres peticiones en paralelo de
+  ``DashboardEmpleado.jsx`` (inventario, configuraciones, auditoría).
+- ``empleado_cierre``: ``CierreDiario.jsx``: subir el CSV y procesarlo.
+- ``empleado_merma``: inventario y solicitud de merma (``AjustesStock.jsx``).
+
+Las sesiones llegan como un proceso de Poisson a ``--tasa`` sesiones por
+segundo (carga abierta: no esperan a que el servidor se desocupe) y
+``--concurrencia`` limita cuántas corren a la vez. Con varias tasas
+(``--tasa 1,2,4,8``) se corre un escalón por tasa y se marca el punto de
+saturación: el primer escalón cuyo p95 supera ``--slo-ms``, cuya tasa de
+error supera el 1% o que no logra completar el 90% de las sesiones ofrecidas.
+
+Los cierres usan ``herramientas.generar_datos``, así que conviene cargar la
+base antes con ``python -m herramientas.generar_datos cargar``.
+
+Uso (contra una instancia ya levantada):
+
+    python -m herramientas.carga --url http://localhost:8000 --tasa 1,2,4,8,16 --duracion 60
+"""
+import argparse
+import http.client
+import io
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from herramientas.generar_datos import escribir_csv
+
+# Usuarios por defecto que crea init_db
+CREDENCIALES = {
+    "dueño": ("dueno@constrefri.com", "dueno123"),
+    "administrador": ("admin@constrefri.com", "admin123"),
+    "empleado": ("empleado@constrefri.com", "empleado123"),
+}
+
+MEZCLA_POR_DEFECTO = "dueno_dashboard=2,administrador_dashboard=1,empleado_dashboard=4,empleado_cierre=1,empleado_merma=2"
+
+
+class Recolector:
+    def __init__(self):
+        self._candado = threading.Lock()
+        self.latencias = {}
+        self.errores = {}
+        self.sesiones = 0
+        self.sesiones_fallidas = 0
+
+    def registrar(self, nombre, duracion, error):
+        with self._candado:
+            self.latencias.setdefault(nombre, []).append(duracion * 1000)
+            if error:
+                self.errores[nombre] = self.errores.get(nombre, 0) + 1
+
+    def sesion(self, exito):
+        with self._candado:
+            self.sesiones += 1
+            if not exito:
+                self.sesiones_fallidas += 1
+
+    def resumen(self, duracion):
+        with self._candado:
+            endpoints = {}
+            for nombre, latencias in sorted(self.latencias.items()):
+                latencias = sorted(latencias)
+                errores = self.errores.get(nombre, 0)
+                endpoints[nombre] = {
+                    "peticiones": len(latencias),
+                    "por_segundo": round(len(latencias) / duracion, 2),
+                    "p50_ms": round(percentil(latencias, 50), 1),
+                    "p95_ms": round(percentil(latencias, 95), 1),
+                    "p99_ms": round(percentil(latencias, 99), 1),
+                    "max_ms": round(latencias[-1], 1),
+                    "errores": errores,
+                    "tasa_error": round(errores / len(latencias), 4),
+                }
+            todas = sorted(latencia for latencias in self.latencias.values() for latencia in latencias)
+            total_errores = sum(self.errores.values())
+            return {
+                "sesiones": self.sesiones,
+                "sesiones_fallidas": self.sesiones_fallidas,
+                "peticiones": len(todas),
+                "p95_ms": round(percentil(todas, 95), 1),
+                "tasa_error": round(total_errores / len(todas), 4) if todas else 0.0,
+                "endpoints": endpoints,
+            }
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return 0.0
+    indice = (len(ordenados) - 1) * p / 100
+    inferior = int(indice)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (indice - inferior)
+
+
+class ErrorPeticion(Exception):
+    pass
+
+
+class Cliente:
+    """Cliente HTTP con una conexión keep-alive por hilo, como un navegador."""
+
+    def __init__(self, url, recolector, timeout):
+        partes = urllib.parse.urlsplit(url)
+        self.clase = http.client.HTTPSConnection if partes.scheme == "https" else http.client.HTTPConnection
+        self.servidor = partes.netloc
+        self.prefijo = partes.path.rstrip("/")
+        self.recolector = recolector
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conexion(self):
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            conexion = self._local.conexion = self.clase(self.servidor, timeout=self.timeout)
+        return conexion
+
+    def pedir(self, nombre, metodo, ruta, json_=None, cuerpo=None, cabeceras=None):
+        """Hace la petición, la registra bajo ``nombre`` y devuelve el JSON; lanza ``ErrorPeticion`` si falla."""
+        cabeceras = dict(cabeceras or {})
+        if json_ is not None:
+            cuerpo = json.dumps(json_).encode("utf-8")
+            cabeceras["Content-Type"] = "application/json"
+
+        inicio = time.perf_counter()
+        estado = None
+        datos = b""
+        try:
+            conexion = self._conexion()
+            conexion.request(metodo, self.prefijo + ruta, body=cuerpo, headers=cabeceras)
+            respuesta = conexion.getresponse()
+            estado = respuesta.status
+            datos = respuesta.read()
+        except (OSError, http.client.HTTPException):
+            self._local.conexion = None
+        duracion = time.perf_counter() - inicio
+
+        error = estado is None or estado >= 400
+        self.recolector.registrar(nombre, duracion, error)
+        if error:
+            raise ErrorPeticion(f"{nombre}: {estado or 'sin respuesta'}")
+        return json.loads(datos) if datos else None
+
+
+def multipart(campos, archivos):
+    """Cuerpo ``multipart/form-data`` como el ``FormData`` del navegador."""
+    limite = uuid.uuid4().hex
+    cuerpo = io.BytesIO()
+    for nombre, valor in campos.items():
+        cuerpo.write(f'--{limite}\r\nContent-Disposition: form-data; name="{nombre}"\r\n\r\n{valor}\r\n'.encode())
+    for nombre, (archivo, contenido, tipo) in archivos.items():
+        cuerpo.write(f'--{limite}\r\nContent-Disposition: form-data; name="{nombre}"; filename="{archivo}"\r\nContent-Type: {tipo}\r\n\r\n'.encode())
+        cuerpo.write(contenido)
+        cuerpo.write(b"\r\n")
+    cuerpo.write(f"--{limite}--\r\n".encode())
+    return cuerpo.getvalue(), {"Content-Type": f"multipart/form-data; boundary={limite}"}
+
+
+class Escenarios:
+    def __init__(self, cliente, paralelo, rng, args):
+        self.cliente = cliente
+        self.paralelo = paralelo
+        self.rng = rng
+        self.args = args
+
+    def _pausa(self):
+        if self.args.pausa > 0:
+            time.sleep(self.rng.expovariate(1 / self.args.pausa))
+
+    def _en_paralelo(self, *peticiones):
+        """Equivalente a ``Promise.all`` del frontend."""
+        futuros = [self.paralelo.submit(self.cliente.pedir, *peticion) for peticion in peticiones]
+        return [futuro.result() for futuro in futuros]
+
+    def _login(self, rol):
+        email, contrasena = CREDENCIALES[rol]
+        respuesta = self.cliente.pedir("POST /auth/login", "POST", "/auth/login", {"username": email, "password": contrasena})
+        self._pausa()
+        return respuesta["usuario"]["id"]
+
+    def dueno_dashboard(self):
+        usuario_id = self._login("dueño")
+        self._en_paralelo(
+            ("GET /inventario", "GET", "/inventario"),
+            ("GET /usuarios", "GET", "/usuarios"),
+            ("GET /configuraciones", "GET", "/configuraciones"),
+        )
+        self._pausa()
+        pendientes = self.cliente.pedir("GET /mermas/pendientes", "GET", "/mermas/pendientes")
+        self._pausa()
+        if pendientes:
+            merma_id = self.rng.choice(pendientes)["id"]
+            if self.rng.random() < 0.8:
+                self.cliente.pedir("POST /mermas/aprobar", "POST", f"/mermas/aprobar?merma_id={merma_id}&usuario_id={usuario_id}")
+            else:
+                motivo = urllib.parse.quote("Prueba de carga")
+                self.cliente.pedir("POST /mermas/rechazar", "POST", f"/mermas/rechazar?merma_id={merma_id}&usuario_id={usuario_id}&motivo_rechazo={motivo}")
+
+    def administrador_dashboard(self):
+        self._login("administrador")
+        self._en_paralelo(
+            ("GET /inventario", "GET", "/inventario"),
+            ("GET /usuarios", "GET", "/usuarios"),
+            ("GET /configuraciones", "GET", "/configuraciones"),
+        )
+        self._pausa()
+        self._en_paralelo(
+            ("GET /auditoria", "GET", "/auditoria"),
+            ("GET /usuarios", "GET", "/usuarios"),
+        )
+
+    def empleado_dashboard(self):
+        self._login("empleado")
+        self._en_paralelo(
+            ("GET /inventario", "GET", "/inventario"),
+            ("GET /configuraciones", "GET", "/configuraciones"),
+            ("GET /auditoria", "GET", "/auditoria?limit=50"),
+        )
+
+    def empleado_cierre(self):
+        usuario_id = self._login("empleado")
+        archivo = io.StringIO()
+        escribir_csv(archivo, self.args.filas_cierre, self.rng.randrange(1 << 30))
+        cuerpo, cabeceras = multipart(
+            {"usuario_id": usuario_id},
+            {"archivo": (f"cierre_carga_{uuid.uuid4().hex[:8]}.csv", archivo.getvalue().encode("utf-8"), "text/csv")}
+        )
+        datos = self.cliente.pedir("POST /cierres-diarios/subir-csv", "POST", "/cierres-diarios/subir-csv", cuerpo=cuerpo, cabeceras=cabeceras)
+        self._pausa()
+        self.cliente.pedir("POST /cierres-diarios/procesar", "POST", "/cierres-diarios/procesar", {
+            "productos": datos["productos"],
+            "nombre_archivo": datos["nombre_archivo"],
+            "usuario_id": usuario_id,
+        })
+
+    def empleado_merma(self):
+        usuario_id = self._login("empleado")
+        inventario = self.cliente.pedir("GET /inventario", "GET", "/inventario")
+        con_stock = [producto for producto in inventario[:500] if (producto.get("stock_actual") or 0) > 0]
+        if not con_stock:
+            return
+        self._pausa()
+        producto = self.rng.choice(con_stock)
+        self.cliente.pedir("POST /mermas/registrar", "POST", "/mermas/registrar", {
+            "producto_id": producto["id"],
+            "cantidad": 1,
+            "motivo": "Prueba de carga",
+            "usuario_id": usuario_id,
+        })
+
+
+def leer_mezcla(texto):
+    mezcla = {}
+    for parte in texto.split(","):
+        nombre, _, peso = parte.partition("=")
+        if not hasattr(Escenarios, nombre.strip()):
+            raise argparse.ArgumentTypeError(f"Escenario desconocido: {nombre}")
+        mezcla[nombre.strip()] = float(peso or 1)
+    return mezcla
+
+
+def correr_escalon(args, tasa, mezcla):
+    recolector = Recolector()
+    cliente = Cliente(args.url, recolector, args.timeout)
+    rng = random.Random(args.semilla + int(tasa * 1000))
+    nombres = list(mezcla)
+    pesos = [mezcla[nombre] for nombre in nombres]
+    ofrecidas = 0
+    semaforo = threading.BoundedSemaphore(args.concurrencia)
+    descartadas = 0
+
+    def sesion(nombre, semilla):
+        try:
+            getattr(Escenarios(cliente, paralelo, random.Random(semilla), args), nombre)()
+            recolector.sesion(True)
+        except Exception:
+            recolector.sesion(False)
+        finally:
+            semaforo.release()
+
+    with ThreadPoolExecutor(max_workers=args.concurrencia * 3) as paralelo, ThreadPoolExecutor(max_workers=args.concurrencia) as sesiones:
+        inicio = time.perf_counter()
+        siguiente = inicio
+        while True:
+            siguiente += rng.expovariate(tasa)
+            if siguiente - inicio >= args.duracion:
+                break
+            espera = siguiente - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            ofrecidas += 1
+            # Con todas las sesiones ocupadas la llegada se descarta: el cliente no debe
+            # acumular una cola propia que oculte la saturación del servidor
+            if not semaforo.acquire(blocking=False):
+                descartadas += 1
+                continue
+            sesiones.submit(sesion, rng.choices(nombres, pesos)[0], rng.randrange(1 << 30))
+        duracion = time.perf_counter() - inicio
+
+    resumen = recolector.resumen(duracion)
+    resumen.update({"tasa_ofrecida": tasa, "sesiones_ofrecidas": ofrecidas, "sesiones_descartadas": descartadas, "duracion_s": round(duracion, 1)})
+    return resumen
+
+
+def imprimir(resumen):
+    print(f"\n📊 Tasa {resumen['tasa_ofrecida']} sesiones/s: {resumen['sesiones']} sesiones ({resumen['sesiones_fallidas']} fallidas, "
+          f"{resumen['sesiones_descartadas']} descartadas), p95 {resumen['p95_ms']} ms, error {resumen['tasa_error'] * 100:.2f}%")
+    print(f"   {'endpoint':<36} {'req':>7} {'req/s':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'error':>7}")
+    for nombre, datos in resumen["endpoints"].items():
+        print(f"   {nombre:<36} {datos['peticiones']:>7} {datos['por_segundo']:>7} {datos['p50_ms']:>8} {datos['p95_ms']:>8} {datos['p99_ms']:>8} {datos['tasa_error'] * 100:>6.2f}%")
+
+
+def saturado(resumen, slo_ms):
+    completadas = resumen["sesiones"] / resumen["sesiones_ofrecidas"] if resumen["sesiones_ofrecidas"] else 1.0
+    return resumen["p95_ms"] > slo_ms or resumen["tasa_error"] > 0.01 or completadas < 0.9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generador de carga por escenarios del frontend")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--tasa", type=lambda valor: [float(t) for t in valor.split(",")], default=[2.0], help="Sesiones por segundo; varias separadas por comas")
+    parser.add_argument("--duracion", type=float, default=60, help="Segundos por escalón")
+    parser.add_argument("--concurrencia", type=int, default=50, help="Máximo de sesiones simultáneas")
+    parser.add_argument("--mezcla", type=leer_mezcla, default=leer_mezcla(MEZCLA_POR_DEFECTO))
+    parser.add_argument("--pausa", type=float, default=0.5, help="Tiempo medio de lectura entre pasos de una sesión (s)")
+    parser.add_argument("--filas-cierre", type=int, default=200)
+    parser.add_argument("--slo-ms", type=float, default=1000, help="p95 máximo aceptable")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--salida", help="Archivo JSON con el resumen de cada escalón")
+    args = parser.parse_args()
+
+    escalones = []
+    saturacion = None
+    for tasa in args.tasa:
+        resumen = correr_escalon(args, tasa, args.mezcla)
+        escalones.append(resumen)
+        imprimir(resumen)
+        if saturado(resumen, args.slo_ms):
+            saturacion = tasa
+            print(f"\n⚠️ Saturación a {tasa} sesiones/s")
+            break
+
+    if saturacion is None:
+        print(f"\n✅ Sin saturación hasta {args.tasa[-1]} sesiones/s")
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as archivo:
+            json.dump({"saturacion": saturacion, "escalones": escalones}, archivo, ensure_ascii=False, indent=2)
+        print(f"💾 Resumen guardado en {args.salida}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
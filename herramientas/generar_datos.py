@@ -0,0 +1,310 @@
+"""Generador de datos sintéticos reproducibles.
+
+Dos comandos:
+
+- ``csv``: escribe en stdout (o ``--salida``) un cierre diario en el formato
+  que acepta ``/cierres-diarios/subir-csv``
+  (``codigo,nombre,categoria,cantidad,precio_compra,precio_venta``) fila por
+  fila, sin armarlo en memoria, así que puede tener millones de filas.
+- ``cargar``: carga con ``COPY`` un catálogo de productos y un historial de
+  cierres, movimientos, mermas y auditoría directamente en PostgreSQL.
+
+Con la misma ``--semilla`` la salida es idéntica. Cada producto ``GEN-<n>``
+se deriva solo de (semilla, n), de modo que un CSV generado actualiza los
+mismos productos que cargó ``cargar``. La popularidad sigue una ley de Zipf
+(pocos productos concentran la mayoría de los movimientos) y la actividad
+diaria tiene estacionalidad semanal y anual (pico en diciembre, sábados
+fuertes, domingos flojos).
+
+Uso (desde la raíz del repositorio, con DATABASE_URL apuntando a una base de
+pruebas):
+
+    python -m herramientas.generar_datos csv --filas 1000000 --semilla 7 > cierre.csv
+    python -m herramientas.generar_datos cargar --productos 100000 --movimientos 5000000 --dias 365
+"""
+import argparse
+import bisect
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import psycopg2
+from dotenv import load_dotenv
+
+PREFIJO_CODIGO = "GEN-"
+MOTIVO_GENERADO = "Generado"
+DETALLES_GENERADO = json.dumps({"mensaje": MOTIVO_GENERADO})
+
+CATEGORIAS = (
+    "Refrigeración", "Aire acondicionado", "Compresores", "Gases refrigerantes",
+    "Herramientas", "Tubería de cobre", "Electricidad", "Controles", "Aislantes", "Repuestos",
+)
+TIPOS = (
+    "Compresor", "Capacitor", "Termostato", "Válvula", "Filtro secador", "Ventilador",
+    "Tubo capilar", "Contactor", "Relé", "Manómetro", "Evaporador", "Condensador",
+)
+MARCAS = ("Tecumseh", "Embraco", "Danfoss", "Copeland", "Sanhua", "Genérico", "Emerson", "Full Gauge")
+MOTIVOS_MERMA = ("Producto dañado", "Vencimiento", "Error de conteo", "Robo", "Devolución defectuosa")
+
+# Peso relativo de la actividad por día de la semana (lunes = 0) y por mes
+PESO_DIA_SEMANA = (1.0, 0.95, 0.95, 1.0, 1.15, 1.4, 0.5)
+PESO_MES = (0.8, 0.85, 0.95, 1.0, 1.0, 0.95, 0.9, 0.95, 1.0, 1.05, 1.2, 1.6)
+
+FILAS_POR_BLOQUE = 10000
+
+_MASCARA = (1 << 64) - 1
+
+
+def _mezclar(x):
+    """splitmix64: entero pseudoaleatorio de 64 bits derivado solo de ``x``."""
+    x = (x + 0x9E3779B97F4A7C15) & _MASCARA
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASCARA
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASCARA
+    return x ^ (x >> 31)
+
+
+def producto(semilla, n):
+    """Atributos del producto ``n`` del catálogo: (codigo, nombre, categoria, precio_compra, precio_venta)."""
+    h = _mezclar(semilla * 1_000_003 + n)
+    tipo = TIPOS[h % len(TIPOS)]
+    marca = MARCAS[(h >> 8) % len(MARCAS)]
+    categoria = CATEGORIAS[(h >> 16) % len(CATEGORIAS)]
+    # Precio de compra log-uniforme entre ~2.7 y ~900: muchos repuestos baratos, pocos equipos caros
+    u = ((h >> 24) & 0xFFFFFF) / 0x1000000
+    precio_compra = round(math.exp(1 + u * 5.8), 2)
+    margen = 1.2 + ((h >> 48) & 0xFFFF) / 0x10000 * 0.6
+    return (
+        f"{PREFIJO_CODIGO}{n:07d}",
+        f"{tipo} {marca} {n}",
+        categoria,
+        precio_compra,
+        round(precio_compra * margen, 2),
+    )
+
+
+def pesos_zipf(cantidad, exponente=1.1):
+    """Pesos acumulados de una ley de Zipf sobre ``cantidad`` productos (el 0 es el más popular)."""
+    return list(itertools.accumulate(1 / (rango ** exponente) for rango in range(1, cantidad + 1)))
+
+
+def pesos_dias(desde, dias):
+    """Pesos acumulados de actividad de cada día desde ``desde``, con estacionalidad."""
+    return list(itertools.accumulate(
+        PESO_DIA_SEMANA[dia.weekday()] * PESO_MES[dia.month - 1]
+        for dia in (desde + timedelta(days=i) for i in range(dias))
+    ))
+
+
+def filas_csv(filas, semilla):
+    """Filas de un cierre diario: producto ``i`` con una cantidad sesgada por su popularidad."""
+    rng = random.Random(semilla)
+    for n in range(filas):
+        codigo, nombre, categoria, precio_compra, precio_venta = producto(semilla, n)
+        # Los productos más populares (n bajo) se reponen en mayor cantidad
+        cantidad = max(1, int(rng.paretovariate(1.5) * 200 / (1 + n) ** 0.5))
+        yield codigo, nombre, categoria, cantidad, precio_compra, precio_venta
+
+
+def escribir_csv(salida, filas, semilla):
+    escritor = csv.writer(salida, lineterminator="\n")
+    escritor.writerow(("codigo", "nombre", "categoria", "cantidad", "precio_compra", "precio_venta"))
+    for bloque in _bloques(filas_csv(filas, semilla)):
+        escritor.writerows(bloque)
+
+
+def _bloques(iterable, tamano=FILAS_POR_BLOQUE):
+    iterador = iter(iterable)
+    while True:
+        bloque = list(itertools.islice(iterador, tamano))
+        if not bloque:
+            return
+        yield bloque
+
+
+def _texto_copy(valor):
+    if valor is None:
+        return "\\N"
+    return str(valor).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+class LectorCopy:
+    """Objeto tipo archivo que genera bajo demanda el texto de ``COPY ... FROM STDIN``.
+
+    Arma un bloque de filas a la vez; ``read`` puede devolver menos de lo
+    pedido y una cadena vacía indica el final, como un archivo.
+    """
+
+    def __init__(self, filas):
+        self._bloques = _bloques(filas)
+        self._bloque = io.StringIO()
+
+    def read(self, tamano=-1):
+        while True:
+            datos = self._bloque.read(tamano)
+            if datos:
+                return datos
+            bloque = next(self._bloques, None)
+            if bloque is None:
+                return ""
+            self._bloque = io.StringIO("".join("\t".join(_texto_copy(valor) for valor in fila) + "\n" for fila in bloque))
+
+    readline = read
+
+
+def copiar(cur, tabla, columnas, filas):
+    inicio = time.perf_counter()
+    cur.copy_expert(f"COPY {tabla} ({', '.join(columnas)}) FROM STDIN", LectorCopy(filas))
+    print(f"📥 {tabla}: {cur.rowcount} filas en {time.perf_counter() - inicio:.1f}s")
+
+
+class Calendario:
+    """Elige instantes dentro del rango de días según la estacionalidad."""
+
+    def __init__(self, rng, desde, dias):
+        self.rng = rng
+        self.desde = datetime.combine(desde, datetime.min.time())
+        self.acumulados = pesos_dias(desde, dias)
+
+    def instante(self):
+        dia = bisect.bisect_left(self.acumulados, self.rng.random() * self.acumulados[-1])
+        # Horario de atención de 8 a 20
+        segundos = 8 * 3600 + int(self.rng.random() * 12 * 3600)
+        return self.desde + timedelta(days=dia, seconds=segundos)
+
+
+def cargar(conn, args):
+    rng = random.Random(args.semilla)
+    cur = conn.cursor()
+    cur.execute("SELECT id, rol FROM usuarios WHERE activo = true ORDER BY id")
+    usuarios = cur.fetchall()
+    if not usuarios:
+        raise RuntimeError("No hay usuarios: arranca la API una vez para crear el esquema y los usuarios por defecto")
+    usuario_ids = [usuario_id for usuario_id, _ in usuarios]
+    duenos = [usuario_id for usuario_id, rol in usuarios if rol in ("dueño", "administrador")] or usuario_ids
+
+    cur.execute("SELECT COUNT(*) FROM productos WHERE codigo LIKE %s", (PREFIJO_CODIGO + "%",))
+    if cur.fetchone()[0]:
+        raise RuntimeError(f"Ya hay productos {PREFIJO_CODIGO}*: usa una base vacía")
+
+    desde = date.today() - timedelta(days=args.dias)
+    calendario = Calendario(rng, desde, args.dias)
+
+    catalogo = [producto(args.semilla, n) for n in range(args.productos)]
+    copiar(cur, "productos", ("codigo", "nombre", "categoria", "precio_compra", "precio_venta", "costo_promedio", "stock_actual", "stock_minimo"), (
+        (codigo, nombre, categoria, compra, venta, compra, rng.randint(0, 500), rng.choice((0, 5, 10, 20)))
+        for codigo, nombre, categoria, compra, venta in catalogo
+    ))
+
+    cur.execute("SELECT codigo, id FROM productos WHERE codigo LIKE %s", (PREFIJO_CODIGO + "%",))
+    ids_por_codigo = dict(cur.fetchall())
+    ids = [ids_por_codigo[fila[0]] for fila in catalogo]
+    zipf = pesos_zipf(len(ids))
+    total_zipf = zipf[-1]
+
+    def elegir_producto():
+        return bisect.bisect_left(zipf, rng.random() * total_zipf)
+
+    copiar(cur, "cierres_diarios", ("fecha_cierre", "archivo_csv", "total_productos", "total_ingresados", "estado", "usuario_id", "fecha_procesado"), (
+        (dia, f"cierre_{dia.isoformat()}.csv", total, total, "procesado", rng.choice(usuario_ids), datetime.combine(dia, datetime.min.time()) + timedelta(hours=20))
+        for dia, total in (
+            (desde + timedelta(days=i), rng.randint(20, 200)) for i in range(args.dias)
+        )
+    ))
+
+    def movimientos():
+        for _ in range(args.movimientos):
+            n = elegir_producto()
+            _, _, _, compra, venta = catalogo[n]
+            if rng.random() < 0.75:
+                tipo, cantidad, motivo = "salida", 1 + int(rng.expovariate(0.5)), MOTIVO_GENERADO
+            else:
+                tipo, cantidad, motivo = "entrada", 5 + int(rng.expovariate(0.05)), f"Cierre diario - {MOTIVO_GENERADO}"
+            yield ids[n], tipo, cantidad, motivo, calendario.instante(), rng.choice(usuario_ids), venta, compra
+
+    copiar(cur, "movimientos_inventario", ("producto_id", "tipo_movimiento", "cantidad", "motivo", "fecha_movimiento", "usuario_id", "precio_unitario", "costo_unitario"), movimientos())
+
+    def mermas():
+        for _ in range(args.mermas):
+            n = elegir_producto()
+            solicitud = calendario.instante()
+            azar = rng.random()
+            if azar < 0.1:
+                estado, aprobador, aprobacion = "pendiente", None, None
+            else:
+                estado = "aprobada" if azar < 0.85 else "rechazada"
+                aprobador, aprobacion = rng.choice(duenos), solicitud + timedelta(hours=rng.randint(1, 48))
+            yield ids[n], rng.randint(1, 5), rng.choice(MOTIVOS_MERMA), MOTIVO_GENERADO, estado, rng.choice(usuario_ids), aprobador, solicitud, aprobacion
+
+    copiar(cur, "mermas_pendientes", ("producto_id", "cantidad", "motivo", "observaciones", "estado", "usuario_solicitud_id", "usuario_aprobacion_id", "fecha_solicitud", "fecha_aprobacion"), mermas())
+
+    # Sin registro_id: estas filas son historial, no procesos que se puedan revertir
+    acciones = (("LOGIN", "usuarios", 0.6), ("CIERRE_DIARIO", "cierres_diarios", 0.15), ("SOLICITUD_MERMA", "mermas_pendientes", 0.1),
+                ("APROBAR_MERMA", "mermas_pendientes", 0.08), ("RECHAZAR_MERMA", "mermas_pendientes", 0.02), ("AJUSTAR_STOCK", "productos", 0.05))
+    acumulados_acciones = list(itertools.accumulate(peso for _, _, peso in acciones))
+
+    def auditorias():
+        for _ in range(args.auditorias):
+            accion, tabla, _ = acciones[min(bisect.bisect_left(acumulados_acciones, rng.random() * acumulados_acciones[-1]), len(acciones) - 1)]
+            yield rng.choice(usuario_ids), accion, tabla, DETALLES_GENERADO, calendario.instante()
+
+    copiar(cur, "auditoria_sistema", ("usuario_id", "accion", "tabla_afectada", "detalles", "fecha"), auditorias())
+
+    # Estadísticas frescas para los planes; van antes del commit para que entren en él
+    cur.execute("ANALYZE")
+    conn.commit()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Generador de datos sintéticos reproducibles")
+    parser.add_argument("--semilla", type=int, default=1)
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    comando_csv = comandos.add_parser("csv", help="Escribe un cierre diario en CSV")
+    comando_csv.add_argument("--filas", type=int, default=1000)
+    comando_csv.add_argument("--salida", help="Archivo de salida (por defecto stdout)")
+
+    comando_cargar = comandos.add_parser("cargar", help="Carga un historial completo en PostgreSQL con COPY")
+    comando_cargar.add_argument("--productos", type=int, default=10000)
+    comando_cargar.add_argument("--movimientos", type=int, default=1000000)
+    comando_cargar.add_argument("--mermas", type=int, default=10000)
+    comando_cargar.add_argument("--auditorias", type=int, default=200000)
+    comando_cargar.add_argument("--dias", type=int, default=365, help="Días de historial hacia atrás desde hoy")
+    args = parser.parse_args()
+
+    if args.comando == "csv":
+        if args.salida:
+            with open(args.salida, "w", encoding="utf-8", newline="") as salida:
+                escribir_csv(salida, args.filas, args.semilla)
+        else:
+            escribir_csv(sys.stdout, args.filas, args.semilla)
+        return 0
+
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        print("❌ ERROR: DATABASE_URL no configurada")
+        return 2
+
+    conn = psycopg2.connect(database_url)
+    inicio = time.perf_counter()
+    try:
+        cargar(conn, args)
+    except RuntimeError as e:
+        conn.rollback()
+        print(f"❌ {e}")
+        return 1
+    finally:
+        conn.close()
+    print(f"✅ Carga completa en {time.perf_counter() - inicio:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
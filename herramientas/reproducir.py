@@ -0,0 +1,212 @@
+"""Reproducción de tráfico grabado con ``observabilidad.grabacion``.
+
+``reproducir`` lee uno o más archivos de grabación (``.jsonl`` o rotados
+``.jsonl.N.gz``), los ordena por instante y vuelve a enviar cada petición a
+una instancia local respetando los tiempos originales, divididos por
+``--velocidad`` (``2`` = el doble de rápido, ``0`` = sin pausas). Las
+contraseñas redactadas del login de los usuarios por defecto se completan con
+``herramientas.carga.CREDENCIALES``; las peticiones cuyo cuerpo no se grabó
+(demasiado grande, multipart con archivos u otro tipo del que solo se guarda
+la longitud) se omiten. El resumen por plantilla de ruta incluye la
+latencia grabada en producción y la de la reproducción, además del retraso de
+envío (si crece, el reproductor no alcanza el ritmo pedido).
+
+``comparar`` contrasta dos resúmenes (p. ej. de dos builds) y termina con
+código 1 si algún endpoint empeoró su p50, p95 o p99 más que ``--tolerancia``.
+
+Uso (desde la raíz del repositorio):
+
+    python -m herramientas.reproducir reproducir trafico.jsonl* --url http://localhost:8000 --velocidad 4 --salida build_a.json
+    python -m herramientas.reproducir comparar build_a.json build_b.json
+"""
+import argparse
+import base64
+import gzip
+import json
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from herramientas.carga import CREDENCIALES, Cliente, Recolector, percentil
+from observabilidad.grabacion import REDACTADO
+
+CONTRASENAS = dict(CREDENCIALES.values())
+
+
+def leer_grabaciones(archivos):
+    registros = []
+    for archivo in archivos:
+        abrir = gzip.open if archivo.endswith(".gz") else open
+        with abrir(archivo, "rt", encoding="utf-8") as entrada:
+            for linea in entrada:
+                if linea.strip():
+                    registros.append(json.loads(linea))
+    registros.sort(key=lambda registro: registro["instante"])
+    return registros
+
+
+def armar_peticion(registro):
+    """Devuelve (ruta con query, cuerpo, cabeceras) o None si no se puede reproducir."""
+    if "cuerpo_truncado" in registro:
+        return None
+
+    cuerpo = None
+    if "json" in registro:
+        datos = registro["json"]
+        if isinstance(datos, dict) and datos.get("password") == REDACTADO:
+            contrasena = CONTRASENAS.get(datos.get("username"))
+            if contrasena is None and registro["ruta"] == "/auth/login":
+                return None
+            datos = dict(datos, password=contrasena or "reproduccion")
+        cuerpo = json.dumps(datos).encode("utf-8")
+    elif "formulario" in registro:
+        cuerpo = registro["formulario"].encode("latin-1")
+    elif "multipart" in registro:
+        # Los archivos no se graban: solo se reproducen formularios sin archivos
+        if any("archivo" in campo for campo in registro["multipart"]):
+            return None
+        limite = uuid.uuid4().hex
+        cuerpo = "".join(
+            f'--{limite}\r\nContent-Disposition: form-data; name="{campo["nombre"]}"\r\n\r\n{campo["valor"]}\r\n'
+            for campo in registro["multipart"]
+        ).encode("utf-8") + f"--{limite}--\r\n".encode("utf-8")
+        return _ruta(registro), cuerpo, {"Content-Type": f"multipart/form-data; boundary={limite}"}
+    elif "base64" in registro:
+        # Grabaciones anteriores a que se dejaran de guardar los cuerpos crudos
+        cuerpo = base64.b64decode(registro["base64"])
+    elif "cuerpo_bytes" in registro:
+        return None
+
+    cabeceras = {"Content-Type": registro["content_type"]} if registro.get("content_type") else {}
+    return _ruta(registro), cuerpo, cabeceras
+
+
+def _ruta(registro):
+    return registro["ruta"] + (f"?{registro['query']}" if registro.get("query") else "")
+
+
+def reproducir(args):
+    registros = leer_grabaciones(args.archivos)
+    if args.solo_lecturas:
+        registros = [registro for registro in registros if registro["metodo"] == "GET"]
+    if not registros:
+        print("❌ No hay peticiones para reproducir")
+        return 1
+
+    original = Recolector()
+    reproduccion = Recolector()
+    cliente = Cliente(args.url, reproduccion, args.timeout)
+    retrasos = []
+    omitidas = 0
+
+    def enviar(nombre, metodo, ruta, cuerpo, cabeceras):
+        try:
+            cliente.pedir(nombre, metodo, ruta, cuerpo=cuerpo, cabeceras=cabeceras)
+        except Exception:
+            # El error ya quedó registrado por el cliente; las respuestas que no son
+            # JSON (p. ej. CSV) tampoco importan aquí
+            pass
+
+    inicio_grabacion = registros[0]["instante"]
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as ejecutor:
+        inicio = time.perf_counter()
+        for registro in registros:
+            peticion = armar_peticion(registro)
+            if peticion is None:
+                omitidas += 1
+                continue
+
+            if args.velocidad > 0:
+                objetivo = inicio + (registro["instante"] - inicio_grabacion) / args.velocidad
+                espera = objetivo - time.perf_counter()
+                if espera > 0:
+                    time.sleep(espera)
+                retrasos.append(max(0.0, time.perf_counter() - objetivo) * 1000)
+
+            nombre = f"{registro['metodo']} {registro['plantilla']}"
+            original.registrar(nombre, registro["duracion_ms"] / 1000, (registro.get("estado") or 500) >= 400)
+            ejecutor.submit(enviar, nombre, registro["metodo"], *peticion)
+    duracion = time.perf_counter() - inicio
+
+    duracion_original = max(registros[-1]["instante"] - inicio_grabacion, 0.001)
+    retrasos.sort()
+    resumen = {
+        "peticiones": len(registros) - omitidas,
+        "omitidas": omitidas,
+        "velocidad": args.velocidad,
+        "retraso_envio_p95_ms": round(percentil(retrasos, 95), 1),
+        "original": original.resumen(duracion_original),
+        "reproduccion": reproduccion.resumen(duracion),
+    }
+
+    print(f"📊 {resumen['peticiones']} peticiones reproducidas en {duracion:.1f}s ({omitidas} omitidas), retraso de envío p95 {resumen['retraso_envio_p95_ms']} ms")
+    print(f"   {'endpoint':<44} {'p50 orig':>9} {'p50 rep':>9} {'p95 orig':>9} {'p95 rep':>9} {'error rep':>9}")
+    for nombre, datos in resumen["reproduccion"]["endpoints"].items():
+        base = resumen["original"]["endpoints"].get(nombre, {})
+        print(f"   {nombre:<44} {base.get('p50_ms', '-'):>9} {datos['p50_ms']:>9} {base.get('p95_ms', '-'):>9} {datos['p95_ms']:>9} {datos['tasa_error'] * 100:>8.2f}%")
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as archivo:
+            json.dump(resumen, archivo, ensure_ascii=False, indent=2)
+        print(f"💾 Resumen guardado en {args.salida}")
+    return 0
+
+
+def comparar(args):
+    with open(args.base, encoding="utf-8") as archivo:
+        base = json.load(archivo)["reproduccion"]["endpoints"]
+    with open(args.nuevo, encoding="utf-8") as archivo:
+        nuevo = json.load(archivo)["reproduccion"]["endpoints"]
+
+    regresiones = 0
+    print(f"   {'endpoint':<44} {'p50':>16} {'p95':>16} {'p99':>16}")
+    for nombre in sorted(set(base) & set(nuevo)):
+        columnas = []
+        empeoro = False
+        for metrica in ("p50_ms", "p95_ms", "p99_ms"):
+            antes, despues = base[nombre][metrica], nuevo[nombre][metrica]
+            cambio = (despues / antes - 1) if antes > 0 else 0.0
+            if cambio > args.tolerancia:
+                regresiones += 1
+                empeoro = True
+            columnas.append(f"{despues} ({cambio * 100:+.0f}%)")
+        marca = "❌" if empeoro else "  "
+        print(f"{marca} {nombre:<44} {' '.join(f'{columna:>16}' for columna in columnas)}")
+
+    for nombre in sorted(set(base) ^ set(nuevo)):
+        print(f"⚠️ {nombre} solo aparece en {'la base' if nombre in base else 'la nueva corrida'}")
+
+    if regresiones:
+        print(f"❌ {regresiones} percentiles empeoraron más de {args.tolerancia * 100:.0f}%")
+        return 1
+    print("✅ Sin regresiones")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproducción de tráfico grabado")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    comando_reproducir = comandos.add_parser("reproducir", help="Envía el tráfico grabado a una instancia")
+    comando_reproducir.add_argument("archivos", nargs="+")
+    comando_reproducir.add_argument("--url", default="http://localhost:8000")
+    comando_reproducir.add_argument("--velocidad", type=float, default=1.0, help="Multiplicador del ritmo original; 0 = sin pausas")
+    comando_reproducir.add_argument("--concurrencia", type=int, default=50)
+    comando_reproducir.add_argument("--solo-lecturas", action="store_true", help="Reproduce solo las peticiones GET")
+    comando_reproducir.add_argument("--timeout", type=float, default=30)
+    comando_reproducir.add_argument("--salida", help="Archivo JSON con el resumen")
+
+    comando_comparar = comandos.add_parser("comparar", help="Compara dos resúmenes de reproducción")
+    comando_comparar.add_argument("base")
+    comando_comparar.add_argument("nuevo")
+    comando_comparar.add_argument("--tolerancia", type=float, default=0.2, help="Empeoramiento permitido (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    if args.comando == "reproducir":
+        return reproducir(args)
+    return comparar(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""Archivo columnar (Parquet) de movimientos de inventario antiguos.
+
+``archivar`` mueve los movimientos anteriores a
+``ARCHIVO_MOVIMIENTOS_HORIZONTE_DIAS`` a archivos Parquet particionados por mes
+(``<ARCHIVO_MOVIMIENTOS_DIR>/mes=2024-01/movimientos-<lote>.parquet``) y los
+borra de ``movimientos_inventario``, que así queda chica. Cada mes se archiva
+en una transacción REPEATABLE READ: la lectura y el DELETE ven la misma foto,
+y el archivo se registra en ``archivos_movimientos`` en esa misma transacción.
+Solo los archivos registrados se consultan, así que una corrida que falla a
+mitad de camino no duplica ni pierde movimientos.
+
+Las consultas de ``/reportes/*`` suman archivo y tabla viva: ``ventas_por_dia``
+y ``vendidos_por_producto`` leen solo los meses del rango pedido (poda por
+partición desde el registro, y por estadísticas de row group con el filtro de
+fecha) y agregan con ``pyarrow.compute`` sin pasar fila por fila por Python.
+Como los archivos no cambian, los agregados se guardan en memoria por
+combinación de archivos y rango.
+"""
+import os
+import threading
+import uuid
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DIRECTORIO = os.getenv("ARCHIVO_MOVIMIENTOS_DIR", "archivo_movimientos")
+HORIZONTE_DIAS = int(os.getenv("ARCHIVO_MOVIMIENTOS_HORIZONTE_DIAS", "365"))
+FILAS_GRUPO = 100000
+MAX_CACHE = 64
+
+COLUMNAS = (
+    "id", "producto_id", "tipo_movimiento", "cantidad", "motivo", "fecha_movimiento",
+    "usuario_id", "archivo_origen", "precio_unitario", "costo_unitario",
+)
+
+
+class ArchivoNoDisponible(RuntimeError):
+    pass
+
+
+def _esquema():
+    return pyarrow.schema([
+        ("id", pyarrow.int32()),
+        ("producto_id", pyarrow.int32()),
+        ("tipo_movimiento", pyarrow.string()),
+        ("cantidad", pyarrow.int32()),
+        ("motivo", pyarrow.string()),
+        ("fecha_movimiento", pyarrow.timestamp("us")),
+        ("usuario_id", pyarrow.int32()),
+        ("archivo_origen", pyarrow.string()),
+        ("precio_unitario", pyarrow.decimal128(10, 2)),
+        ("costo_unitario", pyarrow.decimal128(10, 2)),
+    ])
+
+
+def crear_tabla_registro(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS archivos_movimientos (
+            id SERIAL PRIMARY KEY,
+            mes DATE NOT NULL,
+            ruta TEXT NOT NULL,
+            filas INTEGER NOT NULL,
+            desde TIMESTAMP NOT NULL,
+            hasta TIMESTAMP NOT NULL,
+            fecha_archivado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def corte(conn):
+    """Instante hasta el cual (exclusive) los movimientos están solo en el archivo, o None."""
+    cur = conn.cursor()
+    cur.execute("SELECT MAX(hasta) FROM archivos_movimientos")
+    return cur.fetchone()[0]
+
+
+# ==================== ARCHIVADO ====================
+
+def _siguiente_mes(mes):
+    return date(mes.year + mes.month // 12, mes.month % 12 + 1, 1)
+
+
+def _archivar_mes(conn, mes, limite, directorio, filas_grupo):
+    desde = datetime.combine(mes, datetime.min.time())
+    hasta = min(datetime.combine(_siguiente_mes(mes), datetime.min.time()), limite)
+    particion = f"mes={mes:%Y-%m}"
+    ruta = f"{particion}/movimientos-{uuid.uuid4().hex[:12]}.parquet"
+    destino = os.path.join(directorio, ruta)
+    temporal = destino + ".tmp"
+    os.makedirs(os.path.join(directorio, particion), exist_ok=True)
+
+    cur = conn.cursor()
+    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    lector = conn.cursor(name="archivar_movimientos")
+    lector.itersize = filas_grupo
+    lector.execute(f"""
+        SELECT {", ".join(COLUMNAS)} FROM movimientos_inventario
+        WHERE fecha_movimiento >= %s AND fecha_movimiento < %s
+        ORDER BY fecha_movimiento, id
+    """, (desde, hasta))
+
+    esquema = _esquema()
+    filas = 0
+    try:
+        with pyarrow.parquet.ParquetWriter(temporal, esquema, compression="zstd") as escritor:
+            while True:
+                lote = lector.fetchmany(filas_grupo)
+                if not lote:
+                    break
+                columnas = [list(columna) for columna in zip(*lote)]
+                escritor.write_table(pyarrow.Table.from_arrays(columnas, schema=esquema), row_group_size=filas_grupo)
+                filas += len(lote)
+        lector.close()
+
+        if filas == 0:
+            os.remove(temporal)
+            conn.rollback()
+            return 0
+
+        # Misma foto que la lectura: un movimiento insertado mientras tanto no se borra
+        cur.execute("DELETE FROM movimientos_inventario WHERE fecha_movimiento >= %s AND fecha_movimiento < %s", (desde, hasta))
+        if cur.rowcount != filas:
+            raise RuntimeError(f"Se archivaron {filas} movimientos de {mes:%Y-%m} pero se borrarían {cur.rowcount}")
+        cur.execute("""
+            INSERT INTO archivos_movimientos (mes, ruta, filas, desde, hasta)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (mes, ruta, filas, desde, hasta))
+        os.replace(temporal, destino)
+        try:
+            conn.commit()
+        except Exception:
+            os.remove(destino)
+            raise
+        return filas
+    except Exception:
+        conn.rollback()
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+
+def archivar(conn, horizonte_dias=HORIZONTE_DIAS, directorio=DIRECTORIO, filas_grupo=FILAS_GRUPO):
+    """Archiva los movimientos anteriores a hoy - ``horizonte_dias``; devuelve [(mes, filas)]."""
+    if pyarrow is None:
+        raise ArchivoNoDisponible("pyarrow no está instalado")
+
+    limite = datetime.combine(date.today() - timedelta(days=horizonte_dias), datetime.min.time())
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT DISTINCT date_trunc('month', fecha_movimiento)::date
+        FROM movimientos_inventario
+        WHERE fecha_movimiento < %s
+        ORDER BY 1
+    """, (limite,))
+    meses = [fila[0] for fila in cur.fetchall()]
+    conn.commit()
+
+    resultado = []
+    for mes in meses:
+        filas = _archivar_mes(conn, mes, limite, directorio, filas_grupo)
+        if filas:
+            resultado.append((mes, filas))
+    return resultado
+
+
+# ==================== CONSULTAS ====================
+
+_cache = {}
+_candado_cache = threading.Lock()
+
+
+def _archivos(conn, desde, hasta):
+    """(ids, rutas) de los archivos cuyos meses se cruzan con [desde, hasta)."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, ruta FROM archivos_movimientos
+        WHERE (%(desde)s::timestamp IS NULL OR hasta > %(desde)s)
+            AND (%(hasta)s::timestamp IS NULL OR desde < %(hasta)s)
+        ORDER BY id
+    """, {"desde": desde, "hasta": hasta})
+    filas = cur.fetchall()
+    return tuple(fila[0] for fila in filas), [fila[1] for fila in filas]
+
+
+def _leer_salidas(rutas, desde, hasta, columnas):
+    if pyarrow is None:
+        raise ArchivoNoDisponible("Hay movimientos archivados pero pyarrow no está instalado")
+    campo_fecha = pyarrow.dataset.field("fecha_movimiento")
+    filtro = pyarrow.dataset.field("tipo_movimiento") == "salida"
+    if desde is not None:
+        filtro = filtro & (campo_fecha >= pyarrow.scalar(desde, type=pyarrow.timestamp("us")))
+    if hasta is not None:
+        filtro = filtro & (campo_fecha < pyarrow.scalar(hasta, type=pyarrow.timestamp("us")))
+    conjunto = pyarrow.dataset.dataset([os.path.join(DIRECTORIO, ruta) for ruta in rutas], schema=_esquema(), format="parquet")
+    return conjunto.to_table(columns=columnas, filter=filtro)
+
+
+def _importes(tabla):
+    pc = pyarrow.compute
+    cantidad = pc.cast(tabla["cantidad"], pyarrow.float64())
+    precio = pc.cast(tabla["precio_unitario"], pyarrow.float64())
+    costo = pc.cast(tabla["costo_unitario"], pyarrow.float64())
+    return pc.multiply(cantidad, precio), pc.multiply(cantidad, pc.subtract(precio, costo))
+
+
+def _con_cache(clave, calcular):
+    with _candado_cache:
+        if clave in _cache:
+            return _cache[clave]
+    valor = calcular()
+    with _candado_cache:
+        if len(_cache) >= MAX_CACHE:
+            _cache.pop(next(iter(_cache)))
+        _cache[clave] = valor
+    return valor
+
+
+def _decimal(valor):
+    return None if valor is None else Decimal(f"{valor:.2f}")
+
+
+def ventas_por_dia(conn, desde=None, hasta=None):
+    """{fecha: importe vendido} de los movimientos archivados en [desde, hasta)."""
+    ids, rutas = _archivos(conn, desde, hasta)
+    if not ids:
+        return {}
+
+    def calcular():
+        tabla = _leer_salidas(rutas, desde, hasta, ["fecha_movimiento", "cantidad", "precio_unitario", "costo_unitario"])
+        ingresos, _ = _importes(tabla)
+        por_dia = pyarrow.table({
+            "fecha": pyarrow.compute.cast(tabla["fecha_movimiento"], pyarrow.date32()),
+            "ingresos": ingresos,
+        }).group_by("fecha").aggregate([("ingresos", "sum")])
+        return dict(zip(por_dia["fecha"].to_pylist(), (_decimal(valor) for valor in por_dia["ingresos_sum"].to_pylist())))
+
+    return _con_cache(("ventas_por_dia", ids, desde, hasta), calcular)
+
+
+def vendidos_por_producto(conn, desde=None, hasta=None):
+    """Columnas ``producto_id``, ``vendidos``, ``ingresos`` y ``margen`` de las salidas archivadas.
+
+    Salen como listas paralelas para pasarlas a PostgreSQL con ``unnest`` y
+    sumarlas a la tabla viva en la misma consulta.
+    """
+    vacio = {"producto_id": [], "vendidos": [], "ingresos": [], "margen": []}
+    ids, rutas = _archivos(conn, desde, hasta)
+    if not ids:
+        return vacio
+
+    def calcular():
+        tabla = _leer_salidas(rutas, desde, hasta, ["producto_id", "cantidad", "precio_unitario", "costo_unitario"])
+        ingresos, margen = _importes(tabla)
+        por_producto = pyarrow.table({
+            "producto_id": tabla["producto_id"],
+            "cantidad": pyarrow.compute.cast(tabla["cantidad"], pyarrow.int64()),
+            "ingresos": ingresos,
+            "margen": margen,
+        }).group_by("producto_id").aggregate([("cantidad", "sum"), ("ingresos", "sum"), ("margen", "sum")])
+        return {
+            "producto_id": por_producto["producto_id"].to_pylist(),
+            "vendidos": por_producto["cantidad_sum"].to_pylist(),
+            "ingresos": [_decimal(valor) for valor in por_producto["ingresos_sum"].to_pylist()],
+            "margen": [_decimal(valor) for valor in por_producto["margen_sum"].to_pylist()],
+        }
+
+    return _con_cache(("vendidos_por_producto", ids, desde, hasta), calcular)
@@ -0,0 +1,161 @@
+"""Índice en memoria código -> producto para las consultas del mostrador.
+
+``/productos/codigo/{codigo}`` y ``POST /productos/lookup`` se responden desde
+un diccionario en memoria, sin ir a PostgreSQL. El índice se carga completo
+una vez y después se mantiene producto a producto: un trigger sobre
+``productos`` hace ``pg_notify`` con el id de cada fila insertada, modificada o
+borrada (cierres, mermas, reversiones, bajas), y un hilo por proceso escucha
+el canal y vuelve a leer solo esos ids. Como el aviso sale del trigger, llega a
+todos los workers y ninguna ruta puede olvidarse de invalidar.
+
+Las notificaciones se entregan al hacer commit, así que el índice puede ir
+unos milisegundos detrás de la base. Mientras el hilo no está escuchando (al
+arrancar o tras perder la conexión) el índice no se usa y las consultas van a
+PostgreSQL; al reconectar se recarga completo porque pudo perder avisos.
+"""
+import logging
+import os
+import select
+import threading
+
+logger = logging.getLogger("el_unificador.indice_codigos")
+
+ACTIVO = os.getenv("INDICE_CODIGOS", "1") == "1"
+CANAL = "productos_cambios"
+ESPERA_SEGUNDOS = 5
+MAX_CODIGOS = 1000
+
+COLUMNAS = ("id", "codigo", "nombre", "categoria", "precio_compra", "precio_venta", "stock_actual", "stock_minimo")
+
+
+def crear_trigger(cur):
+    cur.execute(f'''
+        CREATE OR REPLACE FUNCTION notificar_cambio_producto() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('{CANAL}', OLD.id::text);
+            ELSE
+                PERFORM pg_notify('{CANAL}', NEW.id::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cur.execute("DROP TRIGGER IF EXISTS trg_productos_cambios ON productos")
+    cur.execute('''
+        CREATE TRIGGER trg_productos_cambios
+        AFTER INSERT OR UPDATE OR DELETE ON productos
+        FOR EACH ROW EXECUTE FUNCTION notificar_cambio_producto()
+    ''')
+
+
+def consultar(cur, codigos=None, ids=None):
+    """Productos activos con esos códigos o ids, como diccionarios."""
+    columna, valores = ("codigo", codigos) if codigos is not None else ("id", ids)
+    cur.execute(
+        f"SELECT {', '.join(COLUMNAS)} FROM productos WHERE activo = true AND {columna} = ANY(%s)",
+        (list(valores),)
+    )
+    return [dict(zip(COLUMNAS, fila)) for fila in cur.fetchall()]
+
+
+class IndiceCodigos:
+    def __init__(self):
+        self._por_codigo = {}
+        self._codigo_por_id = {}
+        self._candado = threading.Lock()
+        self.listo = False
+
+    def cargar(self, cur):
+        cur.execute(f"SELECT {', '.join(COLUMNAS)} FROM productos WHERE activo = true")
+        productos = [dict(zip(COLUMNAS, fila)) for fila in cur.fetchall()]
+        with self._candado:
+            self._por_codigo = {producto["codigo"]: producto for producto in productos}
+            self._codigo_por_id = {producto["id"]: producto["codigo"] for producto in productos}
+            self.listo = True
+        return len(productos)
+
+    def actualizar(self, cur, ids):
+        """Vuelve a leer ``ids``: los que ya no existen o están inactivos salen del índice."""
+        productos = consultar(cur, ids=ids)
+        with self._candado:
+            for producto_id in ids:
+                codigo = self._codigo_por_id.pop(producto_id, None)
+                if codigo is not None:
+                    self._por_codigo.pop(codigo, None)
+            for producto in productos:
+                self._por_codigo[producto["codigo"]] = producto
+                self._codigo_por_id[producto["id"]] = producto["codigo"]
+
+    def invalidar(self):
+        with self._candado:
+            self.listo = False
+            self._por_codigo = {}
+            self._codigo_por_id = {}
+
+    def buscar(self, codigos):
+        """{codigo: producto} de los encontrados, o None si el índice no está listo."""
+        with self._candado:
+            if not self.listo:
+                return None
+            return {codigo: self._por_codigo[codigo] for codigo in codigos if codigo in self._por_codigo}
+
+
+indice = IndiceCodigos()
+
+
+def buscar(obtener_conexion, codigos):
+    """{codigo: producto} desde el índice, o desde PostgreSQL si el índice no está listo."""
+    encontrados = indice.buscar(codigos)
+    if encontrados is not None:
+        return encontrados
+
+    conn = obtener_conexion()
+    if not conn:
+        raise RuntimeError("Error de conexión a PostgreSQL")
+    try:
+        return {producto["codigo"]: producto for producto in consultar(conn.cursor(), codigos=codigos)}
+    finally:
+        conn.close()
+
+
+def _escuchar(conn, detener):
+    conn.autocommit = True
+    cur = conn.cursor()
+    # LISTEN antes de cargar: un cambio confirmado durante la carga llega como aviso
+    cur.execute(f"LISTEN {CANAL}")
+    productos = indice.cargar(cur)
+    logger.info("Índice de códigos cargado", extra={"campos": {"productos": productos}})
+
+    while not detener.is_set():
+        if not select.select([conn], [], [], ESPERA_SEGUNDOS)[0]:
+            continue
+        conn.poll()
+        ids = {int(aviso.payload) for aviso in conn.notifies}
+        conn.notifies.clear()
+        if ids:
+            indice.actualizar(cur, ids)
+
+
+def iniciar_escucha(obtener_conexion):
+    """Hilo de fondo que carga el índice y lo mantiene con los avisos de ``productos``."""
+    if not ACTIVO:
+        return None
+    detener = threading.Event()
+
+    def ciclo():
+        while True:
+            conn = obtener_conexion()
+            if conn:
+                try:
+                    _escuchar(conn, detener)
+                except Exception:
+                    logger.exception("Error en la escucha del índice de códigos")
+                finally:
+                    indice.invalidar()
+                    conn.close()
+            if detener.wait(ESPERA_SEGUNDOS):
+                return
+
+    threading.Thread(target=ciclo, name="indice-codigos", daemon=True).start()
+    return detener
@@ -1,18 +1,55 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import Json, RealDictCursor, execute_values
 import csv
 import io
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from typing import List
+import logging
 import os
 from dotenv import load_dotenv
 
+# Antes de importar los módulos que leen su configuración del entorno
 load_dotenv()
 
+from motor_stock import (
+    ProductoNoEncontrado,
+    StockInsuficiente,
+    descontar_stock,
+    ejecutar_transaccion,
+    ingresar_cierre,
+    reponer_stock,
+    retirar_stock_lote,
+    tomar_snapshot_stock,
+)
+import busqueda
+from compresion import MiddlewareCompresion
+from exportaciones import (
+    FORMATOS as FORMATOS_EXPORTACION,
+    PARQUET_DISPONIBLE,
+    TABLAS as TABLAS_EXPORTACION,
+    exportar_csv,
+    exportar_parquet,
+)
+import historico
+import indice_codigos
+from observabilidad import consultas_lentas
+from observabilidad.bd import conectar
+from observabilidad.grabacion import ARCHIVO as ARCHIVO_GRABACION, MiddlewareGrabacion
+from observabilidad.metricas import MiddlewareMetricas, registro as registro_metricas
+from observabilidad.perfilado import MODOS_CPU, MiddlewarePerfilado, RutaPerfilada, control as control_perfilado
+from observabilidad.registro import configurar_registro, crear_tabla_nivel, guardar_nivel, iniciar_escucha_nivel, nivel_actual
+from observabilidad.trazas import span
+import particiones_auditoria
+from respuestas import formato_streaming, responder_filas, transmitir_filas
+
+logger = configurar_registro()
+
 app = FastAPI(title="El Unificador")
+# Antes de declarar las rutas: el perfilado envuelve cada endpoint en el hilo donde corre
+app.router.route_class = RutaPerfilada
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,6 +64,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# La compresión queda dentro de métricas para que la latencia medida la incluya
+app.add_middleware(MiddlewareCompresion)
+
+# Perfilado y grabación dentro de métricas: necesitan la plantilla de ruta que esta resuelve
+app.add_middleware(MiddlewarePerfilado)
+if ARCHIVO_GRABACION:
+    app.add_middleware(MiddlewareGrabacion)
+app.add_middleware(MiddlewareMetricas)
+
 class User(BaseModel):
     id: int
     nombre: str
@@ -72,6 +118,9 @@ class MermaRequest(BaseModel):
     observaciones: str = ""
     usuario_id: int
 
+class CodigosRequest(BaseModel):
+    codigos: List[str]
+
 class ConfiguracionBase(BaseModel):
     clave: str
     valor: str
@@ -82,21 +131,20 @@ def get_db():
         database_url = os.getenv("DATABASE_URL")
         
         if not database_url:
-            print("❌ ERROR: DATABASE_URL no configurada en Render")
-            print("📋 Ve a tu Web Service -> Environment -> Add DATABASE_URL")
+            logger.error("DATABASE_URL no configurada: agregarla en Web Service -> Environment")
             return None
             
-        print(f"🔗 Conectando a PostgreSQL...")
+        logger.debug("Conectando a PostgreSQL", extra={"muestreo": "conexion_bd"})
         # Conecta usando la URL de Render
-        return psycopg2.connect(database_url)
+        return conectar(database_url)
     except Exception as e:
-        print(f"❌ Error PostgreSQL: {e}")
+        logger.error("Error conectando a PostgreSQL: %s", e)
         return None
 
 def init_db():
     conn = get_db()
     if not conn:
-        print("⚠️  No se pudo conectar a PostgreSQL")
+        logger.warning("No se pudo conectar a PostgreSQL")
         return
     
     try:
@@ -130,6 +178,61 @@ def init_db():
             )
         ''')
         
+        # Migración: costo promedio ponderado, mantenido por motor_stock en cada entrada
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'productos' AND column_name = 'costo_promedio'
+            )
+        """)
+        if not cur.fetchone()[0]:
+            cur.execute("ALTER TABLE productos ADD COLUMN costo_promedio DECIMAL(12,4)")
+            cur.execute("UPDATE productos SET costo_promedio = precio_compra")
+            logger.info("Migración de costo promedio aplicada")
+        
+        # Versión de fila para /inventario/cambios: el id de la última transacción que
+        # escribió la fila (xid8, crece siempre). El cursor que se entrega es el xmin del
+        # snapshot de la lectura, así que una transacción que aún no confirmó al leer
+        # queda por encima del cursor y aparece en la consulta siguiente
+        cur.execute("ALTER TABLE productos ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_productos_version ON productos (version)")
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS productos_eliminados (
+                producto_id INTEGER PRIMARY KEY,
+                codigo VARCHAR(50) NOT NULL,
+                version BIGINT NOT NULL,
+                fecha_eliminacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_productos_eliminados_version ON productos_eliminados (version)")
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION versionar_producto() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    INSERT INTO productos_eliminados (producto_id, codigo, version)
+                    VALUES (OLD.id, OLD.codigo, pg_current_xact_id()::text::bigint)
+                    ON CONFLICT (producto_id) DO UPDATE
+                    SET codigo = EXCLUDED.codigo, version = EXCLUDED.version, fecha_eliminacion = CURRENT_TIMESTAMP;
+                    RETURN OLD;
+                END IF;
+                NEW.version := pg_current_xact_id()::text::bigint;
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        cur.execute("DROP TRIGGER IF EXISTS trg_productos_version ON productos")
+        cur.execute('''
+            CREATE TRIGGER trg_productos_version
+            BEFORE INSERT OR UPDATE OR DELETE ON productos
+            FOR EACH ROW EXECUTE FUNCTION versionar_producto()
+        ''')
+        
+        # Índices de /productos/buscar (trigramas si pg_trgm está disponible)
+        busqueda.crear_indices(cur)
+        
+        # Avisos de cambios en productos para el índice en memoria de códigos
+        indice_codigos.crear_trigger(cur)
+        
         # Tabla movimientos_inventario
         cur.execute('''
             CREATE TABLE IF NOT EXISTS movimientos_inventario (
@@ -144,6 +247,42 @@ def init_db():
             )
         ''')
         
+        # Migración: precio y costo unitario vigentes al escribir cada movimiento,
+        # para que los reportes no dependan del precio actual del producto
+        cur.execute("""
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'movimientos_inventario' AND column_name IN ('precio_unitario', 'costo_unitario')
+        """)
+        if cur.fetchone()[0] < 2:
+            cur.execute("ALTER TABLE movimientos_inventario ADD COLUMN IF NOT EXISTS precio_unitario DECIMAL(10,2)")
+            cur.execute("ALTER TABLE movimientos_inventario ADD COLUMN IF NOT EXISTS costo_unitario DECIMAL(10,2)")
+            # Backfill con los precios actuales: es la mejor aproximación disponible
+            # para los movimientos anteriores a la migración
+            cur.execute("""
+                UPDATE movimientos_inventario mi
+                SET precio_unitario = p.precio_venta, costo_unitario = p.precio_compra
+                FROM productos p
+                WHERE mi.producto_id = p.id AND mi.precio_unitario IS NULL
+            """)
+            logger.info("Migración de precios en movimientos aplicada")
+        
+        # Migración: stock del producto después de cada movimiento. Las reversiones y
+        # las bajas cambian el stock sin dejar movimiento, así que el saldo del kardex
+        # no se puede reconstruir sumando cantidades; los movimientos anteriores a la
+        # migración quedan en NULL y el kardex los acumula como antes
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'movimientos_inventario' AND column_name = 'stock_resultante'
+            )
+        """)
+        if not cur.fetchone()[0]:
+            cur.execute("ALTER TABLE movimientos_inventario ADD COLUMN stock_resultante INTEGER")
+            logger.info("Migración de stock resultante en movimientos aplicada")
+        
+        # Registro de los movimientos antiguos movidos a Parquet (historico.archivar)
+        historico.crear_tabla_registro(cur)
+        
         # Tabla cierres_diarios
         cur.execute('''
             CREATE TABLE IF NOT EXISTS cierres_diarios (
@@ -158,19 +297,8 @@ def init_db():
             )
         ''')
         
-        # Tabla auditoria_sistema
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS auditoria_sistema (
-                id SERIAL PRIMARY KEY,
-                usuario_id INTEGER REFERENCES usuarios(id),
-                accion VARCHAR(100) NOT NULL,
-                tabla_afectada VARCHAR(50),
-                registro_id INTEGER,
-                detalles TEXT,
-                fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                revertido BOOLEAN DEFAULT false
-            )
-        ''')
+        # Tabla auditoria_sistema, particionada por mes (migra la tabla sin particionar)
+        particiones_auditoria.crear_tabla(cur)
         
         # Tabla mermas_pendientes
         cur.execute('''
@@ -200,6 +328,94 @@ def init_db():
             )
         ''')
         
+        # Nivel de registro guardado, fuera de configuraciones_sistema: solo lo
+        # cambia /admin/registro/nivel
+        crear_tabla_nivel(cur)
+        
+        # Historial de stock (libro de solo inserción): una fila por cada cambio de
+        # productos.stock_actual, escrita por trigger para que ninguna ruta la omita
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS historial_stock (
+                id BIGSERIAL PRIMARY KEY,
+                producto_id INTEGER NOT NULL,
+                delta INTEGER NOT NULL,
+                stock_resultante INTEGER NOT NULL,
+                fecha TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+            )
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_historial_stock_fecha ON historial_stock (fecha)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_historial_stock_producto_fecha ON historial_stock (producto_id, fecha)")
+        
+        # Índice del kardex: recorre el historial de un producto por rango de fechas
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_movimientos_producto_fecha ON movimientos_inventario (producto_id, fecha_movimiento, id)")
+        
+        # Snapshots del stock de todos los productos, tomados en cada cierre diario
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS snapshots_stock (
+                id SERIAL PRIMARY KEY,
+                cierre_id INTEGER,
+                fecha_snapshot TIMESTAMP NOT NULL
+            )
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_stock_fecha ON snapshots_stock (fecha_snapshot)")
+        
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS snapshots_stock_detalle (
+                snapshot_id INTEGER NOT NULL REFERENCES snapshots_stock(id),
+                producto_id INTEGER NOT NULL,
+                stock INTEGER NOT NULL,
+                PRIMARY KEY (snapshot_id, producto_id)
+            )
+        ''')
+        
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION registrar_historial_stock() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    IF COALESCE(NEW.stock_actual, 0) <> 0 THEN
+                        INSERT INTO historial_stock (producto_id, delta, stock_resultante)
+                        VALUES (NEW.id, NEW.stock_actual, NEW.stock_actual);
+                    END IF;
+                ELSIF TG_OP = 'UPDATE' THEN
+                    IF NEW.stock_actual IS DISTINCT FROM OLD.stock_actual THEN
+                        INSERT INTO historial_stock (producto_id, delta, stock_resultante)
+                        VALUES (NEW.id, COALESCE(NEW.stock_actual, 0) - COALESCE(OLD.stock_actual, 0), COALESCE(NEW.stock_actual, 0));
+                    END IF;
+                ELSIF COALESCE(OLD.stock_actual, 0) <> 0 THEN
+                    INSERT INTO historial_stock (producto_id, delta, stock_resultante)
+                    VALUES (OLD.id, -OLD.stock_actual, 0);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        cur.execute("DROP TRIGGER IF EXISTS trg_historial_stock ON productos")
+        cur.execute('''
+            CREATE TRIGGER trg_historial_stock
+            AFTER INSERT OR UPDATE OF stock_actual OR DELETE ON productos
+            FOR EACH ROW EXECUTE FUNCTION registrar_historial_stock()
+        ''')
+        
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION rechazar_modificacion_historial() RETURNS trigger AS $$
+            BEGIN
+                RAISE EXCEPTION 'La tabla % es de solo inserción', TG_TABLE_NAME;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+        for tabla in ('historial_stock', 'snapshots_stock', 'snapshots_stock_detalle'):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_{tabla}_solo_insercion ON {tabla}")
+            cur.execute(f'''
+                CREATE TRIGGER trg_{tabla}_solo_insercion
+                BEFORE UPDATE OR DELETE OR TRUNCATE ON {tabla}
+                FOR EACH STATEMENT EXECUTE FUNCTION rechazar_modificacion_historial()
+            ''')
+        
+        # Snapshot inicial: el historial empieza con el stock existente al activarlo
+        cur.execute("SELECT EXISTS (SELECT 1 FROM snapshots_stock)")
+        if not cur.fetchone()[0]:
+            tomar_snapshot_stock(conn)
+        
         # Insertar configuraciones por defecto
         configuraciones = [
             ('empresa_nombre', 'Constrefri', 'Nombre de la empresa'),
@@ -225,7 +441,7 @@ def init_db():
         count = cur.fetchone()[0]
         
         if count == 0:
-            print("📝 Insertando usuarios por defecto...")
+            logger.info("Insertando usuarios por defecto")
             usuarios = [
                 ('Carlos Dueño', 'dueno@constrefri.com', 'dueno123', 'dueño'),
                 ('Maria Administradora', 'admin@constrefri.com', 'admin123', 'administrador'),
@@ -238,40 +454,90 @@ def init_db():
                     (nombre, email, password, rol)
                 )
             
-            print("✅ Todos los usuarios insertados")
+            logger.info("Usuarios por defecto insertados")
         
         conn.commit()
-        print("✅ Todas las tablas creadas/verificadas")
+        logger.info("Tablas creadas/verificadas")
         
-    except Exception as e:
-        print(f"❌ Error creando tablas: {e}")
+    except Exception:
+        logger.exception("Error creando tablas")
     finally:
         conn.close()
 
 init_db()
+particiones_auditoria.iniciar_mantenimiento_periodico(get_db)
+indice_codigos.iniciar_escucha(get_db)
+iniciar_escucha_nivel(get_db)
 
-def registrar_auditoria(usuario_id: int, accion: str, tabla_afectada: str = None, registro_id: int = None, detalles: str = None):
-    conn = get_db()
-    if not conn:
+def registrar_auditoria(usuario_id: int, accion: str, tabla_afectada: str = None, registro_id: int = None, detalles: str = None, datos: dict = None):
+    registrar_auditorias([(usuario_id, accion, tabla_afectada, registro_id, detalles, datos)])
+
+def registrar_auditorias(registros: list):
+    """Inserta varias filas de auditoría (usuario_id, accion, tabla_afectada, registro_id, detalles[, datos]) con una sola conexión.
+    
+    ``detalles`` es el mensaje legible; ``datos`` (ids, cantidades, valores
+    antes/después) se guarda junto a él en el JSONB para búsquedas indexadas.
+    """
+    if not registros:
         return
     
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO auditoria_sistema (usuario_id, accion, tabla_afectada, registro_id, detalles) VALUES (%s, %s, %s, %s, %s)",
-            (usuario_id, accion, tabla_afectada, registro_id, detalles)
-        )
-        conn.commit()
-        print(f"✅ Auditoría registrada: {accion}")
-    except Exception as e:
-        print(f"❌ Error registrando auditoría: {e}")
-    finally:
-        conn.close()
+    filas = [
+        (usuario_id, accion, tabla_afectada, registro_id, particiones_auditoria.detalles(tabla_afectada, registro_id, mensaje, datos[0] if datos else None))
+        for usuario_id, accion, tabla_afectada, registro_id, mensaje, *datos in registros
+    ]
+    
+    with span("registrar_auditoria", filas=len(registros)):
+        conn = get_db()
+        if not conn:
+            return
+        
+        try:
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                "INSERT INTO auditoria_sistema (usuario_id, accion, tabla_afectada, registro_id, detalles) VALUES %s",
+                filas,
+                page_size=1000
+            )
+            conn.commit()
+            logger.debug("Auditoría registrada", extra={"muestreo": "auditoria", "campos": {"acciones": sorted({registro[1] for registro in registros}), "filas": len(registros)}})
+        except Exception:
+            logger.exception("Error registrando auditoría")
+        finally:
+            conn.close()
+
+def exigir_administrador(usuario_id: int):
+    """Lanza 403 si el usuario no es administrador ni dueño."""
+    with span("verificar_rol", usuario_id=usuario_id):
+        conn = get_db()
+        if not conn:
+            raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
+        
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("SELECT rol FROM usuarios WHERE id = %s AND activo = true", (usuario_id,))
+            usuario = cur.fetchone()
+        finally:
+            conn.close()
+    
+    if not usuario or usuario["rol"] not in ["administrador", "dueño"]:
+        raise HTTPException(status_code=403, detail="Solo el administrador o el dueño pueden acceder")
+
+def rango_fechas(desde, hasta):
+    """Convierte fechas inclusivas en el rango [desde, hasta) de timestamps."""
+    return (
+        datetime.combine(desde, datetime.min.time()) if desde is not None else None,
+        datetime.combine(hasta + timedelta(days=1), datetime.min.time()) if hasta is not None else None
+    )
 
 @app.get("/")
 def home():
     return {"mensaje": "Backend funcionando"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def obtener_metricas():
+    return PlainTextResponse(registro_metricas.exportar(), media_type="text/plain; version=0.0.4")
+
 @app.post("/auth/login")
 def login(login_data: LoginRequest):
     conn = get_db()
@@ -281,8 +547,6 @@ def login(login_data: LoginRequest):
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        print(f"🔍 Buscando usuario: {login_data.username}")
-        
         cur.execute(
             "SELECT id, nombre, email, hash_contrasena, rol FROM usuarios WHERE email = %s",
             (login_data.username,)
@@ -290,12 +554,8 @@ def login(login_data: LoginRequest):
         user_db = cur.fetchone()
         
         if user_db:
-            print(f"✅ Usuario encontrado: {user_db['email']}")
-            print(f"🔑 Contraseña BD: '{user_db['hash_contrasena']}'")
-            print(f"🔑 Contraseña enviada: '{login_data.password}'")
-            
             if user_db["hash_contrasena"] == login_data.password:
-                registrar_auditoria(user_db["id"], "LOGIN", "usuarios", user_db["id"], f"Usuario {user_db['email']} inició sesión")
+                registrar_auditoria(user_db["id"], "LOGIN", "usuarios", user_db["id"], f"Usuario {user_db['email']} inició sesión", {"email": user_db["email"]})
                 
                 return {
                     "token_acceso": f"token_{user_db['id']}",
@@ -308,11 +568,13 @@ def login(login_data: LoginRequest):
                     }
                 }
         
-        print("❌ Credenciales incorrectas")
+        logger.info("Credenciales incorrectas", extra={"campos": {"usuario": login_data.username}})
         raise HTTPException(status_code=401, detail="Credenciales incorrectas")
             
-    except Exception as e:
-        print(f"Error en login: {e}")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error en login")
         raise HTTPException(status_code=500, detail="Error interno del servidor")
     finally:
         conn.close()
@@ -327,8 +589,8 @@ def obtener_usuarios():
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute("SELECT id, nombre, email, rol FROM usuarios WHERE activo = true")
         return cur.fetchall()
-    except Exception as e:
-        print(f"Error obteniendo usuarios: {e}")
+    except Exception:
+        logger.exception("Error obteniendo usuarios")
         return []
     finally:
         conn.close()
@@ -342,18 +604,15 @@ def crear_usuario(usuario: UserCreate):
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        print(f"📝 Intentando crear usuario: {usuario.email}")
-        print(f"📋 Datos recibidos: nombre={usuario.nombre}, email={usuario.email}, rol={usuario.rol}")
+        logger.debug("Creando usuario", extra={"campos": {"email": usuario.email, "rol": usuario.rol}})
         
         cur.execute("SELECT id FROM usuarios WHERE email = %s", (usuario.email,))
         email_existente = cur.fetchone()
         
         if email_existente:
-            print(f"❌ Email ya existe: {usuario.email}")
+            logger.info("Email ya existe", extra={"campos": {"email": usuario.email}})
             raise HTTPException(status_code=400, detail="El email ya existe")
         
-        print("✅ Email disponible")
-        
         try:
             cur.execute(
                 "INSERT INTO usuarios (nombre, email, hash_contrasena, rol) VALUES (%s, %s, %s, %s) RETURNING id, nombre, email, rol",
@@ -363,9 +622,9 @@ def crear_usuario(usuario: UserCreate):
             nuevo_usuario = cur.fetchone()
             conn.commit()
             
-            print(f"✅ Usuario creado exitosamente: ID={nuevo_usuario['id']}")
+            logger.info("Usuario creado", extra={"campos": {"usuario_id": nuevo_usuario["id"]}})
             
-            registrar_auditoria(1, "CREAR_USUARIO", "usuarios", nuevo_usuario["id"], f"Usuario {usuario.email} creado con rol {usuario.rol}")
+            registrar_auditoria(1, "CREAR_USUARIO", "usuarios", nuevo_usuario["id"], f"Usuario {usuario.email} creado con rol {usuario.rol}", {"email": usuario.email, "rol": usuario.rol})
             
             return {
                 "id": nuevo_usuario["id"],
@@ -375,14 +634,14 @@ def crear_usuario(usuario: UserCreate):
             }
             
         except Exception as insert_error:
-            print(f"❌ Error en INSERT: {insert_error}")
+            logger.exception("Error insertando usuario")
             conn.rollback()
             raise HTTPException(status_code=500, detail=f"Error creando usuario en la base de datos: {str(insert_error)}")
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Error general: {e}")
+        logger.exception("Error creando usuario")
         if conn:
             conn.rollback()
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
@@ -425,7 +684,7 @@ async def eliminar_usuario(usuario_id: int, usuario_actual_id: int = Query(...))
         conn.commit()
         
         registrar_auditoria(usuario_actual_id, "ELIMINAR_USUARIO", "usuarios", usuario_id, 
-                           f"Usuario {usuario_a_eliminar['email']} desactivado")
+                           f"Usuario {usuario_a_eliminar['email']} desactivado", {"email": usuario_a_eliminar["email"]})
         
         return {
             "success": True,
@@ -436,7 +695,7 @@ async def eliminar_usuario(usuario_id: int, usuario_actual_id: int = Query(...))
         raise
     except Exception as e:
         conn.rollback()
-        print(f"❌ Error eliminando usuario: {e}")
+        logger.exception("Error eliminando usuario")
         raise HTTPException(status_code=500, detail=f"Error eliminando usuario: {str(e)}")
     finally:
         conn.close()
@@ -472,7 +731,7 @@ async def subir_csv_cierre(archivo: UploadFile = File(...), usuario_id: int = Fo
         raise HTTPException(status_code=400, detail=f"Error procesando CSV: {str(e)}")
 
 @app.post("/cierres-diarios/procesar")
-async def procesar_cierre_diario(datos: ProcesarCierreRequest):
+def procesar_cierre_diario(datos: ProcesarCierreRequest):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
@@ -482,61 +741,65 @@ async def procesar_cierre_diario(datos: ProcesarCierreRequest):
         
         usuario_id = datos.usuario_id
         
-        print(f"🔍 Procesando cierre con usuario_id: {usuario_id}")
+        logger.info("Procesando cierre", extra={"campos": {"usuario_id": usuario_id, "productos": len(datos.productos)}})
         
         cur.execute("SELECT id FROM usuarios WHERE id = %s", (usuario_id,))
         usuario_existe = cur.fetchone()
         
         if not usuario_existe:
-            print(f"❌ Usuario {usuario_id} no existe en la base de datos")
+            logger.warning("Usuario de cierre inexistente", extra={"campos": {"usuario_id": usuario_id}})
             raise HTTPException(status_code=400, detail=f"El usuario {usuario_id} no existe")
         
-        cur.execute(
-            "INSERT INTO cierres_diarios (fecha_cierre, archivo_csv, total_productos, usuario_id) VALUES (%s, %s, %s, %s) RETURNING id",
-            (datetime.now().date(), datos.nombre_archivo, len(datos.productos), usuario_id)
-        )
-        cierre_id = cur.fetchone()[0]
-        
-        total_ingresados = 0
-        
-        for producto in datos.productos:
-            cur.execute("SELECT id, stock_actual FROM productos WHERE codigo = %s", (producto.codigo,))
-            producto_existente = cur.fetchone()
+        def procesar(conn):
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO cierres_diarios (fecha_cierre, archivo_csv, total_productos, usuario_id) VALUES (%s, %s, %s, %s) RETURNING id",
+                (datetime.now().date(), datos.nombre_archivo, len(datos.productos), usuario_id)
+            )
+            cierre_id = cur.fetchone()[0]
             
-            if producto_existente:
-                producto_id = producto_existente[0]
-                nuevo_stock = producto_existente[1] + producto.cantidad
-                
-                cur.execute(
-                    "UPDATE productos SET stock_actual = %s, precio_compra = %s, precio_venta = %s WHERE id = %s",
-                    (nuevo_stock, producto.precio_compra, producto.precio_venta, producto_id)
-                )
-                
-                registrar_auditoria(usuario_id, "ACTUALIZAR_PRODUCTO", "productos", producto_id, f"Stock actualizado a {nuevo_stock}")
-            else:
-                cur.execute(
-                    "INSERT INTO productos (codigo, nombre, categoria, precio_compra, precio_venta, stock_actual) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
-                    (producto.codigo, producto.nombre, producto.categoria, producto.precio_compra, producto.precio_venta, producto.cantidad)
-                )
-                producto_id = cur.fetchone()[0]
-                
-                registrar_auditoria(usuario_id, "CREAR_PRODUCTO", "productos", producto_id, f"Producto {producto.codigo} creado")
+            resultados = ingresar_cierre(conn, datos.productos, usuario_id, datos.nombre_archivo)
             
             cur.execute(
-                "INSERT INTO movimientos_inventario (producto_id, tipo_movimiento, cantidad, motivo, usuario_id, archivo_origen) VALUES (%s, %s, %s, %s, %s, %s)",
-                (producto_id, 'entrada', producto.cantidad, 'Cierre diario CSV', usuario_id, datos.nombre_archivo)
+                "UPDATE cierres_diarios SET total_ingresados = %s WHERE id = %s",
+                (len(datos.productos), cierre_id)
             )
-            
-            total_ingresados += 1
+            return cierre_id, resultados
         
-        cur.execute(
-            "UPDATE cierres_diarios SET total_ingresados = %s WHERE id = %s",
-            (total_ingresados, cierre_id)
-        )
+        cierre_id, resultados = ejecutar_transaccion(conn, procesar)
         
-        conn.commit()
+        # El snapshot va en su propia transacción corta: su LOCK SHARE tiene que ser
+        # la primera sentencia, no una mejora del ROW EXCLUSIVE que ya tomó el cierre
+        # (dos cierres se interbloquearían y frenaría las escrituras de stock)
+        def snapshot(conn):
+            return tomar_snapshot_stock(conn, cierre_id)
         
-        registrar_auditoria(usuario_id, "CIERRE_DIARIO", "cierres_diarios", cierre_id, f"Cierre diario {datos.nombre_archivo} procesado")
+        # El cierre ya está confirmado: si el snapshot falla solo se registra y se
+        # sigue con la auditoría, el historial queda sin la foto de este cierre
+        try:
+            ejecutar_transaccion(conn, snapshot)
+        except Exception:
+            conn.rollback()
+            logger.exception("Error tomando el snapshot de stock del cierre", extra={"campos": {"cierre_id": cierre_id}})
+        total_ingresados = len(datos.productos)
+        
+        # La auditoría se escribe después del commit (para que un reintento no la
+        # duplique) y en una sola inserción, no una conexión por producto
+        registros = []
+        for producto, producto_id, nuevo_stock, creado, cantidad in resultados:
+            datos_producto = {
+                "cierre_id": cierre_id,
+                "codigo": producto.codigo,
+                "cantidad": cantidad,
+                "stock_anterior": nuevo_stock - cantidad,
+                "stock_nuevo": nuevo_stock
+            }
+            if creado:
+                registros.append((usuario_id, "CREAR_PRODUCTO", "productos", producto_id, f"Producto {producto.codigo} creado", datos_producto))
+            else:
+                registros.append((usuario_id, "ACTUALIZAR_PRODUCTO", "productos", producto_id, f"Stock actualizado a {nuevo_stock}", datos_producto))
+        registros.append((usuario_id, "CIERRE_DIARIO", "cierres_diarios", cierre_id, f"Cierre diario {datos.nombre_archivo} procesado", {"archivo": datos.nombre_archivo, "productos": total_ingresados}))
+        registrar_auditorias(registros)
         
         return {
             "success": True,
@@ -544,7 +807,9 @@ async def procesar_cierre_diario(datos: ProcesarCierreRequest):
             "cierre_id": cierre_id,
             "total_procesado": total_ingresados
         }
-        
+    
+    except HTTPException:
+        raise
     except Exception as e:
         conn.rollback()
         raise HTTPException(status_code=500, detail=f"Error procesando cierre: {str(e)}")
@@ -552,28 +817,323 @@ async def procesar_cierre_diario(datos: ProcesarCierreRequest):
         conn.close()
 
 @app.get("/inventario")
-async def obtener_inventario():
+def obtener_inventario(request: Request, stream: bool = Query(False, description="Envía las filas en streaming (también con Accept: application/x-ndjson)")):
     conn = get_db()
     if not conn:
         return []
     
+    sql = """
+        SELECT id, codigo, nombre, categoria, precio_compra, precio_venta, stock_actual, stock_minimo 
+        FROM productos 
+        WHERE activo = true 
+        ORDER BY nombre
+    """
+    try:
+        formato = formato_streaming(request, stream)
+        if formato:
+            respuesta = transmitir_filas(conn, sql, formato=formato)
+            # La respuesta se queda con la conexión y la cierra al terminar de enviar
+            conn = None
+            return respuesta
+        return responder_filas(request, conn, sql)
+    except Exception:
+        logger.exception("Error obteniendo inventario")
+        return []
+    finally:
+        if conn is not None:
+            conn.close()
+
+@app.get("/inventario/cambios")
+def obtener_cambios_inventario(desde: int = Query(0, ge=0, description="Cursor devuelto por la consulta anterior (0 = inventario completo)")):
+    """Productos modificados y eliminados desde ``desde``, con el cursor para la próxima consulta.
+    
+    Un producto puede repetirse en dos respuestas seguidas si su transacción
+    estaba en curso al leer; aplicar los cambios por id es idempotente.
+    """
+    conn = get_db()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
+    
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
+        # Cursor y filas salen del mismo snapshot
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint as cursor")
+        cursor = cur.fetchone()["cursor"]
+        
         cur.execute("""
-            SELECT id, codigo, nombre, categoria, precio_compra, precio_venta, stock_actual, stock_minimo 
-            FROM productos 
-            WHERE activo = true 
-            ORDER BY nombre
-        """)
-        return cur.fetchall()
+            SELECT id, codigo, nombre, categoria, precio_compra, precio_venta, stock_actual, stock_minimo, activo
+            FROM productos
+            WHERE version >= %(desde)s AND (%(desde)s > 0 OR activo = true)
+            ORDER BY id
+        """, {"desde": desde})
+        filas = cur.fetchall()
+        
+        eliminados = [fila["id"] for fila in filas if not fila["activo"]]
+        if desde > 0:
+            cur.execute("SELECT producto_id FROM productos_eliminados WHERE version >= %s ORDER BY producto_id", (desde,))
+            eliminados += [fila["producto_id"] for fila in cur.fetchall()]
+        conn.commit()
+        
+        return {
+            "cursor": cursor,
+            "completo": desde == 0,
+            "productos": [{clave: valor for clave, valor in fila.items() if clave != "activo"} for fila in filas if fila["activo"]],
+            "eliminados": eliminados
+        }
+        
     except Exception as e:
-        print(f"Error obteniendo inventario: {e}")
+        logger.exception("Error obteniendo cambios de inventario")
+        raise HTTPException(status_code=500, detail=f"Error obteniendo cambios de inventario: {str(e)}")
+    finally:
+        conn.close()
+
+@app.get("/inventario/al")
+async def obtener_inventario_al(fecha: date = Query(...)):
+    """Stock de cada producto al final del día ``fecha``.
+    
+    Parte del snapshot más cercano anterior a esa fecha y suma solo los
+    cambios del historial entre el snapshot y el final del día.
+    """
+    conn = get_db()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
+    
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        limite = datetime.combine(fecha + timedelta(days=1), datetime.min.time())
+        
+        cur.execute("""
+            SELECT id, cierre_id, fecha_snapshot
+            FROM snapshots_stock
+            WHERE fecha_snapshot < %s
+            ORDER BY fecha_snapshot DESC
+            LIMIT 1
+        """, (limite,))
+        snapshot = cur.fetchone()
+        
+        cur.execute("""
+            WITH base AS (
+                SELECT producto_id, stock
+                FROM snapshots_stock_detalle
+                WHERE snapshot_id = %(snapshot_id)s
+            ),
+            cambios AS (
+                SELECT producto_id, SUM(delta) as delta
+                FROM historial_stock
+                WHERE fecha > %(desde)s AND fecha < %(limite)s
+                GROUP BY producto_id
+            )
+            SELECT 
+                COALESCE(b.producto_id, c.producto_id) as producto_id,
+                p.codigo,
+                p.nombre,
+                p.categoria,
+                COALESCE(b.stock, 0) + COALESCE(c.delta, 0) as stock
+            FROM base b
+            FULL OUTER JOIN cambios c ON b.producto_id = c.producto_id
+            LEFT JOIN productos p ON p.id = COALESCE(b.producto_id, c.producto_id)
+            WHERE COALESCE(b.stock, 0) + COALESCE(c.delta, 0) <> 0
+            ORDER BY p.nombre
+        """, {
+            "snapshot_id": snapshot["id"] if snapshot else None,
+            "desde": snapshot["fecha_snapshot"] if snapshot else datetime.min,
+            "limite": limite
+        })
+        
+        return {
+            "fecha": fecha,
+            "snapshot": snapshot,
+            "productos": cur.fetchall()
+        }
+        
+    except Exception as e:
+        logger.exception("Error obteniendo inventario histórico")
+        raise HTTPException(status_code=500, detail=f"Error obteniendo inventario histórico: {str(e)}")
+    finally:
+        conn.close()
+
+@app.get("/productos/buscar")
+def buscar_productos(
+    q: str = Query(..., min_length=1, max_length=100),
+    limite: int = Query(20, ge=1, le=100)
+):
+    """Productos activos por código, nombre o categoría, tolerando errores de tipeo."""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="La búsqueda no puede estar vacía")
+    
+    conn = get_db()
+    if not conn:
         return []
+    
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        return busqueda.buscar(cur, q, limite)
+    except Exception:
+        logger.exception("Error buscando productos")
+        return []
+    finally:
+        conn.close()
+
+@app.get("/productos/codigo/{codigo}")
+def obtener_producto_por_codigo(codigo: str):
+    codigo = codigo.strip()
+    try:
+        producto = indice_codigos.buscar(get_db, [codigo]).get(codigo)
+    except Exception as e:
+        logger.exception("Error buscando producto por código")
+        raise HTTPException(status_code=500, detail=f"Error buscando producto: {str(e)}")
+    
+    if not producto:
+        raise HTTPException(status_code=404, detail="Producto no encontrado")
+    return producto
+
+@app.post("/productos/lookup")
+def buscar_productos_por_codigos(datos: CodigosRequest):
+    """Productos de varios códigos en una sola petición, en el orden recibido."""
+    codigos = list(dict.fromkeys(codigo.strip() for codigo in datos.codigos))
+    if len(codigos) > indice_codigos.MAX_CODIGOS:
+        raise HTTPException(status_code=400, detail=f"Máximo {indice_codigos.MAX_CODIGOS} códigos por petición")
+    
+    try:
+        encontrados = indice_codigos.buscar(get_db, codigos)
+    except Exception as e:
+        logger.exception("Error buscando productos por código")
+        raise HTTPException(status_code=500, detail=f"Error buscando productos: {str(e)}")
+    
+    return {
+        "productos": [encontrados[codigo] for codigo in codigos if codigo in encontrados],
+        "no_encontrados": [codigo for codigo in codigos if codigo not in encontrados]
+    }
+
+@app.get("/productos/{producto_id}/movimientos")
+async def obtener_kardex_producto(
+    producto_id: int,
+    desde: date = Query(None),
+    hasta: date = Query(None),
+    tipo: str = Query(None),
+    cursor: str = Query(None),
+    limite: int = Query(100, ge=1, le=1000)
+):
+    """Kardex de un producto: movimientos en orden cronológico con saldo acumulado.
+    
+    Paginación por keyset: ``cursor`` es el valor ``siguiente`` de la página
+    anterior y lleva la posición (fecha, id) y el saldo alcanzado, así cada
+    página es un recorrido por rango del índice (producto_id, fecha_movimiento, id).
+    """
+    if tipo is not None and tipo not in ('entrada', 'salida', 'ajuste'):
+        raise HTTPException(status_code=400, detail="Tipo de movimiento inválido")
+    
+    conn = get_db()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
+    
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        
+        cur.execute("SELECT id, codigo, nombre, stock_actual FROM productos WHERE id = %s", (producto_id,))
+        producto = cur.fetchone()
+        
+        if not producto:
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        
+        condiciones = ["producto_id = %(producto_id)s"]
+        parametros = {"producto_id": producto_id, "limite": limite + 1, "tipo": tipo}
+        
+        if hasta is not None:
+            condiciones.append("fecha_movimiento < %(hasta)s")
+            parametros["hasta"] = datetime.combine(hasta + timedelta(days=1), datetime.min.time())
+        
+        # Los movimientos anteriores al corte están solo en el archivo Parquet: un
+        # rango que empiece antes mostraría un saldo sin esos movimientos
+        archivado_hasta = historico.corte(conn)
+        if desde is not None and archivado_hasta is not None and datetime.combine(desde, datetime.min.time()) < archivado_hasta:
+            raise HTTPException(status_code=400, detail=f"Los movimientos anteriores al {archivado_hasta.date()} están en el archivo histórico; usar desde >= {archivado_hasta.date()}")
+        
+        if cursor:
+            try:
+                cursor_fecha, cursor_id, saldo_inicial = cursor.split("|")
+                parametros["cursor_fecha"] = datetime.fromisoformat(cursor_fecha)
+                parametros["cursor_id"] = int(cursor_id)
+                saldo_inicial = int(saldo_inicial)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Cursor inválido")
+            if archivado_hasta is not None and parametros["cursor_fecha"] < archivado_hasta:
+                raise HTTPException(status_code=400, detail="Los movimientos de este cursor se archivaron; volver a pedir el kardex sin cursor")
+            condiciones.append("(fecha_movimiento, id) > (%(cursor_fecha)s, %(cursor_id)s)")
+        elif desde is not None or archivado_hasta is not None:
+            # Sin rango, el kardex empieza donde termina el archivo histórico
+            condiciones.append("fecha_movimiento >= %(desde)s")
+            parametros["desde"] = datetime.combine(desde, datetime.min.time()) if desde is not None else archivado_hasta
+            # Saldo de apertura desde el historial de stock (búsqueda puntual por índice)
+            cur.execute("""
+                SELECT stock_resultante FROM historial_stock
+                WHERE producto_id = %(producto_id)s AND fecha < %(desde)s
+                ORDER BY fecha DESC, id DESC
+                LIMIT 1
+            """, parametros)
+            fila = cur.fetchone()
+            saldo_inicial = fila["stock_resultante"] if fila else 0
+        else:
+            saldo_inicial = 0
+        
+        parametros["saldo_inicial"] = saldo_inicial
+        
+        # El saldo de cada movimiento es el stock_resultante que guardó al escribirse,
+        # así una reversión (que cambia el stock y borra movimientos) no descuadra los
+        # siguientes. Los movimientos sin stock_resultante (anteriores a la migración)
+        # acumulan su variación sobre el último que sí lo tiene, o sobre el saldo
+        # inicial: "grupo" cuenta cuántos stock_resultante hubo hasta cada fila.
+        # El saldo se calcula sobre todos los tipos y el filtro por tipo se aplica
+        # después, para que el saldo mostrado sea siempre el stock real
+        cur.execute(f"""
+            SELECT id, fecha_movimiento, tipo_movimiento, cantidad, precio_unitario, costo_unitario, motivo, usuario_id, archivo_origen, variacion, saldo
+            FROM (
+                SELECT 
+                    id, fecha_movimiento, tipo_movimiento, cantidad, precio_unitario, costo_unitario, motivo, usuario_id, archivo_origen, variacion,
+                    CASE
+                        WHEN grupo = 0 THEN %(saldo_inicial)s + SUM(variacion) OVER tramo
+                        ELSE MAX(stock_resultante) OVER (PARTITION BY grupo)
+                            + SUM(CASE WHEN stock_resultante IS NULL THEN variacion ELSE 0 END) OVER tramo
+                    END as saldo
+                FROM (
+                    SELECT 
+                        id, fecha_movimiento, tipo_movimiento, cantidad, precio_unitario, costo_unitario, motivo, usuario_id, archivo_origen, stock_resultante,
+                        CASE WHEN tipo_movimiento = 'salida' THEN -cantidad ELSE cantidad END as variacion,
+                        COUNT(stock_resultante) OVER (ORDER BY fecha_movimiento, id ROWS UNBOUNDED PRECEDING) as grupo
+                    FROM movimientos_inventario
+                    WHERE {" AND ".join(condiciones)}
+                ) movimientos
+                WINDOW tramo AS (PARTITION BY grupo ORDER BY fecha_movimiento, id ROWS UNBOUNDED PRECEDING)
+            ) kardex
+            WHERE %(tipo)s::varchar IS NULL OR tipo_movimiento = %(tipo)s
+            ORDER BY fecha_movimiento, id
+            LIMIT %(limite)s
+        """, parametros)
+        movimientos = cur.fetchall()
+        
+        siguiente = None
+        if len(movimientos) > limite:
+            movimientos = movimientos[:limite]
+            ultimo = movimientos[-1]
+            siguiente = f"{ultimo['fecha_movimiento'].isoformat()}|{ultimo['id']}|{ultimo['saldo']}"
+        
+        return {
+            "producto": producto,
+            "movimientos": movimientos,
+            "siguiente": siguiente
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error obteniendo kardex")
+        raise HTTPException(status_code=500, detail=f"Error obteniendo kardex: {str(e)}")
     finally:
         conn.close()
 
 @app.delete("/productos/{producto_id}")
-async def eliminar_producto(producto_id: int, usuario_id: int = Query(...), cantidad: int = Query(None)):
+def eliminar_producto(producto_id: int, usuario_id: int = Query(...), cantidad: int = Query(None)):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
@@ -597,26 +1157,29 @@ async def eliminar_producto(producto_id: int, usuario_id: int = Query(...), cant
             cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = %s", (producto_id,))
             cur.execute("DELETE FROM productos WHERE id = %s", (producto_id,))
             mensaje = f"Producto {producto['nombre']} eliminado permanentemente"
-            registrar_auditoria(usuario_id, "ELIMINAR_PRODUCTO", "productos", producto_id, f"Producto {producto['nombre']} eliminado completamente")
+            registrar_auditoria(usuario_id, "ELIMINAR_PRODUCTO", "productos", producto_id, f"Producto {producto['nombre']} eliminado completamente", {"stock_anterior": producto["stock_actual"], "stock_nuevo": 0})
         else:
-            if cantidad > producto["stock_actual"]:
-                raise HTTPException(status_code=400, detail=f"No se puede eliminar más de {producto['stock_actual']} unidades")
+            def reducir(conn):
+                nuevo_stock = descontar_stock(conn, producto_id, cantidad, 'Reducción manual de stock', usuario_id)
+                if nuevo_stock <= 0:
+                    cur = conn.cursor()
+                    cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = %s", (producto_id,))
+                    cur.execute("DELETE FROM productos WHERE id = %s", (producto_id,))
+                return nuevo_stock
             
-            nuevo_stock = producto["stock_actual"] - cantidad
+            try:
+                nuevo_stock = ejecutar_transaccion(conn, reducir)
+            except StockInsuficiente as e:
+                raise HTTPException(status_code=400, detail=f"No se puede eliminar más de {e.disponible} unidades")
+            except ProductoNoEncontrado:
+                raise HTTPException(status_code=404, detail="Producto no encontrado")
             
             if nuevo_stock <= 0:
-                cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = %s", (producto_id,))
-                cur.execute("DELETE FROM productos WHERE id = %s", (producto_id,))
                 mensaje = f"Producto {producto['nombre']} eliminado completamente (stock agotado)"
-                registrar_auditoria(usuario_id, "ELIMINAR_PRODUCTO", "productos", producto_id, f"Producto {producto['nombre']} eliminado por agotar stock")
+                registrar_auditoria(usuario_id, "ELIMINAR_PRODUCTO", "productos", producto_id, f"Producto {producto['nombre']} eliminado por agotar stock", {"cantidad": cantidad, "stock_anterior": nuevo_stock + cantidad, "stock_nuevo": 0})
             else:
-                cur.execute("UPDATE productos SET stock_actual = %s WHERE id = %s", (nuevo_stock, producto_id))
-                cur.execute(
-                    "INSERT INTO movimientos_inventario (producto_id, tipo_movimiento, cantidad, motivo, usuario_id) VALUES (%s, %s, %s, %s, %s)",
-                    (producto_id, 'salida', cantidad, 'Reducción manual de stock', usuario_id)
-                )
                 mensaje = f"Stock reducido en {cantidad} unidades. Nuevo stock: {nuevo_stock} unidades"
-                registrar_auditoria(usuario_id, "AJUSTAR_STOCK", "productos", producto_id, f"Stock reducido en {cantidad} unidades. Nuevo stock: {nuevo_stock}")
+                registrar_auditoria(usuario_id, "AJUSTAR_STOCK", "productos", producto_id, f"Stock reducido en {cantidad} unidades. Nuevo stock: {nuevo_stock}", {"cantidad": cantidad, "stock_anterior": nuevo_stock + cantidad, "stock_nuevo": nuevo_stock})
         
         conn.commit()
         
@@ -634,151 +1197,272 @@ async def eliminar_producto(producto_id: int, usuario_id: int = Query(...), cant
         conn.close()
 
 @app.get("/auditoria")
-async def obtener_auditoria():
+def obtener_auditoria(request: Request, stream: bool = Query(False, description="Envía las filas en streaming (también con Accept: application/x-ndjson)")):
     conn = get_db()
     if not conn:
         return []
     
+    # detalles sale como el mensaje de texto de siempre; el JSONB completo va en datos
+    sql = """
+        SELECT a.id, a.usuario_id, a.accion, a.tabla_afectada, a.registro_id,
+            a.detalles->>'mensaje' as detalles, a.detalles as datos, a.fecha, a.revertido,
+            u.nombre as usuario_nombre, u.email as usuario_email
+        FROM auditoria_sistema a
+        LEFT JOIN usuarios u ON a.usuario_id = u.id
+        ORDER BY a.fecha DESC
+        LIMIT 1000
+    """
+    try:
+        formato = formato_streaming(request, stream)
+        if formato:
+            respuesta = transmitir_filas(conn, sql, formato=formato)
+            # La respuesta se queda con la conexión y la cierra al terminar de enviar
+            conn = None
+            return respuesta
+        return responder_filas(request, conn, sql)
+    except Exception:
+        logger.exception("Error obteniendo auditoría")
+        return []
+    finally:
+        if conn is not None:
+            conn.close()
+
+@app.get("/auditoria/buscar")
+async def buscar_auditoria(
+    producto_id: int = Query(None),
+    cierre_id: int = Query(None),
+    merma_id: int = Query(None),
+    usuario_afectado_id: int = Query(None),
+    codigo: str = Query(None),
+    accion: str = Query(None),
+    usuario_id: int = Query(None, description="Usuario que realizó la acción"),
+    desde: date = Query(None),
+    hasta: date = Query(None),
+    limite: int = Query(200, ge=1, le=1000)
+):
+    """Busca en la auditoría por contenido de detalles (p. ej. todo lo que tocó un producto o un cierre).
+    
+    Los filtros de detalles se combinan en un solo ``detalles @> {...}`` que
+    resuelve el índice GIN, sin recorrer la tabla.
+    """
+    contenido = {
+        clave: valor
+        for clave, valor in (
+            ("producto_id", producto_id),
+            ("cierre_id", cierre_id),
+            ("merma_id", merma_id),
+            ("usuario_afectado_id", usuario_afectado_id),
+            ("codigo", codigo)
+        )
+        if valor is not None
+    }
+    if not contenido and accion is None and usuario_id is None:
+        raise HTTPException(status_code=400, detail="Indica al menos un criterio de búsqueda")
+    
+    conn = get_db()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
+    
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
+        rango_desde, rango_hasta = rango_fechas(desde, hasta)
         cur.execute("""
-            SELECT a.*, u.nombre as usuario_nombre, u.email as usuario_email
+            SELECT a.id, a.usuario_id, a.accion, a.tabla_afectada, a.registro_id,
+                a.detalles->>'mensaje' as detalles, a.detalles as datos, a.fecha, a.revertido,
+                u.nombre as usuario_nombre, u.email as usuario_email
             FROM auditoria_sistema a
             LEFT JOIN usuarios u ON a.usuario_id = u.id
+            WHERE a.detalles @> %(contenido)s
+                AND (%(accion)s::varchar IS NULL OR a.accion = %(accion)s)
+                AND (%(usuario_id)s::int IS NULL OR a.usuario_id = %(usuario_id)s)
+                AND (%(desde)s::timestamp IS NULL OR a.fecha >= %(desde)s)
+                AND (%(hasta)s::timestamp IS NULL OR a.fecha < %(hasta)s)
             ORDER BY a.fecha DESC
-            LIMIT 1000
-        """)
-        resultados = cur.fetchall()
-        return resultados
+            LIMIT %(limite)s
+        """, {
+            "contenido": Json(contenido),
+            "accion": accion,
+            "usuario_id": usuario_id,
+            "desde": rango_desde,
+            "hasta": rango_hasta,
+            "limite": limite
+        })
+        return cur.fetchall()
+        
     except Exception as e:
-        print(f"Error obteniendo auditoría: {e}")
+        logger.exception("Error buscando en auditoría")
+        raise HTTPException(status_code=500, detail=f"Error buscando en auditoría: {str(e)}")
+    finally:
+        conn.close()
+
+@app.get("/auditoria/contadores")
+async def obtener_contadores_auditoria(desde: date = Query(None), hasta: date = Query(None), accion: str = Query(None)):
+    """Conteos diarios de las acciones compactadas (p. ej. LOGIN) cuyas filas ya no están en /auditoria."""
+    conn = get_db()
+    if not conn:
+        return []
+    
+    try:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT c.dia, c.accion, c.usuario_id, u.nombre as usuario_nombre, c.cantidad
+            FROM auditoria_contadores c
+            LEFT JOIN usuarios u ON c.usuario_id = u.id
+            WHERE (%(desde)s::date IS NULL OR c.dia >= %(desde)s)
+                AND (%(hasta)s::date IS NULL OR c.dia <= %(hasta)s)
+                AND (%(accion)s::varchar IS NULL OR c.accion = %(accion)s)
+            ORDER BY c.dia DESC, c.accion, c.usuario_id
+            LIMIT 1000
+        """, {"desde": desde, "hasta": hasta, "accion": accion})
+        return cur.fetchall()
+        
+    except Exception:
+        logger.exception("Error obteniendo contadores de auditoría")
         return []
     finally:
         conn.close()
 
 @app.post("/revertir-proceso")
-async def revertir_proceso(datos: RevertirProcesoRequest):
+def revertir_proceso(datos: RevertirProcesoRequest):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
     
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute("SELECT * FROM auditoria_sistema WHERE id = %s", (datos.proceso_id,))
-        proceso = cur.fetchone()
-        
-        if not proceso:
-            raise HTTPException(status_code=404, detail="Proceso no encontrado")
-        
-        if proceso["revertido"]:
-            raise HTTPException(status_code=400, detail="Este proceso ya fue revertido")
-        
-        print(f"🔄 Revertiendo proceso: {proceso['accion']} - {proceso['detalles']}")
-        
-        if proceso["accion"] == "CIERRE_DIARIO":
-            # SOLUCIÓN SIMPLE Y DIRECTA: Revertir usando los movimientos de inventario
-            cierre_id = proceso["registro_id"]
-            print(f"📁 Revertiendo cierre diario ID: {cierre_id}")
+        # Todo el proceso (bloqueo, stock, borrados y marca de revertido) es una sola
+        # operación repetible: ante un deadlock con un cierre o una merma se reintenta
+        def revertir(conn):
+            cur = conn.cursor(cursor_factory=RealDictCursor)
             
-            # 1. Obtener información del cierre
-            cur.execute("SELECT archivo_csv FROM cierres_diarios WHERE id = %s", (cierre_id,))
-            cierre_info = cur.fetchone()
+            # FOR UPDATE: dos reversiones simultáneas del mismo proceso se serializan aquí
+            cur.execute("SELECT * FROM auditoria_sistema WHERE id = %s FOR UPDATE", (datos.proceso_id,))
+            proceso = cur.fetchone()
             
-            if not cierre_info:
-                raise HTTPException(status_code=404, detail="Cierre diario no encontrado")
+            if not proceso:
+                raise HTTPException(status_code=404, detail="Proceso no encontrado")
             
-            nombre_archivo = cierre_info["archivo_csv"]
-            print(f"📄 Archivo del cierre: {nombre_archivo}")
+            if proceso["revertido"]:
+                raise HTTPException(status_code=400, detail="Este proceso ya fue revertido")
             
-            productos_actualizados = 0
+            logger.info("Revertiendo proceso", extra={"campos": {"proceso_id": datos.proceso_id, "accion": proceso["accion"]}})
             
-            # 2. Buscar TODOS los movimientos de este cierre
-            cur.execute("""
-                SELECT mi.producto_id, mi.cantidad, p.codigo, p.nombre, p.stock_actual
-                FROM movimientos_inventario mi
-                JOIN productos p ON mi.producto_id = p.id
-                WHERE mi.archivo_origen = %s
-            """, (nombre_archivo,))
-            
-            movimientos = cur.fetchall()
-            print(f"🔍 Movimientos encontrados para revertir: {len(movimientos)}")
+            productos_actualizados = 0
             
-            # 3. Revertir el stock para cada producto
-            for movimiento in movimientos:
-                producto_id = movimiento["producto_id"]
-                cantidad_agregada = movimiento["cantidad"]
-                stock_actual = movimiento["stock_actual"]
+            if proceso["accion"] == "CIERRE_DIARIO":
+                # SOLUCIÓN SIMPLE Y DIRECTA: Revertir usando los movimientos de inventario
+                cierre_id = proceso["registro_id"]
+                logger.debug("Revertiendo cierre diario", extra={"campos": {"cierre_id": cierre_id}})
                 
-                # Calcular nuevo stock (restando lo agregado en el cierre)
-                nuevo_stock = stock_actual - cantidad_agregada
-                if nuevo_stock < 0:
-                    nuevo_stock = 0
+                # 1. Obtener información del cierre
+                cur.execute("SELECT archivo_csv, fecha_procesado FROM cierres_diarios WHERE id = %s", (cierre_id,))
+                cierre_info = cur.fetchone()
                 
-                print(f"📈 Revirtiendo producto: {movimiento['codigo']} - Stock: {stock_actual} -> {nuevo_stock} (restado: {cantidad_agregada})")
+                if not cierre_info:
+                    raise HTTPException(status_code=404, detail="Cierre diario no encontrado")
                 
-                cur.execute("UPDATE productos SET stock_actual = %s WHERE id = %s", (nuevo_stock, producto_id))
-                productos_actualizados += 1
-            
-            # 4. Eliminar movimientos de este cierre
-            cur.execute("DELETE FROM movimientos_inventario WHERE archivo_origen = %s", (nombre_archivo,))
-            movimientos_eliminados = cur.rowcount
-            
-            # 5. Eliminar el registro del cierre diario
-            cur.execute("DELETE FROM cierres_diarios WHERE id = %s", (cierre_id,))
-            cierres_eliminados = cur.rowcount
-            
-            # 6. Marcar como revertido en auditoría
-            cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
-            
-            print(f"✅ Cierre diario revertido: {productos_actualizados} productos actualizados, {movimientos_eliminados} movimientos eliminados")
-            
-        elif proceso["accion"] == "CREAR_PRODUCTO":
-            print(f"🗑️ Eliminando producto creado ID: {proceso['registro_id']}")
-            cur.execute("DELETE FROM productos WHERE id = %s", (proceso["registro_id"],))
-            cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = %s", (proceso["registro_id"],))
-            cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
+                archivado_hasta = historico.corte(conn)
+                if archivado_hasta is not None and cierre_info["fecha_procesado"] < archivado_hasta:
+                    raise HTTPException(status_code=400, detail="Los movimientos de este cierre ya están en el archivo histórico y no se pueden revertir")
+                
+                nombre_archivo = cierre_info["archivo_csv"]
+                logger.debug("Archivo del cierre", extra={"campos": {"archivo": nombre_archivo}})
+                
+                # 2. Buscar TODOS los movimientos de este cierre
+                cur.execute("""
+                    SELECT mi.producto_id, mi.cantidad, mi.costo_unitario, p.codigo, p.nombre, p.stock_actual
+                    FROM movimientos_inventario mi
+                    JOIN productos p ON mi.producto_id = p.id
+                    WHERE mi.archivo_origen = %s
+                """, (nombre_archivo,))
+                
+                movimientos = cur.fetchall()
+                logger.debug("Movimientos a revertir", extra={"campos": {"movimientos": len(movimientos)}})
+                
+                # 3. Revertir el stock de todos los productos (bloqueados en orden de id) y
+                # sacar las entradas del costo promedio con el costo guardado en cada movimiento
+                cantidades = {}
+                costos = {}
+                for movimiento in movimientos:
+                    producto_id = movimiento["producto_id"]
+                    cantidades[producto_id] = cantidades.get(producto_id, 0) + movimiento["cantidad"]
+                    if movimiento["costo_unitario"] is None or costos.get(producto_id, 0) is None:
+                        costos[producto_id] = None
+                    else:
+                        costos[producto_id] = costos.get(producto_id, 0) + movimiento["cantidad"] * movimiento["costo_unitario"]
+                
+                nuevos_stocks = retirar_stock_lote(conn, cantidades, costos)
+                
+                productos_actualizados = len(movimientos)
+                
+                # Traza por fila solo con nivel DEBUG activo
+                if logger.isEnabledFor(logging.DEBUG):
+                    for movimiento in movimientos:
+                        logger.debug("Revirtiendo producto", extra={"campos": {
+                            "codigo": movimiento["codigo"],
+                            "stock_anterior": movimiento["stock_actual"],
+                            "stock_nuevo": nuevos_stocks.get(movimiento["producto_id"]),
+                            "restado": movimiento["cantidad"]
+                        }})
+                
+                # 4. Eliminar movimientos de este cierre
+                cur.execute("DELETE FROM movimientos_inventario WHERE archivo_origen = %s", (nombre_archivo,))
+                movimientos_eliminados = cur.rowcount
+                
+                # 5. Eliminar el registro del cierre diario
+                cur.execute("DELETE FROM cierres_diarios WHERE id = %s", (cierre_id,))
+                cierres_eliminados = cur.rowcount
+                
+                # 6. Marcar como revertido en auditoría
+                cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
+                
+                logger.info("Cierre diario revertido", extra={"campos": {"productos": productos_actualizados, "movimientos_eliminados": movimientos_eliminados}})
             
-        elif proceso["accion"] == "CREAR_USUARIO":
-            print(f"👤 Desactivando usuario creado ID: {proceso['registro_id']}")
-            cur.execute("UPDATE usuarios SET activo = false WHERE id = %s", (proceso["registro_id"],))
-            cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
+            elif proceso["accion"] == "CREAR_PRODUCTO":
+                logger.debug("Eliminando producto creado", extra={"campos": {"producto_id": proceso["registro_id"]}})
+                cur.execute("DELETE FROM productos WHERE id = %s", (proceso["registro_id"],))
+                cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = %s", (proceso["registro_id"],))
+                cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
             
-        elif proceso["accion"] == "ACTUALIZAR_PRODUCTO":
-            print(f"🔄 No se puede revertir automáticamente actualización de producto")
-            cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
+            elif proceso["accion"] == "CREAR_USUARIO":
+                logger.debug("Desactivando usuario creado", extra={"campos": {"usuario_id": proceso["registro_id"]}})
+                cur.execute("UPDATE usuarios SET activo = false WHERE id = %s", (proceso["registro_id"],))
+                cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
             
-        elif proceso["accion"] == "ELIMINAR_PRODUCTO":
-            print(f"⚠️ No se puede revertir eliminación de producto")
-            raise HTTPException(status_code=400, detail="No se puede revertir la eliminación de productos")
+            elif proceso["accion"] == "ACTUALIZAR_PRODUCTO":
+                logger.debug("Actualización de producto marcada como revertida sin cambios")
+                cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
             
-        elif proceso["accion"] == "AJUSTAR_STOCK":
-            print(f"🔄 Revirtiendo ajuste de stock para producto ID: {proceso['registro_id']}")
-            # Buscar el último movimiento de stock para este producto
-            cur.execute("""
-                SELECT cantidad FROM movimientos_inventario 
-                WHERE producto_id = %s AND tipo_movimiento = 'salida' 
-                ORDER BY fecha_movimiento DESC LIMIT 1
-            """, (proceso["registro_id"],))
-            movimiento = cur.fetchone()
+            elif proceso["accion"] == "ELIMINAR_PRODUCTO":
+                logger.warning("No se puede revertir eliminación de producto")
+                raise HTTPException(status_code=400, detail="No se puede revertir la eliminación de productos")
             
-            if movimiento:
-                cantidad_reducida = movimiento["cantidad"]
-                # Obtener stock actual
-                cur.execute("SELECT stock_actual FROM productos WHERE id = %s", (proceso["registro_id"],))
-                producto = cur.fetchone()
-                if producto:
-                    nuevo_stock = producto["stock_actual"] + cantidad_reducida
-                    cur.execute("UPDATE productos SET stock_actual = %s WHERE id = %s", (nuevo_stock, proceso["registro_id"]))
-                    # Eliminar el movimiento de ajuste
-                    cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = %s AND tipo_movimiento = 'salida' ORDER BY fecha_movimiento DESC LIMIT 1", (proceso["registro_id"],))
+            elif proceso["accion"] == "AJUSTAR_STOCK":
+                logger.debug("Revirtiendo ajuste de stock", extra={"campos": {"producto_id": proceso["registro_id"]}})
+                # Buscar el último movimiento de stock para este producto
+                cur.execute("""
+                    SELECT id, cantidad FROM movimientos_inventario 
+                    WHERE producto_id = %s AND tipo_movimiento = 'salida' 
+                    ORDER BY fecha_movimiento DESC LIMIT 1
+                """, (proceso["registro_id"],))
+                movimiento = cur.fetchone()
+                
+                if movimiento:
+                    try:
+                        reponer_stock(conn, proceso["registro_id"], movimiento["cantidad"])
+                    except ProductoNoEncontrado:
+                        pass
+                    else:
+                        # Eliminar el movimiento de ajuste
+                        cur.execute("DELETE FROM movimientos_inventario WHERE id = %s", (movimiento["id"],))
+                
+                cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
             
-            cur.execute("UPDATE auditoria_sistema SET revertido = true WHERE id = %s", (datos.proceso_id,))
+            return proceso, productos_actualizados
         
-        conn.commit()
+        proceso, productos_actualizados = ejecutar_transaccion(conn, revertir)
         
         # Registrar reversión en auditoría
-        registrar_auditoria(1, "REVERTIR_PROCESO", "auditoria_sistema", datos.proceso_id, f"Proceso {datos.proceso_id} ({proceso['accion']}) revertido")
+        registrar_auditoria(1, "REVERTIR_PROCESO", "auditoria_sistema", datos.proceso_id, f"Proceso {datos.proceso_id} ({proceso['accion']}) revertido", {"accion_revertida": proceso["accion"], "productos": productos_actualizados})
         
         return {
             "success": True,
@@ -789,7 +1473,7 @@ async def revertir_proceso(datos: RevertirProcesoRequest):
         raise
     except Exception as e:
         conn.rollback()
-        print(f"❌ Error revirtiendo proceso: {e}")
+        logger.exception("Error revirtiendo proceso")
         raise HTTPException(status_code=500, detail=f"Error revirtiendo proceso: {str(e)}")
     finally:
         conn.close()
@@ -797,7 +1481,7 @@ async def revertir_proceso(datos: RevertirProcesoRequest):
 # ==================== RUTAS PARA MERMAS ====================
 
 @app.post("/mermas/registrar")
-async def registrar_merma(datos: MermaRequest):
+def registrar_merma(datos: MermaRequest):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
@@ -825,46 +1509,43 @@ async def registrar_merma(datos: MermaRequest):
         if not usuario:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
         
-        # Si es dueño o administrador, aplicar merma inmediatamente
-        if usuario["rol"] in ["dueño", "administrador"]:
-            # Calcular nuevo stock
-            nuevo_stock = producto["stock_actual"] - datos.cantidad
-            
-            # Actualizar stock del producto
-            cur.execute("UPDATE productos SET stock_actual = %s WHERE id = %s", 
-                       (nuevo_stock, datos.producto_id))
+        # Si es dueño o administrador, aplicar merma inmediatamente; si es empleado,
+        # solo guardar la solicitud pendiente
+        estado = "aprobada" if usuario["rol"] in ["dueño", "administrador"] else "pendiente"
+        
+        def registrar(conn):
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            if estado == "aprobada":
+                # Descontar stock de forma atómica y registrar movimiento de inventario
+                nuevo_stock = descontar_stock(conn, datos.producto_id, datos.cantidad, f"Merma: {datos.motivo}", datos.usuario_id)
+            else:
+                nuevo_stock = producto["stock_actual"]  # No cambia el stock
             
-            # Registrar movimiento de inventario
+            # Registrar en tabla de mermas_pendientes
             cur.execute("""
-                INSERT INTO movimientos_inventario 
-                (producto_id, tipo_movimiento, cantidad, motivo, usuario_id)
-                VALUES (%s, 'salida', %s, %s, %s)
-            """, (datos.producto_id, datos.cantidad, f"Merma: {datos.motivo}", datos.usuario_id))
-            
+                INSERT INTO mermas_pendientes 
+                (producto_id, cantidad, motivo, observaciones, estado, usuario_solicitud_id)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (datos.producto_id, datos.cantidad, datos.motivo, datos.observaciones, estado, datos.usuario_id))
+            return cur.fetchone()["id"], nuevo_stock
+        
+        try:
+            merma_id, nuevo_stock = ejecutar_transaccion(conn, registrar)
+        except StockInsuficiente as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except ProductoNoEncontrado:
+            raise HTTPException(status_code=404, detail="Producto no encontrado")
+        
+        if estado == "aprobada":
             mensaje = f"Merma registrada exitosamente. Stock actualizado: {nuevo_stock} unidades"
-            estado = "aprobada"
-            
         else:
-            # Si es empleado, solo guardar la solicitud pendiente
             mensaje = "Solicitud de merma enviada. Esperando aprobación del dueño."
-            estado = "pendiente"
-            nuevo_stock = producto["stock_actual"]  # No cambia el stock
-        
-        # Registrar en tabla de mermas_pendientes
-        cur.execute("""
-            INSERT INTO mermas_pendientes 
-            (producto_id, cantidad, motivo, observaciones, estado, usuario_solicitud_id)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (datos.producto_id, datos.cantidad, datos.motivo, datos.observaciones, estado, datos.usuario_id))
-        
-        merma_id = cur.fetchone()["id"]
-        
-        conn.commit()
         
         # Registrar en auditoría
         registrar_auditoria(datos.usuario_id, "SOLICITUD_MERMA", "mermas_pendientes", merma_id, 
-                           f"Solicitud de merma: {datos.cantidad} unidades de {producto['nombre']} - Estado: {estado}")
+                           f"Solicitud de merma: {datos.cantidad} unidades de {producto['nombre']} - Estado: {estado}",
+                           {"producto_id": datos.producto_id, "cantidad": datos.cantidad, "estado": estado})
         
         return {
             "success": True,
@@ -877,42 +1558,48 @@ async def registrar_merma(datos: MermaRequest):
         raise
     except Exception as e:
         conn.rollback()
-        print(f"❌ Error registrando merma: {e}")
+        logger.exception("Error registrando merma")
         raise HTTPException(status_code=500, detail=f"Error registrando merma: {str(e)}")
     finally:
         conn.close()
 
 @app.get("/mermas/pendientes")
-async def obtener_mermas_pendientes():
+def obtener_mermas_pendientes(request: Request, stream: bool = Query(False, description="Envía las filas en streaming (también con Accept: application/x-ndjson)")):
     conn = get_db()
     if not conn:
         return []
     
+    sql = """
+        SELECT 
+            mp.*,
+            p.codigo as producto_codigo,
+            p.nombre as producto_nombre,
+            p.stock_actual as producto_stock,
+            u.nombre as usuario_solicitud_nombre,
+            u.email as usuario_solicitud_email
+        FROM mermas_pendientes mp
+        JOIN productos p ON mp.producto_id = p.id
+        JOIN usuarios u ON mp.usuario_solicitud_id = u.id
+        WHERE mp.estado = 'pendiente'
+        ORDER BY mp.fecha_solicitud DESC
+    """
     try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("""
-            SELECT 
-                mp.*,
-                p.codigo as producto_codigo,
-                p.nombre as producto_nombre,
-                p.stock_actual as producto_stock,
-                u.nombre as usuario_solicitud_nombre,
-                u.email as usuario_solicitud_email
-            FROM mermas_pendientes mp
-            JOIN productos p ON mp.producto_id = p.id
-            JOIN usuarios u ON mp.usuario_solicitud_id = u.id
-            WHERE mp.estado = 'pendiente'
-            ORDER BY mp.fecha_solicitud DESC
-        """)
-        return cur.fetchall()
-    except Exception as e:
-        print(f"Error obteniendo mermas pendientes: {e}")
+        formato = formato_streaming(request, stream)
+        if formato:
+            respuesta = transmitir_filas(conn, sql, formato=formato)
+            # La respuesta se queda con la conexión y la cierra al terminar de enviar
+            conn = None
+            return respuesta
+        return responder_filas(request, conn, sql)
+    except Exception:
+        logger.exception("Error obteniendo mermas pendientes")
         return []
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
 
 @app.post("/mermas/aprobar")
-async def aprobar_merma(merma_id: int = Query(...), usuario_id: int = Query(...)):
+def aprobar_merma(merma_id: int = Query(...), usuario_id: int = Query(...)):
     conn = get_db()
     if not conn:
         raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
@@ -921,55 +1608,49 @@ async def aprobar_merma(merma_id: int = Query(...), usuario_id: int = Query(...)
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
         # Verificar que el usuario es dueño
-        cur.execute("SELECT rol FROM usuarios WHERE id = %s", (usuario_id,))
-        usuario = cur.fetchone()
+        with span("verificar_rol", usuario_id=usuario_id):
+            cur.execute("SELECT rol FROM usuarios WHERE id = %s", (usuario_id,))
+            usuario = cur.fetchone()
         
         if not usuario or usuario["rol"] != "dueño":
             raise HTTPException(status_code=403, detail="Solo el dueño puede aprobar mermas")
         
-        # Obtener la merma pendiente
-        cur.execute("""
-            SELECT mp.*, p.nombre as producto_nombre, p.stock_actual
-            FROM mermas_pendientes mp
-            JOIN productos p ON mp.producto_id = p.id
-            WHERE mp.id = %s AND mp.estado = 'pendiente'
-        """, (merma_id,))
-        
-        merma = cur.fetchone()
-        
-        if not merma:
-            raise HTTPException(status_code=404, detail="Merma no encontrada o ya procesada")
-        
-        # Verificar que aún hay stock suficiente
-        if merma["cantidad"] > merma["stock_actual"]:
-            raise HTTPException(status_code=400, detail=f"No hay suficiente stock. Stock actual: {merma['stock_actual']}")
-        
-        # Actualizar stock del producto
-        nuevo_stock = merma["stock_actual"] - merma["cantidad"]
-        cur.execute("UPDATE productos SET stock_actual = %s WHERE id = %s", 
-                   (nuevo_stock, merma["producto_id"]))
-        
-        # Registrar movimiento de inventario
-        cur.execute("""
-            INSERT INTO movimientos_inventario 
-            (producto_id, tipo_movimiento, cantidad, motivo, usuario_id)
-            VALUES (%s, 'salida', %s, %s, %s)
-        """, (merma["producto_id"], merma["cantidad"], f"Merma: {merma['motivo']}", usuario_id))
-        
-        # Actualizar merma como aprobada
-        cur.execute("""
-            UPDATE mermas_pendientes 
-            SET estado = 'aprobada', 
-                usuario_aprobacion_id = %s,
-                fecha_aprobacion = CURRENT_TIMESTAMP
-            WHERE id = %s
-        """, (usuario_id, merma_id))
+        def aprobar(conn):
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            
+            # Marcar la merma como aprobada solo si sigue pendiente: dos aprobaciones
+            # simultáneas no pueden descontar el stock dos veces
+            cur.execute("""
+                UPDATE mermas_pendientes 
+                SET estado = 'aprobada', 
+                    usuario_aprobacion_id = %s,
+                    fecha_aprobacion = CURRENT_TIMESTAMP
+                WHERE id = %s AND estado = 'pendiente'
+                RETURNING producto_id, cantidad, motivo,
+                          (SELECT nombre FROM productos WHERE id = producto_id) as producto_nombre
+            """, (usuario_id, merma_id))
+            
+            merma = cur.fetchone()
+            
+            if not merma:
+                raise HTTPException(status_code=404, detail="Merma no encontrada o ya procesada")
+            
+            # Actualizar stock del producto y registrar movimiento de inventario
+            try:
+                nuevo_stock = descontar_stock(conn, merma["producto_id"], merma["cantidad"], f"Merma: {merma['motivo']}", usuario_id)
+            except StockInsuficiente as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except ProductoNoEncontrado:
+                raise HTTPException(status_code=404, detail="Merma no encontrada o ya procesada")
+            
+            return merma, nuevo_stock
         
-        conn.commit()
+        merma, nuevo_stock = ejecutar_transaccion(conn, aprobar)
         
         # Registrar en auditoría
         registrar_auditoria(usuario_id, "APROBAR_MERMA", "mermas_pendientes", merma_id, 
-                           f"Merma aprobada: {merma['cantidad']} unidades de {merma['producto_nombre']}")
+                           f"Merma aprobada: {merma['cantidad']} unidades de {merma['producto_nombre']}",
+                           {"producto_id": merma["producto_id"], "cantidad": merma["cantidad"], "stock_anterior": nuevo_stock + merma["cantidad"], "stock_nuevo": nuevo_stock})
         
         return {
             "success": True,
@@ -980,7 +1661,7 @@ async def aprobar_merma(merma_id: int = Query(...), usuario_id: int = Query(...)
         raise
     except Exception as e:
         conn.rollback()
-        print(f"❌ Error aprobando merma: {e}")
+        logger.exception("Error aprobando merma")
         raise HTTPException(status_code=500, detail=f"Error aprobando merma: {str(e)}")
     finally:
         conn.close()
@@ -1028,7 +1709,8 @@ async def rechazar_merma(merma_id: int = Query(...), usuario_id: int = Query(...
         
         # Registrar en auditoría
         registrar_auditoria(usuario_id, "RECHAZAR_MERMA", "mermas_pendientes", merma_id, 
-                           f"Merma rechazada: {merma['cantidad']} unidades de {merma['producto_nombre']} - Motivo: {motivo_rechazo}")
+                           f"Merma rechazada: {merma['cantidad']} unidades de {merma['producto_nombre']} - Motivo: {motivo_rechazo}",
+                           {"producto_id": merma["producto_id"], "cantidad": merma["cantidad"], "motivo_rechazo": motivo_rechazo})
         
         return {
             "success": True,
@@ -1039,13 +1721,37 @@ async def rechazar_merma(merma_id: int = Query(...), usuario_id: int = Query(...
         raise
     except Exception as e:
         conn.rollback()
-        print(f"❌ Error rechazando merma: {e}")
+        logger.exception("Error rechazando merma")
         raise HTTPException(status_code=500, detail=f"Error rechazando merma: {str(e)}")
     finally:
         conn.close()
 
 # ==================== RUTAS PARA REPORTES ====================
 
+# Salidas por producto: tabla viva más las archivadas en Parquet, que llegan ya
+# agregadas como arreglos paralelos (historico.vendidos_por_producto)
+SQL_VENDIDOS_POR_PRODUCTO = """
+    SELECT producto_id, SUM(vendidos) as vendidos, SUM(ingresos) as ingresos, SUM(margen) as margen
+    FROM (
+        SELECT 
+            producto_id,
+            SUM(cantidad) as vendidos,
+            SUM(cantidad * precio_unitario) as ingresos,
+            SUM(cantidad * (precio_unitario - costo_unitario)) as margen
+        FROM movimientos_inventario
+        WHERE tipo_movimiento = 'salida'
+            AND (%(desde)s::timestamp IS NULL OR fecha_movimiento >= %(desde)s)
+            AND (%(hasta)s::timestamp IS NULL OR fecha_movimiento < %(hasta)s)
+        GROUP BY producto_id
+        UNION ALL
+        SELECT * FROM unnest(%(producto_id)s::int[], %(vendidos)s::bigint[], %(ingresos)s::numeric[], %(margen)s::numeric[])
+    ) salidas
+    GROUP BY producto_id
+"""
+
+def parametros_vendidos(conn, desde=None, hasta=None):
+    return dict(historico.vendidos_por_producto(conn, desde, hasta), desde=desde, hasta=hasta)
+
 @app.get("/reportes/metricas")
 async def obtener_metricas_reportes():
     conn = get_db()
@@ -1061,6 +1767,7 @@ async def obtener_metricas_reportes():
                 COUNT(*) as total_productos,
                 SUM(stock_actual) as stock_total,
                 SUM(precio_venta * stock_actual) as valor_inventario,
+                SUM(costo_promedio * stock_actual) as valor_inventario_costo,
                 COUNT(CASE WHEN stock_actual <= stock_minimo THEN 1 END) as stock_critico_count,
                 COUNT(CASE WHEN stock_actual > 0 THEN 1 END) as productos_activos
             FROM productos 
@@ -1068,19 +1775,39 @@ async def obtener_metricas_reportes():
         """)
         metricas = cur.fetchone()
         
-        # Productos más vendidos (basado en movimientos de salida)
+        # Valoración por categoría a costo promedio y a precio de venta
         cur.execute("""
             SELECT 
-                p.nombre as producto,
-                SUM(mi.cantidad) as vendidos,
-                SUM(mi.cantidad * p.precio_venta) as ingresos
-            FROM movimientos_inventario mi
-            JOIN productos p ON mi.producto_id = p.id
-            WHERE mi.tipo_movimiento = 'salida'
-            GROUP BY p.id, p.nombre
-            ORDER BY vendidos DESC
-            LIMIT 5
+                COALESCE(categoria, 'Sin categoría') as categoria,
+                SUM(stock_actual) as stock,
+                SUM(costo_promedio * stock_actual) as valor_costo,
+                SUM(precio_venta * stock_actual) as valor_venta,
+                SUM((precio_venta - costo_promedio) * stock_actual) as margen,
+                CASE WHEN SUM(precio_venta * stock_actual) > 0
+                    THEN ROUND(SUM((precio_venta - costo_promedio) * stock_actual) * 100 / SUM(precio_venta * stock_actual), 2)
+                END as margen_porcentaje
+            FROM productos 
+            WHERE activo = true AND stock_actual > 0
+            GROUP BY COALESCE(categoria, 'Sin categoría')
+            ORDER BY valor_costo DESC NULLS LAST
         """)
+        valoracion_por_categoria = cur.fetchall()
+        
+        # Productos más vendidos (basado en movimientos de salida, incluido el archivo histórico)
+        cur.execute(f"""
+            SELECT 
+                p.nombre as producto,
+                v.vendidos,
+                v.ingresos,
+                v.margen
+            FROM (
+                {SQL_VENDIDOS_POR_PRODUCTO}
+                ORDER BY vendidos DESC
+                LIMIT 5
+            ) v
+            JOIN productos p ON v.producto_id = p.id
+            ORDER BY v.vendidos DESC
+        """, parametros_vendidos(conn))
         productos_mas_vendidos = cur.fetchall()
         
         # Stock crítico
@@ -1103,17 +1830,19 @@ async def obtener_metricas_reportes():
         return {
             "metricas": metricas,
             "productos_mas_vendidos": productos_mas_vendidos,
-            "stock_critico": stock_critico
+            "stock_critico": stock_critico,
+            "valoracion_por_categoria": valoracion_por_categoria
         }
         
-    except Exception as e:
-        print(f"Error obteniendo métricas de reportes: {e}")
+    except Exception:
+        logger.exception("Error obteniendo métricas de reportes")
         return {}
     finally:
         conn.close()
 
 @app.get("/reportes/ventas")
-async def obtener_ventas_reporte():
+async def obtener_ventas_reporte(desde: date = Query(None), hasta: date = Query(None)):
+    """Ventas por día; sin rango, los últimos 7 días. Los días anteriores al horizonte salen del archivo histórico."""
     conn = get_db()
     if not conn:
         return []
@@ -1121,19 +1850,30 @@ async def obtener_ventas_reporte():
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        # Ventas de los últimos 7 días (simuladas basadas en movimientos)
+        rango_desde, rango_hasta = rango_fechas(desde if desde is not None else date.today() - timedelta(days=7), hasta)
+        
+        # Ventas por día (simuladas basadas en movimientos)
         cur.execute("""
             SELECT 
                 DATE(fecha_movimiento) as fecha,
-                SUM(cantidad * (SELECT precio_venta FROM productos WHERE id = mi.producto_id)) as ventas_dia
-            FROM movimientos_inventario mi
+                SUM(cantidad * precio_unitario) as ventas_dia
+            FROM movimientos_inventario
             WHERE tipo_movimiento = 'salida' 
-                AND fecha_movimiento >= CURRENT_DATE - INTERVAL '7 days'
+                AND fecha_movimiento >= %(desde)s
+                AND (%(hasta)s::timestamp IS NULL OR fecha_movimiento < %(hasta)s)
             GROUP BY DATE(fecha_movimiento)
-            ORDER BY fecha DESC
-            LIMIT 7
-        """)
-        ventas_reales = cur.fetchall()
+        """, {"desde": rango_desde, "hasta": rango_hasta})
+        
+        ventas_por_fecha = dict(historico.ventas_por_dia(conn, rango_desde, rango_hasta))
+        for venta in cur.fetchall():
+            ventas_por_fecha[venta["fecha"]] = ventas_por_fecha.get(venta["fecha"], 0) + (venta["ventas_dia"] or 0)
+        
+        ventas_reales = [
+            {"fecha": fecha, "ventas_dia": ventas_por_fecha[fecha]}
+            for fecha in sorted(ventas_por_fecha, reverse=True)
+        ]
+        if desde is None:
+            ventas_reales = ventas_reales[:7]
         
         # Si no hay ventas reales, generar datos de ejemplo basados en productos
         if not ventas_reales:
@@ -1160,8 +1900,8 @@ async def obtener_ventas_reporte():
         
         return ventas_reales
         
-    except Exception as e:
-        print(f"Error obteniendo ventas: {e}")
+    except Exception:
+        logger.exception("Error obteniendo ventas")
         return []
     finally:
         conn.close()
@@ -1190,14 +1930,14 @@ async def obtener_stock_critico_reporte():
         """)
         return cur.fetchall()
         
-    except Exception as e:
-        print(f"Error obteniendo stock crítico: {e}")
+    except Exception:
+        logger.exception("Error obteniendo stock crítico")
         return []
     finally:
         conn.close()
 
 @app.get("/reportes/productos-mas-vendidos")
-async def obtener_productos_mas_vendidos_reporte():
+async def obtener_productos_mas_vendidos_reporte(desde: date = Query(None), hasta: date = Query(None)):
     conn = get_db()
     if not conn:
         return []
@@ -1205,22 +1945,22 @@ async def obtener_productos_mas_vendidos_reporte():
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         
-        cur.execute("""
+        cur.execute(f"""
             SELECT 
                 p.nombre as producto,
-                COALESCE(SUM(mi.cantidad), 0) as vendidos,
-                COALESCE(SUM(mi.cantidad * p.precio_venta), 0) as ingresos
+                COALESCE(v.vendidos, 0) as vendidos,
+                COALESCE(v.ingresos, 0) as ingresos,
+                COALESCE(v.margen, 0) as margen
             FROM productos p
-            LEFT JOIN movimientos_inventario mi ON p.id = mi.producto_id AND mi.tipo_movimiento = 'salida'
+            LEFT JOIN ({SQL_VENDIDOS_POR_PRODUCTO}) v ON v.producto_id = p.id
             WHERE p.activo = true
-            GROUP BY p.id, p.nombre
             ORDER BY vendidos DESC
             LIMIT 5
-        """)
+        """, parametros_vendidos(conn, *rango_fechas(desde, hasta)))
         return cur.fetchall()
         
-    except Exception as e:
-        print(f"Error obteniendo productos más vendidos: {e}")
+    except Exception:
+        logger.exception("Error obteniendo productos más vendidos")
         return []
     finally:
         conn.close()
@@ -1242,8 +1982,8 @@ async def obtener_configuraciones():
         config_dict = {config['clave']: config['valor'] for config in configs}
         return config_dict
         
-    except Exception as e:
-        print(f"Error obteniendo configuraciones: {e}")
+    except Exception:
+        logger.exception("Error obteniendo configuraciones")
         return {}
     finally:
         conn.close()
@@ -1295,6 +2035,176 @@ async def actualizar_configuraciones_multiples(configs: List[ConfiguracionBase])
     finally:
         conn.close()
 
+# ==================== RUTAS DE EXPORTACIÓN ====================
+
+@app.get("/exportaciones/{tabla}")
+def exportar_tabla(
+    tabla: str,
+    usuario_id: int = Query(...),
+    formato: str = Query("csv", description="csv o parquet"),
+    desde: date = Query(None),
+    hasta: date = Query(None)
+):
+    """Descarga ``productos``, ``movimientos``, ``auditoria`` o ``cierres`` en streaming, filtrados por fecha."""
+    exigir_administrador(usuario_id)
+    if tabla not in TABLAS_EXPORTACION:
+        raise HTTPException(status_code=404, detail=f"Tabla no exportable; opciones: {', '.join(TABLAS_EXPORTACION)}")
+    if formato not in FORMATOS_EXPORTACION:
+        raise HTTPException(status_code=400, detail=f"formato debe ser uno de: {', '.join(FORMATOS_EXPORTACION)}")
+    if formato == "parquet" and not PARQUET_DISPONIBLE:
+        raise HTTPException(status_code=501, detail="Exportación Parquet no disponible: falta instalar pyarrow")
+    if desde and hasta and desde > hasta:
+        raise HTTPException(status_code=400, detail="desde no puede ser posterior a hasta")
+    
+    conn = get_db()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
+    
+    try:
+        if tabla == "movimientos":
+            # Los movimientos anteriores al corte están solo en el archivo Parquet: un
+            # rango que empiece antes saldría incompleto sin avisar
+            archivado_hasta = historico.corte(conn)
+            if archivado_hasta is not None:
+                if desde is not None and datetime.combine(desde, datetime.min.time()) < archivado_hasta:
+                    raise HTTPException(status_code=400, detail=f"Los movimientos anteriores al {archivado_hasta.date()} están en el archivo histórico; usar desde >= {archivado_hasta.date()}")
+                if hasta is not None and datetime.combine(hasta + timedelta(days=1), datetime.min.time()) <= archivado_hasta:
+                    raise HTTPException(status_code=400, detail=f"Los movimientos anteriores al {archivado_hasta.date()} están en el archivo histórico")
+                # Sin rango, la exportación empieza donde termina el archivo histórico
+                if desde is None:
+                    desde = archivado_hasta
+        
+        exportar = exportar_parquet if formato == "parquet" else exportar_csv
+        respuesta = exportar(conn, tabla, desde, hasta)
+        # La respuesta se queda con la conexión y la cierra al terminar de enviar
+        conn = None
+        logger.info("Exportación iniciada", extra={"campos": {"tabla": tabla, "formato": formato, "desde": str(desde), "hasta": str(hasta), "usuario_id": usuario_id}})
+        return respuesta
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error iniciando exportación")
+        raise HTTPException(status_code=500, detail=f"Error exportando {tabla}: {str(e)}")
+    finally:
+        if conn is not None:
+            conn.close()
+
+# ==================== RUTAS DE DIAGNÓSTICO ====================
+
+@app.get("/admin/consultas-lentas")
+def obtener_consultas_lentas(usuario_id: int = Query(...)):
+    exigir_administrador(usuario_id)
+    return {
+        "umbral_ms": consultas_lentas.UMBRAL_SEGUNDOS * 1000,
+        "captura_plan": consultas_lentas.CAPTURAR_PLAN,
+        "consultas": consultas_lentas.registro.listar()
+    }
+
+@app.delete("/admin/consultas-lentas")
+def limpiar_consultas_lentas(usuario_id: int = Query(...)):
+    exigir_administrador(usuario_id)
+    consultas_lentas.registro.limpiar()
+    return {"success": True, "mensaje": "Registro de consultas lentas vaciado"}
+
+@app.get("/admin/registro/nivel")
+def obtener_nivel_registro(usuario_id: int = Query(...)):
+    exigir_administrador(usuario_id)
+    return {"nivel": nivel_actual()}
+
+@app.post("/admin/registro/nivel")
+def actualizar_nivel_registro(nivel: str = Query(...), usuario_id: int = Query(...)):
+    """Cambia el nivel de registro de todos los workers sin reiniciar (p. ej. DEBUG para trazar filas)."""
+    exigir_administrador(usuario_id)
+    conn = get_db()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
+    
+    try:
+        nivel = guardar_nivel(conn, nivel)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error guardando el nivel de registro")
+        raise HTTPException(status_code=500, detail=f"Error guardando el nivel de registro: {str(e)}")
+    finally:
+        conn.close()
+    logger.warning("Nivel de registro cambiado", extra={"campos": {"nivel": nivel, "usuario_id": usuario_id}})
+    return {"success": True, "nivel": nivel}
+
+@app.post("/admin/auditoria/mantenimiento")
+def mantener_auditoria(usuario_id: int = Query(...)):
+    """Corre ya el mantenimiento de auditoría: particiones adelantadas, compactación y retención."""
+    exigir_administrador(usuario_id)
+    conn = get_db()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Error de conexión a PostgreSQL")
+    
+    try:
+        resumen = particiones_auditoria.mantener(conn)
+        if resumen is None:
+            raise HTTPException(status_code=409, detail="El mantenimiento de auditoría ya está en curso")
+        logger.info("Mantenimiento de auditoría", extra={"campos": dict(resumen, usuario_id=usuario_id)})
+        return {"success": True, **resumen}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error en el mantenimiento de auditoría")
+        raise HTTPException(status_code=500, detail=f"Error en el mantenimiento de auditoría: {str(e)}")
+    finally:
+        conn.close()
+
+@app.post("/admin/perfilado")
+def armar_perfilado(
+    ruta: str = Query(..., description="Plantilla de la ruta, p. ej. /productos/{producto_id}/movimientos"),
+    usuario_id: int = Query(...),
+    peticiones: int = Query(1, ge=1, le=100),
+    cpu: str = Query("determinista", description="determinista (cProfile), muestreo (pilas) o ninguno"),
+    memoria: bool = Query(False)
+):
+    """Perfila las próximas ``peticiones`` que lleguen a ``ruta`` en este proceso."""
+    exigir_administrador(usuario_id)
+    if cpu not in MODOS_CPU:
+        raise HTTPException(status_code=400, detail=f"cpu debe ser uno de: {', '.join(MODOS_CPU)}")
+    if cpu == "ninguno" and not memoria:
+        raise HTTPException(status_code=400, detail="Nada que perfilar: activa cpu o memoria")
+    control_perfilado.armar(ruta, peticiones, cpu, memoria)
+    logger.warning("Perfilado armado", extra={"campos": {"ruta": ruta, "peticiones": peticiones, "cpu": cpu, "memoria": memoria, "usuario_id": usuario_id}})
+    return {"success": True, "armados": control_perfilado.armados()}
+
+@app.delete("/admin/perfilado")
+def desarmar_perfilado(usuario_id: int = Query(...), ruta: str = Query(None)):
+    exigir_administrador(usuario_id)
+    control_perfilado.desarmar(ruta)
+    return {"success": True, "armados": control_perfilado.armados()}
+
+@app.get("/admin/perfilado")
+def listar_perfilados(usuario_id: int = Query(...)):
+    exigir_administrador(usuario_id)
+    return {"armados": control_perfilado.armados(), "resultados": control_perfilado.resumen()}
+
+@app.get("/admin/perfilado/{perfil_id}")
+def descargar_perfilado(perfil_id: int, usuario_id: int = Query(...), formato: str = Query("pstats")):
+    """Descarga un perfil: ``pstats`` (cProfile), ``flamegraph`` (pilas colapsadas) o ``memoria``."""
+    exigir_administrador(usuario_id)
+    resultado = control_perfilado.obtener(perfil_id)
+    if not resultado:
+        raise HTTPException(status_code=404, detail="Perfil no encontrado")
+    
+    if formato == "pstats" and "pstats" in resultado:
+        return Response(
+            resultado["pstats"],
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="perfil_{perfil_id}.pstats"'}
+        )
+    if formato == "flamegraph" and "colapsado" in resultado:
+        return PlainTextResponse(
+            resultado["colapsado"],
+            headers={"Content-Disposition": f'attachment; filename="perfil_{perfil_id}.folded"'}
+        )
+    if formato == "memoria" and "memoria_top" in resultado:
+        return PlainTextResponse(f"Pico: {resultado['memoria_pico_kb']} KB\n\n{resultado['memoria_top']}")
+    raise HTTPException(status_code=400, detail=f"El perfil {perfil_id} no tiene formato {formato}")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,283 @@
+"""Motor de cambios de stock.
+
+Todas las modificaciones de ``productos.stock_actual`` pasan por este módulo.
+Cada cambio es un ``UPDATE`` atómico que calcula el nuevo valor dentro de
+PostgreSQL (nunca leer-calcular-escribir en Python), de modo que dos
+peticiones concurrentes no pueden pisarse. Cuando una operación toca varios
+productos, las filas se bloquean siempre en orden de ``id`` para evitar
+interbloqueos, y ``ejecutar_transaccion`` reintenta la transacción completa
+si PostgreSQL la aborta por serialización o deadlock.
+"""
+import random
+import time
+
+from psycopg2.extensions import TransactionRollbackError
+from psycopg2.extras import execute_values
+
+from observabilidad import trazas
+
+MAX_REINTENTOS = 5
+ESPERA_BASE_SEGUNDOS = 0.02
+TAMANO_LOTE = 1000
+
+
+class ProductoNoEncontrado(Exception):
+    def __init__(self, producto_id):
+        super().__init__(f"Producto {producto_id} no encontrado")
+        self.producto_id = producto_id
+
+
+class StockInsuficiente(Exception):
+    def __init__(self, producto_id, solicitado, disponible):
+        super().__init__(f"No hay suficiente stock. Stock actual: {disponible}")
+        self.producto_id = producto_id
+        self.solicitado = solicitado
+        self.disponible = disponible
+
+
+def ejecutar_transaccion(conn, operacion, reintentos=MAX_REINTENTOS):
+    """Ejecuta ``operacion(conn)`` y hace commit, reintentando ante conflictos.
+
+    ``operacion`` debe ser repetible: ante un ``TransactionRollbackError``
+    (serialización o deadlock) se hace rollback y se vuelve a ejecutar desde
+    el principio con una espera exponencial con jitter.
+
+    La espera usa ``time.sleep``: llamarlo solo desde rutas ``def`` (que
+    FastAPI corre en el threadpool), nunca desde una ``async def``.
+    """
+    for intento in range(reintentos):
+        try:
+            with trazas.span("transaccion", operacion=operacion.__name__, intento=intento + 1):
+                resultado = operacion(conn)
+                conn.commit()
+            return resultado
+        except TransactionRollbackError:
+            conn.rollback()
+            if intento == reintentos - 1:
+                raise
+            time.sleep(ESPERA_BASE_SEGUNDOS * (2 ** intento) * random.uniform(0.5, 1.5))
+
+
+def bloquear_productos(conn, producto_ids):
+    """Bloquea las filas de ``producto_ids`` en orden de id ascendente."""
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT id FROM productos WHERE id = ANY(%s) ORDER BY id FOR UPDATE",
+        (sorted(set(producto_ids)),)
+    )
+    return [fila[0] for fila in cur.fetchall()]
+
+
+def registrar_movimiento(conn, producto_id, tipo_movimiento, cantidad, motivo, usuario_id, archivo_origen=None, precio_unitario=None, costo_unitario=None):
+    """Inserta el movimiento con el precio y costo unitario vigentes.
+
+    Si no se indican, se toman del producto (precio de venta y costo promedio
+    ponderado) en el mismo ``INSERT ... SELECT``,
+    de modo que los reportes de ingresos no dependen de cambios de precio
+    posteriores. También guarda el stock actual como ``stock_resultante``, así
+    que se llama después de actualizar el stock, con la fila bloqueada.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO movimientos_inventario (producto_id, tipo_movimiento, cantidad, motivo, usuario_id, archivo_origen, precio_unitario, costo_unitario, stock_resultante)
+        SELECT id, %s, %s, %s, %s, %s, COALESCE(%s, precio_venta), COALESCE(%s, costo_promedio, precio_compra), stock_actual
+        FROM productos WHERE id = %s
+        """,
+        (tipo_movimiento, cantidad, motivo, usuario_id, archivo_origen, precio_unitario, costo_unitario, producto_id)
+    )
+
+
+def descontar_stock(conn, producto_id, cantidad, motivo, usuario_id):
+    """Resta ``cantidad`` del stock solo si alcanza y registra la salida.
+
+    Devuelve el nuevo stock. Lanza ``StockInsuficiente`` o
+    ``ProductoNoEncontrado`` sin modificar nada.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE productos SET stock_actual = stock_actual - %s WHERE id = %s AND stock_actual >= %s RETURNING stock_actual",
+        (cantidad, producto_id, cantidad)
+    )
+    fila = cur.fetchone()
+
+    if fila is None:
+        cur.execute("SELECT stock_actual FROM productos WHERE id = %s", (producto_id,))
+        actual = cur.fetchone()
+        if actual is None:
+            raise ProductoNoEncontrado(producto_id)
+        raise StockInsuficiente(producto_id, cantidad, actual[0])
+
+    registrar_movimiento(conn, producto_id, 'salida', cantidad, motivo, usuario_id)
+    return fila[0]
+
+
+def reponer_stock(conn, producto_id, cantidad):
+    """Suma ``cantidad`` al stock (p. ej. al revertir una salida)."""
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE productos SET stock_actual = stock_actual + %s WHERE id = %s RETURNING stock_actual",
+        (cantidad, producto_id)
+    )
+    fila = cur.fetchone()
+    if fila is None:
+        raise ProductoNoEncontrado(producto_id)
+    return fila[0]
+
+
+def retirar_stock_lote(conn, cantidades, costos=None):
+    """Resta varias cantidades ``{producto_id: cantidad}`` sin bajar de cero.
+
+    Usado al revertir entradas: las filas se bloquean en orden de id y luego se
+    actualizan todas en una sola sentencia. Devuelve ``{producto_id: nuevo_stock}``.
+
+    ``costos`` (``{producto_id: cantidad * costo_unitario}`` de las entradas que
+    se revierten) saca esas entradas del costo promedio ponderado:
+    ``(stock * promedio - costo) / (stock - cantidad)``. Si no queda stock, o no
+    se conoce el costo, el promedio no cambia.
+    """
+    if not cantidades:
+        return {}
+
+    bloquear_productos(conn, cantidades.keys())
+
+    ids = sorted(cantidades)
+    costos = costos or {}
+    cur = conn.cursor()
+    cur.execute(
+        """
+        UPDATE productos p
+        SET stock_actual = GREATEST(p.stock_actual - v.cantidad, 0),
+            costo_promedio = CASE
+                WHEN v.costo IS NOT NULL AND p.stock_actual - v.cantidad > 0 THEN
+                    (p.stock_actual * COALESCE(p.costo_promedio, p.precio_compra) - v.costo) / (p.stock_actual - v.cantidad)
+                ELSE p.costo_promedio
+            END
+        FROM unnest(%s::int[], %s::int[], %s::numeric[]) AS v(id, cantidad, costo)
+        WHERE p.id = v.id
+        RETURNING p.id, p.stock_actual
+        """,
+        (ids, [cantidades[producto_id] for producto_id in ids], [costos.get(producto_id) for producto_id in ids])
+    )
+    return dict(cur.fetchall())
+
+
+def ingresar_cierre(conn, productos, usuario_id, nombre_archivo):
+    """Suma al stock las cantidades de un cierre diario, creando productos nuevos.
+
+    Las filas con el mismo código se agrupan y todos los productos se
+    actualizan con un único ``INSERT ... ON CONFLICT DO UPDATE`` en orden de
+    código, después de bloquear los existentes en orden de id; así dos cierres
+    simultáneos, aunque traigan el mismo código nuevo, no se pisan. En la misma
+    sentencia se actualiza el costo promedio ponderado con el costo de compra
+    de la entrada (O(1) por producto, sin recorrer movimientos anteriores).
+    Los movimientos se insertan en lotes de ``TAMANO_LOTE``, uno por fila del
+    CSV, de modo que el número de sentencias no crece fila a fila.
+
+    Devuelve una lista de ``(producto, producto_id, nuevo_stock, creado,
+    cantidad)`` con una entrada por código, en el orden en que aparece en el
+    CSV; ``cantidad`` es la suma de todas las filas del código, la que
+    realmente se ingresó.
+    """
+    if not productos:
+        return []
+
+    cur = conn.cursor()
+    codigos = sorted({producto.codigo for producto in productos})
+    cur.execute("SELECT id FROM productos WHERE codigo = ANY(%s)", (codigos,))
+    bloquear_productos(conn, [fila[0] for fila in cur.fetchall()])
+
+    # Agrupar por código: la última fila manda en nombre y precios, las
+    # cantidades se suman y el costo entrante es el promedio ponderado de las filas
+    agrupados = {}
+    for producto in productos:
+        grupo = agrupados.setdefault(producto.codigo, {"cantidad": 0, "costo_total": 0.0})
+        grupo["producto"] = producto
+        grupo["cantidad"] += producto.cantidad
+        grupo["costo_total"] += producto.cantidad * producto.precio_compra
+
+    filas = []
+    for codigo in codigos:
+        grupo = agrupados[codigo]
+        producto = grupo["producto"]
+        costo_entrada = grupo["costo_total"] / grupo["cantidad"] if grupo["cantidad"] else producto.precio_compra
+        filas.append((codigo, producto.nombre, producto.categoria, producto.precio_compra, producto.precio_venta, grupo["cantidad"], costo_entrada))
+
+    filas_actualizadas = execute_values(
+        cur,
+        """
+        INSERT INTO productos (codigo, nombre, categoria, precio_compra, precio_venta, stock_actual, costo_promedio)
+        VALUES %s
+        ON CONFLICT (codigo) DO UPDATE
+        SET stock_actual = productos.stock_actual + EXCLUDED.stock_actual,
+            precio_compra = EXCLUDED.precio_compra,
+            precio_venta = EXCLUDED.precio_venta,
+            costo_promedio = CASE
+                WHEN GREATEST(productos.stock_actual, 0) + EXCLUDED.stock_actual > 0 THEN
+                    (GREATEST(productos.stock_actual, 0) * COALESCE(productos.costo_promedio, productos.precio_compra, EXCLUDED.costo_promedio)
+                     + EXCLUDED.stock_actual * EXCLUDED.costo_promedio)
+                    / (GREATEST(productos.stock_actual, 0) + EXCLUDED.stock_actual)
+                ELSE EXCLUDED.precio_compra
+            END
+        RETURNING codigo, id, stock_actual, (xmax = 0) AS creado
+        """,
+        filas,
+        page_size=TAMANO_LOTE,
+        fetch=True
+    )
+    por_codigo = {codigo: (producto_id, nuevo_stock, creado) for codigo, producto_id, nuevo_stock, creado in filas_actualizadas}
+
+    # Stock resultante de cada fila: las filas de un código se sumaron juntas, así
+    # que se reconstruye hacia atrás desde el stock final
+    restante = {codigo: nuevo_stock for codigo, (_, nuevo_stock, _) in por_codigo.items()}
+    stocks_resultantes = []
+    for producto in reversed(productos):
+        stocks_resultantes.append(restante[producto.codigo])
+        restante[producto.codigo] -= producto.cantidad
+    stocks_resultantes.reverse()
+
+    execute_values(
+        cur,
+        """
+        INSERT INTO movimientos_inventario (producto_id, tipo_movimiento, cantidad, motivo, usuario_id, archivo_origen, precio_unitario, costo_unitario, stock_resultante)
+        VALUES %s
+        """,
+        [
+            (por_codigo[producto.codigo][0], 'entrada', producto.cantidad, 'Cierre diario CSV', usuario_id, nombre_archivo, producto.precio_venta, producto.precio_compra, stock_resultante)
+            for producto, stock_resultante in zip(productos, stocks_resultantes)
+        ],
+        page_size=TAMANO_LOTE
+    )
+
+    resultados = []
+    for codigo in dict.fromkeys(producto.codigo for producto in productos):
+        producto_id, nuevo_stock, creado = por_codigo[codigo]
+        resultados.append((agrupados[codigo]["producto"], producto_id, nuevo_stock, creado, agrupados[codigo]["cantidad"]))
+    return resultados
+
+
+def tomar_snapshot_stock(conn, cierre_id=None):
+    """Guarda el stock actual de todos los productos en ``snapshots_stock``.
+
+    ``LOCK TABLE ... IN SHARE MODE`` espera a que terminen las escrituras de
+    stock en curso y bloquea las nuevas hasta el commit; así cada fila de
+    ``historial_stock`` queda estrictamente antes o después del snapshot
+    (ambos usan ``clock_timestamp()``) y ``/inventario/al`` puede sumar solo
+    los cambios posteriores.
+
+    Tiene que ser lo primero de su transacción: si la transacción ya escribió
+    en ``productos`` tiene ROW EXCLUSIVE, y subir a SHARE mientras otra hace lo
+    mismo es un interbloqueo seguro.
+    """
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE productos IN SHARE MODE")
+    cur.execute(
+        "INSERT INTO snapshots_stock (cierre_id, fecha_snapshot) VALUES (%s, clock_timestamp()) RETURNING id",
+        (cierre_id,)
+    )
+    snapshot_id = cur.fetchone()[0]
+    cur.execute(
+        "INSERT INTO snapshots_stock_detalle (snapshot_id, producto_id, stock) SELECT %s, id, stock_actual FROM productos WHERE COALESCE(stock_actual, 0) <> 0",
+        (snapshot_id,)
+    )
+    return snapshot_id
@@ -0,0 +1 @@
+"""Instrumentación del backend: métricas, consultas a la base de datos y diagnóstico."""
@@ -0,0 +1,173 @@
+"""Conexiones psycopg2 instrumentadas.
+
+``ConexionInstrumentada`` entrega cursores que miden cada sentencia y la
+acumulan en las estadísticas de la petición en curso (``contextvars``), sin
+importar qué ``cursor_factory`` pida la ruta. Fuera de una petición las
+sentencias se ejecutan igual pero no se contabilizan.
+
+Las mismas estadísticas pueden devolverse en cabeceras de respuesta
+(``X-BD-Consultas``, ``X-BD-Tiempo-Ms``, ``X-BD-Conexiones``), lo que permite a
+``verificar_maximo_consultas`` detectar regresiones N+1 desde una prueba.
+Las sentencias que superan el umbral pasan a ``observabilidad.consultas_lentas``
+y, si hay una traza en curso, cada conexión y sentencia genera su span.
+"""
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+import psycopg2
+import psycopg2.extensions
+
+from observabilidad import consultas_lentas, trazas
+
+
+CABECERA_CONSULTAS = "x-bd-consultas"
+CABECERA_TIEMPO = "x-bd-tiempo-ms"
+CABECERA_CONEXIONES = "x-bd-conexiones"
+
+# Con BD_CABECERAS=1 todas las respuestas llevan las cabeceras; si no, solo las
+# peticiones que envían la cabecera X-BD-Consultas
+CABECERAS_SIEMPRE = os.getenv("BD_CABECERAS", "0") == "1"
+
+MAX_SQL_SPAN = 1000
+
+
+class ExcesoConsultas(AssertionError):
+    pass
+
+
+class EstadisticasConsultas:
+    __slots__ = ("consultas", "tiempo", "conexiones", "ruta")
+
+    def __init__(self, ruta=None):
+        self.consultas = 0
+        self.tiempo = 0.0
+        self.conexiones = 0
+        self.ruta = ruta
+
+    def cabeceras(self):
+        return [
+            (CABECERA_CONSULTAS.encode(), str(self.consultas).encode()),
+            (CABECERA_TIEMPO.encode(), f"{self.tiempo * 1000:.1f}".encode()),
+            (CABECERA_CONEXIONES.encode(), str(self.conexiones).encode()),
+        ]
+
+    def registrar(self, duracion):
+        self.consultas += 1
+        self.tiempo += duracion
+
+
+estadisticas_actuales = ContextVar("estadisticas_consultas", default=None)
+
+_conexiones_abiertas = 0
+_candado_conexiones = threading.Lock()
+
+
+def conexiones_abiertas():
+    return _conexiones_abiertas
+
+
+def _medir(cursor, query, parametros, llamada):
+    estadisticas = estadisticas_actuales.get()
+    if estadisticas is None:
+        return llamada()
+
+    padre = trazas.span_actual.get()
+    span = padre.hijo("bd.consulta", sql=consultas_lentas.normalizar_sql(cursor, query)[:MAX_SQL_SPAN]) if padre else None
+    inicio = time.perf_counter()
+    exito = False
+    error = None
+    try:
+        resultado = llamada()
+        exito = True
+        return resultado
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        duracion = time.perf_counter() - inicio
+        estadisticas.registrar(duracion)
+        if span is not None:
+            span.atributos["filas"] = cursor.rowcount
+            span.terminar(error)
+        if duracion >= consultas_lentas.UMBRAL_SEGUNDOS:
+            consultas_lentas.revisar(cursor, query, parametros, duracion, estadisticas.ruta, exito)
+
+
+class _MixinCursorInstrumentado:
+    def execute(self, query, vars=None):
+        return _medir(self, query, vars, lambda: super(_MixinCursorInstrumentado, self).execute(query, vars))
+
+    def executemany(self, query, vars_list):
+        return _medir(self, query, None, lambda: super(_MixinCursorInstrumentado, self).executemany(query, vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        return _medir(self, sql, None, lambda: super(_MixinCursorInstrumentado, self).copy_expert(sql, file, size))
+
+
+_clases_instrumentadas = {}
+
+
+def _clase_instrumentada(base):
+    clase = _clases_instrumentadas.get(base)
+    if clase is None:
+        clase = type(f"{base.__name__}Instrumentado", (_MixinCursorInstrumentado, base), {})
+        _clases_instrumentadas[base] = clase
+    return clase
+
+
+class ConexionInstrumentada(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        global _conexiones_abiertas
+        super().__init__(*args, **kwargs)
+        with _candado_conexiones:
+            _conexiones_abiertas += 1
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _clase_instrumentada(base)
+        return super().cursor(*args, **kwargs)
+
+    def close(self):
+        global _conexiones_abiertas
+        if not self.closed:
+            with _candado_conexiones:
+                _conexiones_abiertas -= 1
+        super().close()
+
+
+def conectar(dsn):
+    estadisticas = estadisticas_actuales.get()
+    if estadisticas is None:
+        return psycopg2.connect(dsn, connection_factory=ConexionInstrumentada)
+
+    # El tiempo de establecer la conexión también cuenta como tiempo de base de datos
+    inicio = time.perf_counter()
+    try:
+        with trazas.span("bd.conexion"):
+            return psycopg2.connect(dsn, connection_factory=ConexionInstrumentada)
+    finally:
+        estadisticas.tiempo += time.perf_counter() - inicio
+        estadisticas.conexiones += 1
+
+
+def verificar_maximo_consultas(cliente, metodo, url, maximo, maximo_conexiones=None, **kwargs):
+    """Hace la petición con ``cliente`` (p. ej. ``TestClient``) y falla si excede el presupuesto.
+
+    Pensado para pruebas (ver ``tests/test_consultas.py``): llamarlo con
+    entradas de distintos tamaños y el mismo ``maximo`` hace que un bucle con
+    una consulta por fila falle.
+    Devuelve la respuesta.
+    """
+    cabeceras = dict(kwargs.pop("headers", None) or {})
+    cabeceras[CABECERA_CONSULTAS] = "1"
+    respuesta = cliente.request(metodo, url, headers=cabeceras, **kwargs)
+
+    consultas = int(respuesta.headers[CABECERA_CONSULTAS])
+    conexiones = int(respuesta.headers[CABECERA_CONEXIONES])
+    if consultas > maximo:
+        raise ExcesoConsultas(f"{metodo} {url}: {consultas} sentencias SQL (máximo {maximo})")
+    if maximo_conexiones is not None and conexiones > maximo_conexiones:
+        raise ExcesoConsultas(f"{metodo} {url}: {conexiones} conexiones (máximo {maximo_conexiones})")
+    return respuesta
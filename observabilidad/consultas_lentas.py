@@ -0,0 +1,107 @@
+"""Registro de consultas lentas.
+
+Cada sentencia que supera ``BD_UMBRAL_LENTA_MS`` se guarda en un buffer
+circular en memoria (``BD_MAX_CONSULTAS_LENTAS`` entradas) con su SQL
+normalizado, los parámetros redactados (solo el tipo de cada valor), la
+duración y la ruta que la ejecutó. Con ``BD_EXPLAIN_LENTAS=1`` también se
+captura el plan con ``EXPLAIN`` (sin ``ANALYZE``, así no se vuelve a ejecutar).
+"""
+import logging
+import os
+import re
+import threading
+from collections import deque
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+
+UMBRAL_SEGUNDOS = float(os.getenv("BD_UMBRAL_LENTA_MS", "200")) / 1000
+CAPTURAR_PLAN = os.getenv("BD_EXPLAIN_LENTAS", "0") == "1"
+MAX_CONSULTAS = int(os.getenv("BD_MAX_CONSULTAS_LENTAS", "100"))
+
+_SENTENCIAS_EXPLICABLES = ("select", "insert", "update", "delete", "with")
+
+logger = logging.getLogger("el_unificador.bd")
+
+
+class RegistroConsultasLentas:
+    def __init__(self, maximo=MAX_CONSULTAS):
+        self._candado = threading.Lock()
+        self._consultas = deque(maxlen=maximo)
+
+    def agregar(self, entrada):
+        with self._candado:
+            self._consultas.append(entrada)
+
+    def listar(self):
+        with self._candado:
+            return list(reversed(self._consultas))
+
+    def limpiar(self):
+        with self._candado:
+            self._consultas.clear()
+
+
+registro = RegistroConsultasLentas()
+
+
+def normalizar_sql(cursor, query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        query = query.as_string(cursor)
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def redactar_parametros(parametros):
+    if parametros is None:
+        return None
+    if isinstance(parametros, dict):
+        return {clave: type(valor).__name__ for clave, valor in parametros.items()}
+    return [type(valor).__name__ for valor in parametros]
+
+
+def _capturar_plan(cursor, query, parametros):
+    conn = cursor.connection
+    # Cursor sin instrumentar: el EXPLAIN no debe contarse ni volver a registrarse
+    explicacion = psycopg2.extensions.cursor(conn)
+    en_transaccion = conn.status == psycopg2.extensions.STATUS_IN_TRANSACTION
+    try:
+        if en_transaccion:
+            explicacion.execute("SAVEPOINT explain_consulta_lenta")
+        explicacion.execute(b"EXPLAIN " + cursor.mogrify(query, parametros))
+        plan = "\n".join(fila[0] for fila in explicacion.fetchall())
+        if en_transaccion:
+            explicacion.execute("RELEASE SAVEPOINT explain_consulta_lenta")
+        return plan
+    except psycopg2.Error as e:
+        if en_transaccion:
+            explicacion.execute("ROLLBACK TO SAVEPOINT explain_consulta_lenta")
+        return f"No se pudo obtener el plan: {e}"
+    finally:
+        explicacion.close()
+
+
+def revisar(cursor, query, parametros, duracion, ruta, exito=True):
+    """Registra la sentencia si superó el umbral. Llamado por ``observabilidad.bd``."""
+    if duracion < UMBRAL_SEGUNDOS:
+        return
+
+    sql = normalizar_sql(cursor, query)
+    plan = None
+    # Sin plan si la sentencia falló (la transacción quedó abortada) o si el
+    # cursor tiene nombre (del lado del servidor: no admite sentencias intercaladas)
+    if CAPTURAR_PLAN and exito and cursor.name is None and sql.lower().startswith(_SENTENCIAS_EXPLICABLES):
+        plan = _capturar_plan(cursor, query, parametros)
+
+    registro.agregar({
+        "fecha": datetime.now().isoformat(),
+        "ruta": ruta,
+        "duracion_ms": round(duracion * 1000, 1),
+        "sql": sql,
+        "parametros": redactar_parametros(parametros),
+        "plan": plan,
+        "error": not exito,
+    })
+    logger.warning("Consulta lenta", extra={"campos": {"duracion_ms": round(duracion * 1000, 1), "sql": sql[:500]}})
@@ -0,0 +1,198 @@
+"""Grabación de tráfico real para reproducirlo después.
+
+Con ``GRABACION_ARCHIVO`` definido, ``MiddlewareGrabacion`` guarda cada
+petición (método, ruta, plantilla de ruta, query, cuerpo, instante, duración
+y estado) como una línea JSON. La escritura la hace un ``QueueListener`` en
+segundo plano, como el registro de la aplicación. El archivo rota al superar
+``GRABACION_MAX_MB`` y los archivos rotados se comprimen con gzip
+(``trafico.jsonl.1.gz``, ...), conservando ``GRABACION_RESPALDOS``.
+
+Antes de escribir se sanean los datos: contraseñas, tokens y hashes en
+cuerpos JSON, formularios y en la query se reemplazan por ``REDACTADO``, de
+las cabeceras solo se guarda ``content-type`` y los cuerpos mayores a
+``GRABACION_MAX_CUERPO_KB`` se descartan (la línea queda marcada como
+truncada). De un cuerpo multipart se guardan los campos (saneados) y, de cada
+archivo, solo el nombre y el tamaño: el CSV de un cierre no llega al disco.
+De cualquier otro cuerpo solo se guarda la longitud. Las rutas de diagnóstico
+(``/admin/*``, ``/metrics``) no se graban.
+
+``herramientas.reproducir`` lee estos archivos y vuelve a enviar el tráfico.
+"""
+import atexit
+import email.parser
+import email.policy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+import urllib.parse
+
+from observabilidad.bd import estadisticas_actuales
+
+ARCHIVO = os.getenv("GRABACION_ARCHIVO", "")
+MAX_BYTES = int(float(os.getenv("GRABACION_MAX_MB", "50")) * 1024 * 1024)
+RESPALDOS = int(os.getenv("GRABACION_RESPALDOS", "10"))
+MAX_CUERPO = int(os.getenv("GRABACION_MAX_CUERPO_KB", "1024")) * 1024
+
+REDACTADO = "REDACTADO"
+_CLAVES_SENSIBLES = ("password", "contrasena", "hash_contrasena", "token", "token_acceso", "secret")
+_RUTAS_EXCLUIDAS = ("/admin/", "/metrics")
+
+_grabador = logging.getLogger("el_unificador.grabacion")
+_listener = None
+
+
+def _rotar_comprimiendo(origen, destino):
+    with open(origen, "rb") as entrada, gzip.open(destino, "wb") as salida:
+        shutil.copyfileobj(entrada, salida)
+    os.remove(origen)
+
+
+def configurar_grabacion(archivo=ARCHIVO):
+    global _listener
+    if _listener is not None:
+        return
+
+    manejador = logging.handlers.RotatingFileHandler(archivo, maxBytes=MAX_BYTES, backupCount=RESPALDOS, encoding="utf-8")
+    manejador.namer = lambda nombre: nombre + ".gz"
+    manejador.rotator = _rotar_comprimiendo
+    manejador.setFormatter(logging.Formatter("%(message)s"))
+
+    cola = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(cola, manejador)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    _grabador.addHandler(logging.handlers.QueueHandler(cola))
+    _grabador.setLevel(logging.INFO)
+    _grabador.propagate = False
+
+
+def sanear(valor):
+    if isinstance(valor, dict):
+        return {
+            clave: REDACTADO if clave.lower() in _CLAVES_SENSIBLES else sanear(contenido)
+            for clave, contenido in valor.items()
+        }
+    if isinstance(valor, list):
+        return [sanear(elemento) for elemento in valor]
+    return valor
+
+
+def sanear_query(query):
+    if not query:
+        return ""
+    pares = urllib.parse.parse_qsl(query, keep_blank_values=True)
+    return urllib.parse.urlencode([
+        (clave, REDACTADO if clave.lower() in _CLAVES_SENSIBLES else valor) for clave, valor in pares
+    ])
+
+
+def sanear_multipart(crudo, tipo):
+    """Campos de un cuerpo multipart: ``{"nombre", "valor"}`` o, de los archivos, ``{"nombre", "archivo", "bytes"}``."""
+    mensaje = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {tipo}\r\n\r\n".encode("latin-1") + crudo
+    )
+    if not mensaje.is_multipart():
+        raise ValueError("Cuerpo multipart inválido")
+
+    campos = []
+    for parte in mensaje.iter_parts():
+        nombre = parte.get_param("name", header="content-disposition") or ""
+        contenido = parte.get_payload(decode=True) or b""
+        archivo = parte.get_filename()
+        if archivo is not None:
+            campos.append({"nombre": nombre, "archivo": archivo, "bytes": len(contenido)})
+        elif nombre.lower() in _CLAVES_SENSIBLES:
+            campos.append({"nombre": nombre, "valor": REDACTADO})
+        else:
+            campos.append({"nombre": nombre, "valor": contenido.decode("utf-8", errors="replace")})
+    return campos
+
+
+def _cuerpo(crudo, tipo):
+    """Devuelve (campo, valor) para guardar el cuerpo: ``json``, ``formulario`` o ``multipart`` saneados, o solo ``cuerpo_bytes``."""
+    if not crudo:
+        return None, None
+    if tipo.startswith("application/json"):
+        try:
+            return "json", sanear(json.loads(crudo))
+        except ValueError:
+            pass
+    if tipo.startswith("application/x-www-form-urlencoded"):
+        return "formulario", sanear_query(crudo.decode("latin-1"))
+    if tipo.startswith("multipart/form-data"):
+        try:
+            return "multipart", sanear_multipart(crudo, tipo)
+        except Exception:
+            pass
+    return "cuerpo_bytes", len(crudo)
+
+
+class MiddlewareGrabacion:
+    def __init__(self, app):
+        self.app = app
+        configurar_grabacion()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(_RUTAS_EXCLUIDAS):
+            await self.app(scope, receive, send)
+            return
+
+        partes = []
+        tamano = 0
+        truncado = False
+        estado = {"codigo": None}
+
+        async def recibir():
+            nonlocal tamano, truncado
+            mensaje = await receive()
+            if mensaje["type"] == "http.request" and not truncado:
+                fragmento = mensaje.get("body", b"")
+                tamano += len(fragmento)
+                if tamano > MAX_CUERPO:
+                    truncado = True
+                    partes.clear()
+                else:
+                    partes.append(fragmento)
+            return mensaje
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado["codigo"] = mensaje["status"]
+            await send(mensaje)
+
+        instante = time.time()
+        inicio = time.perf_counter()
+        try:
+            await self.app(scope, recibir, enviar)
+        finally:
+            duracion = time.perf_counter() - inicio
+            estadisticas = estadisticas_actuales.get()
+            tipo = ""
+            for nombre, valor in scope["headers"]:
+                if nombre == b"content-type":
+                    tipo = valor.decode("latin-1")
+                    break
+
+            registro = {
+                "instante": round(instante, 6),
+                "metodo": scope["method"],
+                "ruta": scope["path"],
+                "plantilla": estadisticas.ruta if estadisticas is not None else scope["path"],
+                "query": sanear_query(scope["query_string"].decode("latin-1")),
+                "content_type": tipo,
+                "duracion_ms": round(duracion * 1000, 3),
+                "estado": estado["codigo"],
+            }
+            if truncado:
+                registro["cuerpo_truncado"] = tamano
+            else:
+                campo, valor = _cuerpo(b"".join(partes), tipo)
+                if campo:
+                    registro[campo] = valor
+            _grabador.info(json.dumps(registro, ensure_ascii=False, separators=(",", ":"), default=str))
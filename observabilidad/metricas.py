@@ -0,0 +1,200 @@
+"""Métricas por ruta en formato de exposición de Prometheus.
+
+``MiddlewareMetricas`` es un middleware ASGI puro: etiqueta cada petición con
+la plantilla de la ruta (``/productos/{producto_id}``, no la URL concreta)
+para que la cardinalidad no crezca con los ids, y registra conteos, latencia,
+peticiones en curso, errores y el tiempo y número de sentencias SQL que
+acumuló ``observabilidad.bd`` durante la petición. A pedido añade esas
+estadísticas como cabeceras de la respuesta. Con las trazas activas también
+abre el span raíz de la petición (ver ``observabilidad.trazas``).
+"""
+import threading
+import time
+
+from starlette.routing import Match
+
+from observabilidad.bd import (
+    CABECERA_CONSULTAS,
+    CABECERAS_SIEMPRE,
+    EstadisticasConsultas,
+    conexiones_abiertas,
+    estadisticas_actuales,
+)
+from observabilidad import trazas
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_CONSULTAS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histograma:
+    __slots__ = ("limites", "conteos", "suma", "total")
+
+    def __init__(self, limites):
+        self.limites = limites
+        self.conteos = [0] * len(limites)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.suma += valor
+        self.total += 1
+        for i, limite in enumerate(self.limites):
+            if valor <= limite:
+                self.conteos[i] += 1
+                break
+
+
+class RegistroMetricas:
+    def __init__(self):
+        self._candado = threading.Lock()
+        self.peticiones = {}
+        self.errores = {}
+        self.en_curso = {}
+        self.latencia = {}
+        self.tiempo_bd = {}
+        self.consultas_bd = {}
+
+    def iniciar(self, etiquetas):
+        with self._candado:
+            self.en_curso[etiquetas] = self.en_curso.get(etiquetas, 0) + 1
+
+    def finalizar(self, etiquetas, estado, duracion, estadisticas, error):
+        with self._candado:
+            self.en_curso[etiquetas] -= 1
+            clave_estado = etiquetas + (str(estado),)
+            self.peticiones[clave_estado] = self.peticiones.get(clave_estado, 0) + 1
+            if error:
+                self.errores[etiquetas] = self.errores.get(etiquetas, 0) + 1
+            self._histograma(self.latencia, etiquetas, BUCKETS_SEGUNDOS).observar(duracion)
+            self._histograma(self.tiempo_bd, etiquetas, BUCKETS_SEGUNDOS).observar(estadisticas.tiempo)
+            self._histograma(self.consultas_bd, etiquetas, BUCKETS_CONSULTAS).observar(estadisticas.consultas)
+
+    @staticmethod
+    def _histograma(tabla, etiquetas, limites):
+        histograma = tabla.get(etiquetas)
+        if histograma is None:
+            histograma = tabla[etiquetas] = Histograma(limites)
+        return histograma
+
+    def exportar(self):
+        lineas = []
+        with self._candado:
+            _contador(lineas, "http_peticiones_total", "Peticiones HTTP atendidas", self.peticiones, ("metodo", "ruta", "estado"))
+            _contador(lineas, "http_errores_total", "Peticiones con estado 5xx o excepción", self.errores, ("metodo", "ruta"))
+            _gauge(lineas, "http_peticiones_en_curso", "Peticiones HTTP en curso", self.en_curso, ("metodo", "ruta"))
+            _histogramas(lineas, "http_duracion_segundos", "Latencia de las peticiones HTTP", self.latencia)
+            _histogramas(lineas, "bd_tiempo_por_peticion_segundos", "Tiempo en la base de datos por petición", self.tiempo_bd)
+            _histogramas(lineas, "bd_consultas_por_peticion", "Sentencias SQL por petición", self.consultas_bd)
+        _gauge(lineas, "bd_conexiones_abiertas", "Conexiones a PostgreSQL abiertas en este proceso", {(): conexiones_abiertas()}, ())
+        return "\n".join(lineas) + "\n"
+
+
+def _formatear_etiquetas(nombres, valores):
+    if not nombres:
+        return ""
+    pares = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pares.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(pares) + "}"
+
+
+def _contador(lineas, nombre, ayuda, valores, nombres):
+    lineas.append(f"# HELP {nombre} {ayuda}")
+    lineas.append(f"# TYPE {nombre} counter")
+    for etiquetas, valor in sorted(valores.items()):
+        lineas.append(f"{nombre}{_formatear_etiquetas(nombres, etiquetas)} {valor}")
+
+
+def _gauge(lineas, nombre, ayuda, valores, nombres):
+    lineas.append(f"# HELP {nombre} {ayuda}")
+    lineas.append(f"# TYPE {nombre} gauge")
+    for etiquetas, valor in sorted(valores.items()):
+        lineas.append(f"{nombre}{_formatear_etiquetas(nombres, etiquetas)} {valor}")
+
+
+def _histogramas(lineas, nombre, ayuda, histogramas):
+    lineas.append(f"# HELP {nombre} {ayuda}")
+    lineas.append(f"# TYPE {nombre} histogram")
+    for (metodo, ruta), histograma in sorted(histogramas.items()):
+        acumulado = 0
+        for limite, conteo in zip(histograma.limites, histograma.conteos):
+            acumulado += conteo
+            etiquetas = _formatear_etiquetas(("metodo", "ruta", "le"), (metodo, ruta, limite))
+            lineas.append(f"{nombre}_bucket{etiquetas} {acumulado}")
+        etiquetas = _formatear_etiquetas(("metodo", "ruta", "le"), (metodo, ruta, "+Inf"))
+        lineas.append(f"{nombre}_bucket{etiquetas} {histograma.total}")
+        etiquetas = _formatear_etiquetas(("metodo", "ruta"), (metodo, ruta))
+        lineas.append(f"{nombre}_sum{etiquetas} {histograma.suma}")
+        lineas.append(f"{nombre}_count{etiquetas} {histograma.total}")
+
+
+registro = RegistroMetricas()
+
+
+def plantilla_ruta(app, scope):
+    """Devuelve la plantilla de la ruta que atenderá ``scope`` (o ``sin_ruta``)."""
+    for ruta in app.routes:
+        coincidencia, _ = ruta.matches(scope)
+        if coincidencia == Match.FULL:
+            return ruta.path
+    return "sin_ruta"
+
+
+class MiddlewareMetricas:
+    def __init__(self, app, registro=registro):
+        self.app = app
+        self.registro = registro
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        aplicacion = scope.get("app")
+        ruta = plantilla_ruta(aplicacion, scope) if aplicacion is not None else scope["path"]
+        etiquetas = (scope["method"], ruta)
+        estado = {"codigo": 500}
+        estadisticas = EstadisticasConsultas(ruta)
+        con_cabeceras = CABECERAS_SIEMPRE or any(
+            nombre == CABECERA_CONSULTAS.encode() for nombre, _ in scope["headers"]
+        )
+
+        raiz = trazas.iniciar_traza(
+            scope["headers"], f"{scope['method']} {ruta}",
+            {"http.method": scope["method"], "http.route": ruta, "http.target": scope["path"]}
+        )
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                estado["codigo"] = mensaje["status"]
+                if con_cabeceras:
+                    mensaje["headers"] = list(mensaje.get("headers", [])) + estadisticas.cabeceras()
+                if raiz is not None:
+                    mensaje["headers"] = list(mensaje.get("headers", [])) + [(b"traceparent", raiz.traceparent().encode())]
+            await send(mensaje)
+
+        token = estadisticas_actuales.set(estadisticas)
+        token_traza = trazas.span_actual.set(raiz)
+        self.registro.iniciar(etiquetas)
+        inicio = time.perf_counter()
+        error = False
+        excepcion = None
+        try:
+            await self.app(scope, receive, enviar)
+        except Exception as e:
+            error = True
+            excepcion = e
+            raise
+        finally:
+            duracion = time.perf_counter() - inicio
+            trazas.span_actual.reset(token_traza)
+            estadisticas_actuales.reset(token)
+            error = error or estado["codigo"] >= 500
+            self.registro.finalizar(etiquetas, estado["codigo"], duracion, estadisticas, error)
+            if raiz is not None:
+                raiz.atributos["http.status_code"] = estado["codigo"]
+                raiz.atributos["bd.consultas"] = estadisticas.consultas
+                if excepcion is None and error:
+                    raiz.error = f"HTTP {estado['codigo']}"
+                raiz.terminar(excepcion)
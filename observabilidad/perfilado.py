@@ -0,0 +1,326 @@
+"""Perfilado de CPU y memoria bajo demanda.
+
+Un administrador arma el perfilado para las próximas N peticiones de una
+ruta (``armar``). ``MiddlewarePerfilado`` envuelve esas peticiones con:
+
+- ``determinista``: ``cProfile``; el resultado se descarga como archivo pstats.
+- ``muestreo``: un hilo que toma la pila del hilo que ejecuta la petición cada
+  ``INTERVALO_MUESTREO`` segundos; se descarga en formato de pilas colapsadas
+  (``flamegraph.pl``, speedscope).
+- ``memoria``: ``tracemalloc`` con las líneas que más memoria asignaron.
+
+El handler de una ruta ``def`` corre en un hilo del threadpool, no en el del
+event loop, así que el middleware no puede perfilarlo desde afuera: deja la
+sesión en ``sesion_actual`` y ``RutaPerfilada`` (la clase de ruta de la app)
+envuelve cada endpoint para activarla en el hilo donde corre. En rutas
+``async`` el perfil se activa solo durante los pasos de la corrutina del
+handler, y no mientras el event loop atiende otras peticiones. ``tracemalloc``
+sí es global al proceso: el pico de memoria incluye lo que corra en paralelo.
+
+Sin perfilado armado el middleware solo consulta un booleano.
+"""
+import cProfile
+import functools
+import inspect
+import io
+import itertools
+import marshal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from fastapi.routing import APIRoute
+
+from observabilidad.bd import estadisticas_actuales
+
+MODOS_CPU = ("determinista", "muestreo", "ninguno")
+INTERVALO_MUESTREO = 0.005
+MAX_RESULTADOS = 20
+LINEAS_MEMORIA = 25
+
+
+class MuestreadorPila:
+    """Muestrea las pilas de los hilos agregados, solo mientras están agregados."""
+
+    def __init__(self, intervalo=INTERVALO_MUESTREO):
+        self.intervalo = intervalo
+        self.pilas = {}
+        self.hilos = set()
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ejecutar, name="muestreador-perfilado", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._hilo.join()
+
+    def _ejecutar(self):
+        while not self._detener.wait(self.intervalo):
+            marcos = sys._current_frames()
+            for hilo_id in list(self.hilos):
+                marco = marcos.get(hilo_id)
+                if marco is None:
+                    continue
+                pila = []
+                while marco is not None:
+                    codigo = marco.f_code
+                    pila.append(f"{codigo.co_name} ({codigo.co_filename}:{codigo.co_firstlineno})")
+                    marco = marco.f_back
+                clave = ";".join(reversed(pila))
+                self.pilas[clave] = self.pilas.get(clave, 0) + 1
+
+    def colapsado(self):
+        return "".join(f"{pila} {conteo}\n" for pila, conteo in sorted(self.pilas.items()))
+
+
+class SesionPerfilado:
+    """Perfil de CPU de una petición, que se activa en el hilo donde corre su handler."""
+
+    def __init__(self, cpu):
+        # cProfile solo ve el hilo donde se llama a enable()
+        self.perfil = cProfile.Profile() if cpu == "determinista" else None
+        self.muestreador = MuestreadorPila() if cpu == "muestreo" else None
+
+    @contextmanager
+    def activa(self):
+        hilo_id = threading.get_ident()
+        if self.muestreador:
+            self.muestreador.hilos.add(hilo_id)
+        if self.perfil:
+            self.perfil.enable()
+        try:
+            yield
+        finally:
+            if self.perfil:
+                self.perfil.disable()
+            if self.muestreador:
+                self.muestreador.hilos.discard(hilo_id)
+
+
+sesion_actual = ContextVar("sesion_perfilado", default=None)
+
+
+def _pasos_perfilados(corrutina, sesion):
+    """Impulsa ``corrutina`` con el perfil activo solo durante cada uno de sus pasos."""
+    valor, error = None, None
+    while True:
+        try:
+            with sesion.activa():
+                paso = corrutina.send(valor) if error is None else corrutina.throw(error)
+        except StopIteration as fin:
+            return fin.value
+        try:
+            valor, error = (yield paso), None
+        except GeneratorExit:
+            corrutina.close()
+            raise
+        except BaseException as e:
+            valor, error = None, e
+
+
+class _CorrutinaPerfilada:
+    def __init__(self, corrutina, sesion):
+        self.corrutina = corrutina
+        self.sesion = sesion
+
+    def __await__(self):
+        return _pasos_perfilados(self.corrutina, self.sesion)
+
+
+def _envolver_endpoint(endpoint):
+    # functools.wraps deja __wrapped__: FastAPI lee la firma del endpoint original
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def envuelto(*args, **kwargs):
+            sesion = sesion_actual.get()
+            if sesion is None:
+                return await endpoint(*args, **kwargs)
+            return await _CorrutinaPerfilada(endpoint(*args, **kwargs), sesion)
+    else:
+        @functools.wraps(endpoint)
+        def envuelto(*args, **kwargs):
+            # El threadpool copia el contexto de la petición, así que la sesión llega hasta aquí
+            sesion = sesion_actual.get()
+            if sesion is None:
+                return endpoint(*args, **kwargs)
+            with sesion.activa():
+                return endpoint(*args, **kwargs)
+    return envuelto
+
+
+class RutaPerfilada(APIRoute):
+    """Ruta cuyo endpoint se perfila en su propio hilo cuando la petición está armada."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _envolver_endpoint(endpoint), **kwargs)
+
+
+class ControlPerfilado:
+    def __init__(self):
+        self._candado = threading.Lock()
+        self._armados = {}
+        self._ids = itertools.count(1)
+        self.resultados = deque(maxlen=MAX_RESULTADOS)
+        # Solo un perfil a la vez: cProfile y tracemalloc son globales al proceso/hilo
+        self._en_curso = threading.Lock()
+        self.activo = False
+
+    def armar(self, ruta, peticiones, cpu, memoria):
+        if cpu not in MODOS_CPU:
+            raise ValueError(f"Modo de CPU inválido: {cpu}")
+        with self._candado:
+            self._armados[ruta] = {"restantes": peticiones, "cpu": cpu, "memoria": memoria}
+            self.activo = True
+
+    def desarmar(self, ruta=None):
+        with self._candado:
+            if ruta is None:
+                self._armados.clear()
+            else:
+                self._armados.pop(ruta, None)
+            self.activo = bool(self._armados)
+
+    def armados(self):
+        with self._candado:
+            return {ruta: dict(config) for ruta, config in self._armados.items()}
+
+    def tomar(self, ruta):
+        """Reserva una de las peticiones armadas para ``ruta``, si queda alguna."""
+        with self._candado:
+            config = self._armados.get(ruta)
+            if config is None:
+                return None
+            config["restantes"] -= 1
+            if config["restantes"] <= 0:
+                del self._armados[ruta]
+                self.activo = bool(self._armados)
+            return config
+
+    def tomar_peticion(self, ruta):
+        """Reserva una petición armada de ``ruta`` y el turno para perfilarla.
+
+        Devuelve la configuración, o None si no hay nada armado para la ruta o
+        ya se está perfilando otra petición. Con configuración hay que llamar
+        a ``liberar`` al terminar.
+        """
+        if not self._en_curso.acquire(blocking=False):
+            return None
+        try:
+            config = self.tomar(ruta)
+        except BaseException:
+            self._en_curso.release()
+            raise
+        if config is None:
+            # Sin retener el turno: una petición larga de otra ruta no debe
+            # hacer que se salte la ruta armada
+            self._en_curso.release()
+        return config
+
+    def liberar(self):
+        self._en_curso.release()
+
+    def guardar(self, resultado):
+        resultado["id"] = next(self._ids)
+        self.resultados.append(resultado)
+        return resultado["id"]
+
+    def obtener(self, resultado_id):
+        for resultado in self.resultados:
+            if resultado["id"] == resultado_id:
+                return resultado
+        return None
+
+    def resumen(self):
+        return [
+            {
+                "id": resultado["id"],
+                "ruta": resultado["ruta"],
+                "fecha": resultado["fecha"],
+                "duracion_ms": resultado["duracion_ms"],
+                "cpu": resultado["cpu"],
+                "memoria_pico_kb": resultado.get("memoria_pico_kb"),
+            }
+            for resultado in reversed(self.resultados)
+        ]
+
+
+control = ControlPerfilado()
+
+
+def _top_memoria(inicial, final):
+    salida = io.StringIO()
+    for estadistica in final.compare_to(inicial, "lineno")[:LINEAS_MEMORIA]:
+        salida.write(f"{estadistica}\n")
+    return salida.getvalue()
+
+
+class MiddlewarePerfilado:
+    def __init__(self, app, control=control):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        if not self.control.activo or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        estadisticas = estadisticas_actuales.get()
+        ruta = estadisticas.ruta if estadisticas is not None else scope["path"]
+        config = self.control.tomar_peticion(ruta)
+        if config is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await self._perfilar(scope, receive, send, ruta, config)
+        finally:
+            self.control.liberar()
+
+    async def _perfilar(self, scope, receive, send, ruta, config):
+        sesion = SesionPerfilado(config["cpu"])
+        perfil = sesion.perfil
+        muestreador = sesion.muestreador
+        inicio_tracemalloc = config["memoria"] and not tracemalloc.is_tracing()
+        if inicio_tracemalloc:
+            tracemalloc.start(10)
+        memoria_inicial = tracemalloc.take_snapshot() if config["memoria"] else None
+        if config["memoria"]:
+            tracemalloc.reset_peak()
+
+        if muestreador:
+            muestreador.iniciar()
+        token = sesion_actual.set(sesion)
+        inicio = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            duracion = time.perf_counter() - inicio
+            sesion_actual.reset(token)
+            if muestreador:
+                muestreador.detener()
+
+            resultado = {
+                "ruta": ruta,
+                "fecha": datetime.now().isoformat(),
+                "duracion_ms": round(duracion * 1000, 1),
+                "cpu": config["cpu"],
+            }
+            if perfil:
+                perfil.create_stats()
+                resultado["pstats"] = marshal.dumps(perfil.stats)
+            if muestreador:
+                resultado["colapsado"] = muestreador.colapsado()
+            if config["memoria"]:
+                memoria_final = tracemalloc.take_snapshot()
+                resultado["memoria_pico_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+                resultado["memoria_top"] = _top_memoria(memoria_inicial, memoria_final)
+                if inicio_tracemalloc:
+                    tracemalloc.stop()
+            self.control.guardar(resultado)
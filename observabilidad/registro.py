@@ -0,0 +1,231 @@
+"""Registro estructurado, por niveles y asíncrono.
+
+``configurar_registro`` instala en el logger ``el_unificador`` un
+``QueueHandler``: el hilo que atiende la petición solo encola el registro y un
+``QueueListener`` en segundo plano lo serializa como una línea JSON y lo
+escribe en stdout. Los mensajes frecuentes se marcan con
+``extra={"muestreo": "<clave>"}`` y solo pasa uno de cada
+``LOG_MUESTREO_CADA`` por ruta y clave. El nivel inicial sale de
+``LOG_NIVEL`` y se puede cambiar en caliente: ``guardar_nivel`` lo deja en
+la tabla ``nivel_registro`` y lo avisa con ``pg_notify``, y el hilo de
+``iniciar_escucha_nivel`` de cada worker lo aplica (también al arrancar), así
+que el cambio llega a todos los procesos y sobrevive a un reinicio. Con las
+trazas activas cada línea lleva el ``trace_id`` de la petición.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import select
+import sys
+import threading
+from datetime import datetime, timezone
+
+from observabilidad import trazas
+from observabilidad.bd import estadisticas_actuales
+
+NOMBRE_LOGGER = "el_unificador"
+MUESTREO_CADA = int(os.getenv("LOG_MUESTREO_CADA", "100"))
+NIVELES = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+CANAL_NIVEL = "log_nivel"
+# Clave en la que se guardaba el nivel dentro de configuraciones_sistema
+CLAVE_NIVEL_ANTERIOR = "log_nivel"
+ESPERA_SEGUNDOS = 5
+
+logger = logging.getLogger(NOMBRE_LOGGER)
+
+_listener = None
+
+
+def _ruta_actual():
+    estadisticas = estadisticas_actuales.get()
+    return estadisticas.ruta if estadisticas is not None else None
+
+
+class FormateadorJSON(logging.Formatter):
+    def format(self, record):
+        datos = {
+            "fecha": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "mensaje": record.getMessage(),
+        }
+        ruta = getattr(record, "ruta", None)
+        if ruta:
+            datos["ruta"] = ruta
+        traza = getattr(record, "traza", None)
+        if traza:
+            datos["traza"] = traza
+        campos = getattr(record, "campos", None)
+        if campos:
+            datos.update(campos)
+        if record.exc_text:
+            datos["excepcion"] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+
+class FiltroMuestreo(logging.Filter):
+    """Deja pasar uno de cada ``cada`` registros con la misma (ruta, clave de muestreo)."""
+
+    def __init__(self, cada=MUESTREO_CADA):
+        super().__init__()
+        self.cada = max(cada, 1)
+        self._conteos = {}
+        self._candado = threading.Lock()
+
+    def filter(self, record):
+        clave = getattr(record, "muestreo", None)
+        if clave is None:
+            return True
+
+        clave = (_ruta_actual(), clave)
+        with self._candado:
+            conteo = self._conteos.get(clave, 0)
+            self._conteos[clave] = conteo + 1
+        if conteo % self.cada:
+            return False
+        record.muestreado = self.cada
+        return True
+
+
+class ManejadorCola(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Se resuelve aquí lo que depende del hilo de la petición (mensaje con
+        # argumentos, traza de la excepción, ruta); el JSON se arma en el listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.ruta = _ruta_actual()
+        record.traza = trazas.traza_actual()
+        if getattr(record, "muestreado", None):
+            record.campos = dict(getattr(record, "campos", None) or {}, muestreo=f"1/{record.muestreado}")
+        return record
+
+
+def configurar_registro():
+    global _listener
+    if _listener is not None:
+        return logger
+
+    cola = queue.SimpleQueue()
+    manejador = ManejadorCola(cola)
+    manejador.addFilter(FiltroMuestreo())
+
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormateadorJSON())
+
+    _listener = logging.handlers.QueueListener(cola, salida)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    logger.addHandler(manejador)
+    logger.setLevel(os.getenv("LOG_NIVEL", "INFO").upper())
+    logger.propagate = False
+    return logger
+
+
+def nivel_actual():
+    return logging.getLevelName(logger.level)
+
+
+def cambiar_nivel(nivel):
+    """Cambia el nivel solo en este proceso."""
+    nivel = nivel.upper()
+    if nivel not in NIVELES:
+        raise ValueError(f"Nivel de registro inválido: {nivel}")
+    logger.setLevel(nivel)
+    return nivel
+
+
+def crear_tabla_nivel(cur):
+    """Tabla de una sola fila con el nivel guardado.
+
+    Va aparte de ``configuraciones_sistema`` para que ``/configuraciones`` no
+    lo muestre ni lo cambie sin validar ni avisar: ``guardar_nivel`` es el único
+    que escribe. Si el nivel estaba guardado como clave de configuración se
+    mueve aquí.
+    """
+    cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS nivel_registro (
+            id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+            nivel VARCHAR(10) NOT NULL CHECK (nivel IN ({", ".join(f"'{nivel}'" for nivel in NIVELES)})),
+            fecha_actualizacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cur.execute("""
+        INSERT INTO nivel_registro (nivel)
+        SELECT upper(valor) FROM configuraciones_sistema WHERE clave = %s AND upper(valor) = ANY(%s)
+        ON CONFLICT (id) DO NOTHING
+    """, (CLAVE_NIVEL_ANTERIOR, list(NIVELES)))
+    cur.execute("DELETE FROM configuraciones_sistema WHERE clave = %s", (CLAVE_NIVEL_ANTERIOR,))
+
+
+def guardar_nivel(conn, nivel):
+    """Guarda el nivel en ``nivel_registro`` y avisa a todos los procesos."""
+    nivel = nivel.upper()
+    if nivel not in NIVELES:
+        raise ValueError(f"Nivel de registro inválido: {nivel}")
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO nivel_registro (nivel) VALUES (%s)
+        ON CONFLICT (id) DO UPDATE SET nivel = EXCLUDED.nivel, fecha_actualizacion = CURRENT_TIMESTAMP
+    """, (nivel,))
+    # El aviso se entrega al confirmar, junto con el valor guardado
+    cur.execute("SELECT pg_notify(%s, %s)", (CANAL_NIVEL, nivel))
+    conn.commit()
+    return cambiar_nivel(nivel)
+
+
+def _aplicar(nivel):
+    try:
+        if logging.getLevelName(logger.level) != nivel.upper():
+            cambiar_nivel(nivel)
+            logger.info("Nivel de registro aplicado", extra={"campos": {"nivel": nivel.upper()}})
+    except ValueError:
+        logger.warning("Nivel de registro guardado inválido: %s", nivel)
+
+
+def _escuchar_nivel(conn, detener):
+    conn.autocommit = True
+    cur = conn.cursor()
+    # LISTEN antes de leer el valor guardado: un cambio posterior llega como aviso
+    cur.execute(f"LISTEN {CANAL_NIVEL}")
+    cur.execute("SELECT nivel FROM nivel_registro")
+    fila = cur.fetchone()
+    if fila:
+        _aplicar(fila[0])
+
+    while not detener.is_set():
+        if not select.select([conn], [], [], ESPERA_SEGUNDOS)[0]:
+            continue
+        conn.poll()
+        if conn.notifies:
+            _aplicar(conn.notifies[-1].payload)
+            conn.notifies.clear()
+
+
+def iniciar_escucha_nivel(obtener_conexion):
+    """Hilo de fondo que aplica en este proceso el nivel guardado con ``guardar_nivel``."""
+    detener = threading.Event()
+
+    def ciclo():
+        while True:
+            conn = obtener_conexion()
+            if conn:
+                try:
+                    _escuchar_nivel(conn, detener)
+                except Exception:
+                    logger.exception("Error en la escucha del nivel de registro")
+                finally:
+                    conn.close()
+            if detener.wait(ESPERA_SEGUNDOS):
+                return
+
+    threading.Thread(target=ciclo, name="nivel-registro", daemon=True).start()
+    return detener
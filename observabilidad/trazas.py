@@ -0,0 +1,240 @@
+"""Trazas de peticiones (spans) con exportación local.
+
+Con ``TRAZAS_DESTINO`` definido, ``MiddlewareMetricas`` abre un span raíz por
+petición y ``observabilidad.bd`` cuelga de él un span por conexión y por
+sentencia SQL; el código de la aplicación añade los suyos con ``span()``.
+El identificador de traza se toma de la cabecera W3C ``traceparent`` si el
+cliente la envía y se devuelve en la respuesta, así que una traza puede
+seguirse desde el frontend hasta cada sentencia.
+
+Los spans terminados se encolan y un hilo en segundo plano los escribe por
+lotes: si ``TRAZAS_DESTINO`` es una ruta, una línea JSON por span; si es una
+URL ``http(s)://``, se envían como OTLP/HTTP JSON (p. ej.
+``http://localhost:4318/v1/traces`` de un colector OpenTelemetry local).
+Sin ``TRAZAS_DESTINO`` no se crea ningún span.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DESTINO = os.getenv("TRAZAS_DESTINO", "")
+MUESTREO = float(os.getenv("TRAZAS_MUESTREO", "1.0"))
+NOMBRE_SERVICIO = os.getenv("TRAZAS_SERVICIO", "el_unificador")
+TAMANO_LOTE = 512
+INTERVALO_EXPORTACION = 1.0
+
+logger = logging.getLogger("el_unificador.trazas")
+
+span_actual = ContextVar("span_actual", default=None)
+
+
+def _nuevo_id(bytes_):
+    return f"{random.getrandbits(bytes_ * 8):0{bytes_ * 2}x}"
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "padre_id", "nombre", "inicio", "fin", "atributos", "error")
+
+    def __init__(self, nombre, trace_id, padre_id=None, atributos=None):
+        self.trace_id = trace_id
+        self.span_id = _nuevo_id(8)
+        self.padre_id = padre_id
+        self.nombre = nombre
+        self.inicio = time.time_ns()
+        self.fin = None
+        self.atributos = atributos or {}
+        self.error = None
+
+    def hijo(self, nombre, **atributos):
+        return Span(nombre, self.trace_id, self.span_id, atributos)
+
+    def terminar(self, error=None):
+        self.fin = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        exportador.enviar(self)
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def como_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "padre_id": self.padre_id,
+            "nombre": self.nombre,
+            "inicio_ns": self.inicio,
+            "duracion_ms": round((self.fin - self.inicio) / 1e6, 3),
+            "atributos": self.atributos,
+            "error": self.error,
+        }
+
+    def como_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.nombre,
+            # SERVER para la petición, CLIENT para la base de datos, INTERNAL el resto
+            "kind": 2 if "http.route" in self.atributos else 3 if self.nombre.startswith("bd.") else 1,
+            "startTimeUnixNano": str(self.inicio),
+            "endTimeUnixNano": str(self.fin),
+            "attributes": [_atributo_otlp(clave, valor) for clave, valor in self.atributos.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.padre_id:
+            span["parentSpanId"] = self.padre_id
+        return span
+
+
+def _atributo_otlp(clave, valor):
+    if isinstance(valor, bool):
+        return {"key": clave, "value": {"boolValue": valor}}
+    if isinstance(valor, int):
+        return {"key": clave, "value": {"intValue": str(valor)}}
+    if isinstance(valor, float):
+        return {"key": clave, "value": {"doubleValue": valor}}
+    return {"key": clave, "value": {"stringValue": str(valor)}}
+
+
+def _leer_traceparent(valor):
+    """Devuelve (trace_id, span_id del padre, muestreado) o None si la cabecera no es válida."""
+    partes = valor.split("-")
+    if len(partes) != 4 or len(partes[1]) != 32 or len(partes[2]) != 16:
+        return None
+    try:
+        int(partes[1], 16), int(partes[2], 16)
+        muestreado = int(partes[3], 16) & 1
+    except ValueError:
+        return None
+    return partes[1], partes[2], bool(muestreado)
+
+
+def iniciar_traza(cabeceras, nombre, atributos):
+    """Crea el span raíz de una petición ASGI, o None si las trazas están desactivadas o no se muestrea."""
+    if not DESTINO:
+        return None
+
+    padre = None
+    for clave, valor in cabeceras:
+        if clave == b"traceparent":
+            padre = _leer_traceparent(valor.decode("latin-1"))
+            break
+
+    if padre is not None:
+        trace_id, padre_id, muestreado = padre
+        if not muestreado:
+            return None
+        return Span(nombre, trace_id, padre_id, atributos)
+    if MUESTREO < 1.0 and random.random() >= MUESTREO:
+        return None
+    return Span(nombre, _nuevo_id(16), None, atributos)
+
+
+@contextmanager
+def span(nombre, **atributos):
+    """Span hijo del span actual; sin traza en curso no hace nada."""
+    padre = span_actual.get()
+    if padre is None:
+        yield None
+        return
+
+    hijo = padre.hijo(nombre, **atributos)
+    token = span_actual.set(hijo)
+    error = None
+    try:
+        yield hijo
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        span_actual.reset(token)
+        hijo.terminar(error)
+
+
+def traza_actual():
+    actual = span_actual.get()
+    return actual.trace_id if actual is not None else None
+
+
+class Exportador:
+    def __init__(self, destino):
+        self.destino = destino
+        self._cola = queue.SimpleQueue()
+        self._hilo = None
+        self._candado = threading.Lock()
+
+    def enviar(self, span):
+        if self._hilo is None:
+            self._iniciar()
+        self._cola.put(span)
+
+    def _iniciar(self):
+        with self._candado:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._ejecutar, name="exportador-trazas", daemon=True)
+                self._hilo.start()
+                atexit.register(self.detener)
+
+    def detener(self):
+        self._cola.put(None)
+        self._hilo.join(timeout=5)
+
+    def _ejecutar(self):
+        terminar = False
+        while not terminar:
+            lote = [self._cola.get()]
+            limite = time.monotonic() + INTERVALO_EXPORTACION
+            while len(lote) < TAMANO_LOTE:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self._cola.get(timeout=restante))
+                except queue.Empty:
+                    break
+            if None in lote:
+                terminar = True
+                lote = [span for span in lote if span is not None]
+            if lote:
+                try:
+                    self._escribir(lote)
+                except Exception:
+                    logger.exception("No se pudieron exportar las trazas", extra={"campos": {"spans": len(lote)}})
+
+    def _escribir(self, lote):
+        if self.destino.startswith(("http://", "https://")):
+            self._enviar_otlp(lote)
+            return
+        with open(self.destino, "a", encoding="utf-8") as archivo:
+            for span in lote:
+                archivo.write(json.dumps(span.como_dict(), ensure_ascii=False, default=str) + "\n")
+
+    def _enviar_otlp(self, lote):
+        cuerpo = {
+            "resourceSpans": [{
+                "resource": {"attributes": [_atributo_otlp("service.name", NOMBRE_SERVICIO)]},
+                "scopeSpans": [{
+                    "scope": {"name": "el_unificador"},
+                    "spans": [span.como_otlp() for span in lote],
+                }],
+            }]
+        }
+        peticion = urllib.request.Request(
+            self.destino,
+            data=json.dumps(cuerpo, default=str).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(peticion, timeout=5) as respuesta:
+            respuesta.read()
+
+
+exportador = Exportador(DESTINO)
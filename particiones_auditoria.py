@@ -0,0 +1,333 @@
+"""Particionado mensual, retención y compactación de ``auditoria_sistema``.
+
+La tabla está particionada por rango de ``fecha``, una partición por mes
+(``auditoria_sistema_2025_01``, ...), más ``auditoria_sistema_default`` para
+lo que llegue fuera de las particiones creadas. ``crear_tabla`` migra una
+tabla sin particionar copiando las filas (conservando ids y la secuencia).
+
+``detalles`` es JSONB: ``mensaje`` (el texto que muestra la interfaz) más los
+ids y valores de la acción (``producto_id``, ``cierre_id``, ``cantidad``,
+``stock_anterior``/``stock_nuevo``, ...), con un índice GIN para buscar por
+contenido (``detalles @> '{"producto_id": 7}'``).
+
+``mantener`` hace el mantenimiento periódico:
+
+- crea las particiones de ``AUDITORIA_MESES_ADELANTE`` meses hacia adelante,
+  moviendo a su mes lo que haya caído en la partición por defecto;
+- compacta las acciones de mucho volumen y poco valor
+  (``AUDITORIA_ACCIONES_COMPACTABLES``, por defecto LOGIN) más viejas que
+  ``AUDITORIA_COMPACTAR_DIAS`` en contadores diarios (``auditoria_contadores``);
+- con ``AUDITORIA_RETENCION_MESES`` > 0, exporta a CSV gzip en
+  ``AUDITORIA_ARCHIVO_DIR`` las particiones más viejas, las separa y las borra.
+
+Un hilo de fondo lo corre al iniciar la aplicación y después cada
+``AUDITORIA_MANTENIMIENTO_HORAS``; un advisory lock evita que dos procesos lo
+hagan a la vez.
+"""
+import gzip
+import logging
+import os
+import re
+import threading
+from datetime import date, timedelta
+
+from psycopg2.extras import Json
+
+logger = logging.getLogger("el_unificador.auditoria")
+
+MESES_ADELANTE = int(os.getenv("AUDITORIA_MESES_ADELANTE", "3"))
+RETENCION_MESES = int(os.getenv("AUDITORIA_RETENCION_MESES", "0"))
+DIRECTORIO_ARCHIVO = os.getenv("AUDITORIA_ARCHIVO_DIR", "archivo_auditoria")
+COMPACTAR_DIAS = int(os.getenv("AUDITORIA_COMPACTAR_DIAS", "30"))
+ACCIONES_COMPACTABLES = [
+    accion.strip() for accion in os.getenv("AUDITORIA_ACCIONES_COMPACTABLES", "LOGIN").split(",") if accion.strip()
+]
+INTERVALO_HORAS = float(os.getenv("AUDITORIA_MANTENIMIENTO_HORAS", "24"))
+
+TABLA = "auditoria_sistema"
+DEFECTO = "auditoria_sistema_default"
+_PATRON_PARTICION = re.compile(r"^auditoria_sistema_(\d{4})_(\d{2})$")
+_CLAVE_LOCK = 462001
+
+# Tabla afectada -> clave con la que registro_id se guarda en detalles
+CLAVES_REGISTRO = {
+    "productos": "producto_id",
+    "cierres_diarios": "cierre_id",
+    "mermas_pendientes": "merma_id",
+    "usuarios": "usuario_afectado_id",
+    "auditoria_sistema": "proceso_id",
+}
+
+# Conversión de los detalles en texto (filas anteriores a JSONB)
+_DETALLES_DESDE_TEXTO = "jsonb_strip_nulls(jsonb_build_object('mensaje', detalles, {}))".format(", ".join(
+    f"'{clave}', CASE WHEN tabla_afectada = '{tabla}' THEN registro_id END" for tabla, clave in CLAVES_REGISTRO.items()
+))
+
+
+def detalles(tabla_afectada, registro_id, mensaje, datos=None):
+    """Arma el JSONB de ``detalles``: mensaje, id del registro afectado y ``datos``."""
+    contenido = {"mensaje": mensaje}
+    clave = CLAVES_REGISTRO.get(tabla_afectada)
+    if clave and registro_id is not None:
+        contenido[clave] = registro_id
+    if datos:
+        contenido.update(datos)
+    return Json(contenido)
+
+
+def nombre_particion(mes):
+    return f"{TABLA}_{mes:%Y_%m}"
+
+
+def _mes(fecha):
+    return date(fecha.year, fecha.month, 1)
+
+
+def _sumar_meses(mes, meses):
+    indice = mes.year * 12 + mes.month - 1 + meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+
+def _crear_padre(cur, nombre):
+    cur.execute(f'''
+        CREATE TABLE {nombre} (
+            id INTEGER NOT NULL DEFAULT nextval('auditoria_sistema_id_seq'),
+            usuario_id INTEGER REFERENCES usuarios(id),
+            accion VARCHAR(100) NOT NULL,
+            tabla_afectada VARCHAR(50),
+            registro_id INTEGER,
+            detalles JSONB,
+            fecha TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            revertido BOOLEAN DEFAULT false,
+            PRIMARY KEY (id, fecha)
+        ) PARTITION BY RANGE (fecha)
+    ''')
+    cur.execute(f"CREATE TABLE {DEFECTO} PARTITION OF {nombre} DEFAULT")
+
+
+def crear_tabla(cur, meses_adelante=MESES_ADELANTE):
+    """Crea ``auditoria_sistema`` particionada, o migra la tabla existente si no lo está."""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (TABLA,))
+    fila = cur.fetchone()
+    tipo = fila[0] if fila else None
+
+    if tipo is None:
+        cur.execute("CREATE SEQUENCE IF NOT EXISTS auditoria_sistema_id_seq")
+        _crear_padre(cur, TABLA)
+        cur.execute(f"ALTER SEQUENCE auditoria_sistema_id_seq OWNED BY {TABLA}.id")
+        primer_mes = _mes(date.today())
+    elif tipo == "r":
+        cur.execute(f"SELECT MIN(fecha) FROM {TABLA}")
+        minima = cur.fetchone()[0]
+        primer_mes = _mes(minima or date.today())
+
+        # La secuencia pasa a la tabla nueva; sin esto el DROP de la vieja la borraría
+        cur.execute("ALTER SEQUENCE auditoria_sistema_id_seq OWNED BY NONE")
+        _crear_padre(cur, "auditoria_sistema_nueva")
+        mes = primer_mes
+        while mes <= _sumar_meses(_mes(date.today()), meses_adelante):
+            cur.execute(f"""
+                CREATE TABLE {nombre_particion(mes)} PARTITION OF auditoria_sistema_nueva
+                FOR VALUES FROM ('{mes}') TO ('{_sumar_meses(mes, 1)}')
+            """)
+            mes = _sumar_meses(mes, 1)
+        cur.execute(f"""
+            INSERT INTO auditoria_sistema_nueva (id, usuario_id, accion, tabla_afectada, registro_id, detalles, fecha, revertido)
+            SELECT id, usuario_id, accion, tabla_afectada, registro_id, {_DETALLES_DESDE_TEXTO}, COALESCE(fecha, CURRENT_TIMESTAMP), revertido
+            FROM {TABLA}
+        """)
+        filas = cur.rowcount
+        cur.execute(f"DROP TABLE {TABLA}")
+        cur.execute(f"ALTER TABLE auditoria_sistema_nueva RENAME TO {TABLA}")
+        cur.execute(f"ALTER SEQUENCE auditoria_sistema_id_seq OWNED BY {TABLA}.id")
+        logger.info("Auditoría migrada a particiones mensuales", extra={"campos": {"filas": filas, "desde": str(primer_mes)}})
+    else:
+        primer_mes = _mes(date.today())
+        cur.execute("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = 'detalles'
+        """, (TABLA,))
+        if cur.fetchone()[0] == "text":
+            cur.execute(f"ALTER TABLE {TABLA} ALTER COLUMN detalles TYPE JSONB USING {_DETALLES_DESDE_TEXTO}")
+            logger.info("Migración de detalles de auditoría a JSONB aplicada")
+
+    # El índice en el padre se crea en cada partición: /auditoria lee las más
+    # recientes por fecha, la compactación busca por acción y fecha y
+    # /auditoria/buscar por contenido de detalles
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_auditoria_fecha ON {TABLA} (fecha)")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_auditoria_accion_fecha ON {TABLA} (accion, fecha)")
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_auditoria_detalles ON {TABLA} USING GIN (detalles jsonb_path_ops)")
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS auditoria_contadores (
+            dia DATE NOT NULL,
+            accion VARCHAR(100) NOT NULL,
+            usuario_id INTEGER NOT NULL,
+            cantidad INTEGER NOT NULL,
+            PRIMARY KEY (dia, accion, usuario_id)
+        )
+    ''')
+
+    asegurar_particiones(cur, meses_adelante, desde=primer_mes)
+
+
+def crear_particion(cur, mes):
+    """Crea la partición de ``mes`` si no existe; devuelve True si la creó."""
+    nombre = nombre_particion(mes)
+    cur.execute("SELECT to_regclass(%s)", (nombre,))
+    if cur.fetchone()[0] is not None:
+        return False
+
+    inicio, fin = mes, _sumar_meses(mes, 1)
+    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {DEFECTO} WHERE fecha >= %s AND fecha < %s)", (inicio, fin))
+    if not cur.fetchone()[0]:
+        cur.execute(f"CREATE TABLE {nombre} PARTITION OF {TABLA} FOR VALUES FROM ('{inicio}') TO ('{fin}')")
+        return True
+
+    # Filas de ese mes en la partición por defecto: PostgreSQL no deja crear la
+    # partición mientras estén ahí, así que se separa la de defecto y se mueven
+    cur.execute(f"ALTER TABLE {TABLA} DETACH PARTITION {DEFECTO}")
+    cur.execute(f"CREATE TABLE {nombre} PARTITION OF {TABLA} FOR VALUES FROM ('{inicio}') TO ('{fin}')")
+    cur.execute(f"""
+        WITH movidas AS (
+            DELETE FROM {DEFECTO} WHERE fecha >= %s AND fecha < %s RETURNING *
+        )
+        INSERT INTO {TABLA} SELECT * FROM movidas
+    """, (inicio, fin))
+    movidas = cur.rowcount
+    cur.execute(f"ALTER TABLE {TABLA} ATTACH PARTITION {DEFECTO} DEFAULT")
+    logger.info("Filas de auditoría movidas desde la partición por defecto", extra={"campos": {"particion": nombre, "filas": movidas}})
+    return True
+
+
+def asegurar_particiones(cur, meses_adelante=MESES_ADELANTE, desde=None):
+    """Crea las particiones desde ``desde`` hasta ``meses_adelante`` meses adelante; devuelve las creadas.
+
+    Sin ``desde`` empieza en el mes actual o en el más viejo que haya en la
+    partición por defecto (p. ej. después de una carga masiva de historial).
+    """
+    actual = _mes(date.today())
+    if desde is None:
+        cur.execute(f"SELECT MIN(fecha) FROM {DEFECTO}")
+        minima = cur.fetchone()[0]
+        desde = _mes(minima) if minima else actual
+    mes = min(desde, actual)
+    creadas = []
+    while mes <= _sumar_meses(actual, meses_adelante):
+        if crear_particion(cur, mes):
+            creadas.append(nombre_particion(mes))
+        mes = _sumar_meses(mes, 1)
+    return creadas
+
+
+def compactar(cur, dias=COMPACTAR_DIAS, acciones=ACCIONES_COMPACTABLES):
+    """Reemplaza las filas de ``acciones`` más viejas que ``dias`` por contadores diarios; devuelve cuántas borró."""
+    if not acciones:
+        return 0
+    cur.execute("""
+        WITH compactadas AS (
+            DELETE FROM auditoria_sistema
+            WHERE accion = ANY(%(acciones)s) AND fecha < %(limite)s AND NOT revertido
+            RETURNING usuario_id, accion, fecha
+        ), contadas AS (
+            INSERT INTO auditoria_contadores (dia, accion, usuario_id, cantidad)
+            SELECT fecha::date, accion, COALESCE(usuario_id, 0), COUNT(*)
+            FROM compactadas
+            GROUP BY 1, 2, 3
+            ON CONFLICT (dia, accion, usuario_id)
+            DO UPDATE SET cantidad = auditoria_contadores.cantidad + EXCLUDED.cantidad
+        )
+        SELECT COUNT(*) FROM compactadas
+    """, {"acciones": list(acciones), "limite": date.today() - timedelta(days=dias)})
+    return cur.fetchone()[0]
+
+
+def particiones(cur):
+    """[(mes, nombre)] de las particiones mensuales, de la más vieja a la más nueva."""
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'auditoria_sistema'::regclass
+    """)
+    resultado = []
+    for nombre, in cur.fetchall():
+        coincidencia = _PATRON_PARTICION.match(nombre)
+        if coincidencia:
+            resultado.append((date(int(coincidencia.group(1)), int(coincidencia.group(2)), 1), nombre))
+    return sorted(resultado)
+
+
+def aplicar_retencion(conn, retencion_meses=RETENCION_MESES, directorio=DIRECTORIO_ARCHIVO):
+    """Exporta, separa y borra las particiones anteriores a la retención; devuelve los archivos escritos."""
+    if retencion_meses <= 0:
+        return []
+
+    limite = _sumar_meses(_mes(date.today()), -retencion_meses)
+    cur = conn.cursor()
+    os.makedirs(directorio, exist_ok=True)
+    archivos = []
+    for mes, nombre in particiones(cur):
+        if mes >= limite:
+            break
+        destino = os.path.join(directorio, f"{nombre}.csv.gz")
+        temporal = destino + ".tmp"
+        with gzip.open(temporal, "wb") as salida:
+            cur.copy_expert(f"COPY (SELECT * FROM {nombre} ORDER BY fecha, id) TO STDOUT WITH (FORMAT csv, HEADER)", salida)
+        os.replace(temporal, destino)
+
+        cur.execute(f"ALTER TABLE {TABLA} DETACH PARTITION {nombre}")
+        cur.execute(f"DROP TABLE {nombre}")
+        conn.commit()
+        archivos.append(destino)
+        logger.info("Partición de auditoría archivada", extra={"campos": {"particion": nombre, "archivo": destino}})
+    conn.commit()
+    return archivos
+
+
+def mantener(conn):
+    """Particiones adelantadas, compactación y retención. Devuelve un resumen o None si otro proceso lo está haciendo."""
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s)", (_CLAVE_LOCK,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        return None
+    try:
+        creadas = asegurar_particiones(cur)
+        conn.commit()
+        compactadas = compactar(cur)
+        conn.commit()
+        archivadas = aplicar_retencion(conn)
+        return {"particiones_creadas": creadas, "filas_compactadas": compactadas, "particiones_archivadas": archivadas}
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (_CLAVE_LOCK,))
+        conn.commit()
+
+
+def iniciar_mantenimiento_periodico(obtener_conexion, intervalo_horas=INTERVALO_HORAS):
+    """Hilo de fondo que llama a ``mantener`` cada ``intervalo_horas`` (0 = desactivado)."""
+    if intervalo_horas <= 0:
+        return None
+    detener = threading.Event()
+
+    def ciclo():
+        # La primera pasada es al arrancar (en segundo plano): con reinicios
+        # frecuentes, esperar un intervalo completo podría no llegar nunca
+        while True:
+            conn = obtener_conexion()
+            if conn:
+                try:
+                    resumen = mantener(conn)
+                    if resumen:
+                        logger.info("Mantenimiento de auditoría", extra={"campos": resumen})
+                except Exception:
+                    logger.exception("Error en el mantenimiento de auditoría")
+                finally:
+                    conn.close()
+            if detener.wait(intervalo_horas * 3600):
+                return
+
+    threading.Thread(target=ciclo, name="mantenimiento-auditoria", daemon=True).start()
+    return detener
@@ -0,0 +1,116 @@
+"""Respuestas de listados grandes sin pasar por ``jsonable_encoder``.
+
+Para JSON, ``responder_filas`` envuelve la consulta en
+``json_agg``/``row_to_json``: PostgreSQL arma el documento completo y los
+bytes se devuelven tal cual, sin crear un dict por fila en Python. Los
+``numeric`` salen como números y los ``timestamp`` en ISO 8601, igual que
+con FastAPI.
+
+Si el cliente envía ``Accept: application/msgpack`` (y ``msgpack`` está
+instalado) la respuesta es MessagePack, más compacta y rápida de decodificar;
+ahí sí se leen las filas en Python.
+
+``transmitir_filas`` es el modo streaming para listados sin tope: lee con un
+cursor con nombre (del lado del servidor) de a ``STREAMING_FILAS_LOTE`` filas
+y va enviando un arreglo JSON o NDJSON (una fila por línea), así que la
+memoria del worker no crece con el tamaño de la tabla. Lo activa
+``?stream=true`` o ``Accept: application/x-ndjson``.
+"""
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+from fastapi.responses import Response, StreamingResponse
+from psycopg2.extras import RealDictCursor
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+TIPO_JSON = "application/json"
+TIPO_MSGPACK = "application/msgpack"
+TIPO_NDJSON = "application/x-ndjson"
+_TIPOS_MSGPACK = (TIPO_MSGPACK, "application/x-msgpack")
+
+FILAS_LOTE = int(os.getenv("STREAMING_FILAS_LOTE", "2000"))
+
+
+def _por_defecto(valor):
+    # Mismas conversiones que fastapi.encoders para Decimal y fechas
+    if isinstance(valor, Decimal):
+        return int(valor) if valor.as_tuple().exponent >= 0 else float(valor)
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def acepta_msgpack(request):
+    if msgpack is None:
+        return False
+    aceptados = request.headers.get("accept", "")
+    return any(tipo in aceptados for tipo in _TIPOS_MSGPACK)
+
+
+def a_msgpack(datos):
+    return msgpack.packb(datos, default=_por_defecto, use_bin_type=True, datetime=False)
+
+
+def responder_filas(request, conn, sql, parametros=None):
+    """Ejecuta ``sql`` y responde con la lista de filas en el formato que pida el cliente."""
+    cabeceras = {"Vary": "Accept"}
+    if acepta_msgpack(request):
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(sql, parametros)
+        return Response(a_msgpack(cur.fetchall()), media_type=TIPO_MSGPACK, headers=cabeceras)
+
+    cur = conn.cursor()
+    # json_agg respeta el orden en que la subconsulta entrega las filas (su ORDER BY)
+    cur.execute(f"SELECT COALESCE(json_agg(fila), '[]'::json)::text FROM ({sql}) fila", parametros)
+    return Response(cur.fetchone()[0].encode("utf-8"), media_type=TIPO_JSON, headers=cabeceras)
+
+
+def formato_streaming(request, stream=False):
+    """Devuelve ``ndjson``, ``json`` o None (sin streaming) según lo que pida el cliente."""
+    if TIPO_NDJSON in request.headers.get("accept", ""):
+        return "ndjson"
+    return "json" if stream else None
+
+
+def _lotes_json(conn, cur, formato, filas_lote):
+    try:
+        if formato == "ndjson":
+            while True:
+                lote = cur.fetchmany(filas_lote)
+                if not lote:
+                    break
+                yield "".join(f"{json}\n" for json, in lote).encode("utf-8")
+        else:
+            separador = "["
+            while True:
+                lote = cur.fetchmany(filas_lote)
+                if not lote:
+                    break
+                yield (separador + ",".join(json for json, in lote)).encode("utf-8")
+                separador = ","
+            yield b"[]" if separador == "[" else b"]"
+        cur.close()
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def transmitir_filas(conn, sql, parametros=None, formato="json", filas_lote=FILAS_LOTE):
+    """Responde con las filas de ``sql`` en streaming.
+
+    El ``DECLARE`` se ejecuta aquí, así que un error de SQL todavía llega a la
+    ruta; desde que devuelve, la respuesta se queda con ``conn`` y la cierra
+    al terminar de enviar.
+    """
+    # Cursor con nombre: las filas quedan en el servidor y se traen de a un lote
+    cur = conn.cursor(name="transmitir_filas")
+    cur.itersize = filas_lote
+    cur.execute(f"SELECT row_to_json(fila)::text FROM ({sql}) fila", parametros)
+
+    media_type = TIPO_NDJSON if formato == "ndjson" else TIPO_JSON
+    return StreamingResponse(_lotes_json(conn, cur, formato, filas_lote), media_type=media_type, headers={"Vary": "Accept"})
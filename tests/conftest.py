@@ -0,0 +1,57 @@
+"""Fixtures de las pruebas contra PostgreSQL.
+
+Las pruebas corren en un esquema descartable dentro de la base de
+``TEST_DATABASE_URL``: se crea al empezar la sesión, ``init_db`` crea ahí todas
+las tablas al importar ``main`` y al terminar se borra con todo lo que las
+pruebas escribieron. Sin ``TEST_DATABASE_URL`` las pruebas se saltan; nunca se
+usa ``DATABASE_URL``, para no escribir por accidente en la base real.
+"""
+import os
+import sys
+import uuid
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def database_url():
+    base = os.getenv("TEST_DATABASE_URL")
+    if not base:
+        pytest.skip("TEST_DATABASE_URL no configurada")
+
+    esquema = f"prueba_{uuid.uuid4().hex[:12]}"
+    conn = psycopg2.connect(base)
+    conn.autocommit = True
+    conn.cursor().execute(f"CREATE SCHEMA {esquema}")
+    try:
+        # Solo el esquema de prueba en el search_path: las tablas se crean ahí y
+        # ninguna consulta ve las de public
+        yield psycopg2.extensions.make_dsn(base, options=f"-c search_path={esquema}")
+    finally:
+        conn.cursor().execute(f"DROP SCHEMA {esquema} CASCADE")
+        conn.close()
+
+
+@pytest.fixture(scope="session")
+def main(database_url):
+    """El módulo ``main`` con su esquema ya creado por ``init_db``."""
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("AUDITORIA_MANTENIMIENTO_HORAS", "0")
+    os.environ.setdefault("INDICE_CODIGOS", "0")
+    import main as modulo
+    return modulo
+
+
+@pytest.fixture
+def usuario_id(main):
+    conn = main.get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM usuarios WHERE activo = true ORDER BY id LIMIT 1")
+        return cur.fetchone()[0]
+    finally:
+        conn.close()
@@ -0,0 +1,183 @@
+"""Carga concurrente sobre el motor de stock.
+
+Muchos hilos, cada uno con su propia conexión, descuentan y reponen stock de
+unos pocos productos al mismo tiempo, incluyendo transacciones multi-producto
+en orden aleatorio. Al final el stock de cada producto tiene que coincidir con
+el esperado según las operaciones confirmadas: si hubiera actualizaciones
+perdidas los números no cuadrarían. Lo mismo vale con la reversión de un
+cierre diario corriendo en medio de esa carga.
+"""
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from fastapi.testclient import TestClient
+
+from motor_stock import (
+    StockInsuficiente,
+    descontar_stock,
+    ejecutar_transaccion,
+    reponer_stock,
+    retirar_stock_lote,
+)
+
+HILOS = int(os.getenv("PRUEBA_CONCURRENCIA_HILOS", "16"))
+OPERACIONES = int(os.getenv("PRUEBA_CONCURRENCIA_OPERACIONES", "100"))
+PRODUCTOS = 5
+STOCK_INICIAL = 1000
+PREFIJO_CODIGO = "PRUEBA-CONC-"
+CANTIDAD_CIERRE = 10
+
+
+def trabajador(database_url, ids, usuario_id, semilla, balance, candado):
+    rng = random.Random(semilla)
+    conn = psycopg2.connect(database_url)
+    local = {producto_id: 0 for producto_id in ids}
+    try:
+        for _ in range(OPERACIONES):
+            tipo = rng.random()
+            if tipo < 0.5:
+                producto_id = rng.choice(ids)
+                cantidad = rng.randint(1, 5)
+                try:
+                    ejecutar_transaccion(conn, lambda c: descontar_stock(c, producto_id, cantidad, "Prueba concurrencia", usuario_id))
+                    local[producto_id] -= cantidad
+                except StockInsuficiente:
+                    conn.rollback()
+            elif tipo < 0.8:
+                producto_id = rng.choice(ids)
+                cantidad = rng.randint(1, 5)
+                ejecutar_transaccion(conn, lambda c: reponer_stock(c, producto_id, cantidad))
+                local[producto_id] += cantidad
+            else:
+                # Transacción multi-producto en orden aleatorio: el motor debe ordenar los bloqueos
+                elegidos = rng.sample(ids, min(3, len(ids)))
+                cantidades = {producto_id: 1 for producto_id in elegidos}
+                antes = {}
+
+                def retirar(c):
+                    cur = c.cursor()
+                    cur.execute("SELECT id, stock_actual FROM productos WHERE id = ANY(%s) ORDER BY id FOR UPDATE", (sorted(cantidades),))
+                    antes.clear()
+                    antes.update(dict(cur.fetchall()))
+                    return retirar_stock_lote(c, cantidades)
+
+                nuevos = ejecutar_transaccion(conn, retirar)
+                for producto_id, nuevo in nuevos.items():
+                    local[producto_id] += nuevo - antes[producto_id]
+    finally:
+        conn.close()
+
+    with candado:
+        for producto_id, delta in local.items():
+            balance[producto_id] += delta
+
+
+def crear_productos(cur):
+    ids = []
+    for i in range(PRODUCTOS):
+        cur.execute(
+            "INSERT INTO productos (codigo, nombre, categoria, precio_compra, precio_venta, stock_actual) VALUES (%s, %s, 'Prueba', 1, 2, %s) RETURNING id",
+            (f"{PREFIJO_CODIGO}{i}", f"Producto de prueba {i}", STOCK_INICIAL)
+        )
+        ids.append(cur.fetchone()[0])
+    return ids
+
+
+def correr_trabajadores(database_url, ids, usuario_id, extra=None):
+    """Corre los trabajadores (y ``extra``, si se da) a la vez y devuelve el balance por producto."""
+    balance = {producto_id: 0 for producto_id in ids}
+    candado = threading.Lock()
+    with ThreadPoolExecutor(max_workers=HILOS + 1) as ejecutor:
+        futuros = [
+            ejecutor.submit(trabajador, database_url, ids, usuario_id, i, balance, candado)
+            for i in range(HILOS)
+        ]
+        if extra:
+            futuros.append(ejecutor.submit(extra))
+        for futuro in futuros:
+            futuro.result()
+    return balance
+
+
+def test_sin_actualizaciones_perdidas(main, database_url, usuario_id):
+    conn = psycopg2.connect(database_url)
+    cur = conn.cursor()
+    ids = crear_productos(cur)
+    conn.commit()
+
+    try:
+        balance = correr_trabajadores(database_url, ids, usuario_id)
+
+        cur.execute("SELECT id, stock_actual FROM productos WHERE id = ANY(%s)", (ids,))
+        finales = dict(cur.fetchall())
+        esperados = {producto_id: STOCK_INICIAL + balance[producto_id] for producto_id in ids}
+        assert finales == esperados
+        assert all(stock >= 0 for stock in finales.values())
+    finally:
+        conn.rollback()
+        cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = ANY(%s)", (ids,))
+        cur.execute("DELETE FROM productos WHERE id = ANY(%s)", (ids,))
+        conn.commit()
+        conn.close()
+
+
+def test_revertir_cierre_con_carga_concurrente(main, database_url, usuario_id):
+    conn = psycopg2.connect(database_url)
+    cur = conn.cursor()
+    ids = crear_productos(cur)
+    conn.commit()
+    cliente = TestClient(main.app)
+    nombre_archivo = f"{PREFIJO_CODIGO}cierre.csv"
+
+    try:
+        respuesta = cliente.post("/cierres-diarios/procesar", json={
+            "productos": [
+                {
+                    "codigo": f"{PREFIJO_CODIGO}{i}",
+                    "nombre": f"Producto de prueba {i}",
+                    "categoria": "Prueba",
+                    "cantidad": CANTIDAD_CIERRE,
+                    "precio_compra": 1.0,
+                    "precio_venta": 2.0,
+                }
+                for i in range(PRODUCTOS)
+            ],
+            "nombre_archivo": nombre_archivo,
+            "usuario_id": usuario_id,
+        })
+        assert respuesta.status_code == 200
+        cur.execute(
+            "SELECT id FROM auditoria_sistema WHERE accion = 'CIERRE_DIARIO' AND registro_id = %s",
+            (respuesta.json()["cierre_id"],)
+        )
+        proceso_id = cur.fetchone()[0]
+        conn.commit()
+
+        # La reversión bloquea los mismos productos que descuentan y reponen los trabajadores
+        reversiones = []
+
+        def revertir():
+            reversiones.append(cliente.post("/revertir-proceso", json={"proceso_id": proceso_id, "proceso_tipo": "CIERRE_DIARIO"}))
+
+        balance = correr_trabajadores(database_url, ids, usuario_id, revertir)
+        assert reversiones[0].status_code == 200
+
+        # El cierre sumó y la reversión restó lo mismo: solo queda lo de los trabajadores
+        cur.execute("SELECT id, stock_actual FROM productos WHERE id = ANY(%s)", (ids,))
+        finales = dict(cur.fetchall())
+        esperados = {producto_id: STOCK_INICIAL + balance[producto_id] for producto_id in ids}
+        assert finales == esperados
+
+        cur.execute("SELECT count(*) FROM movimientos_inventario WHERE archivo_origen = %s", (nombre_archivo,))
+        assert cur.fetchone()[0] == 0
+        cur.execute("SELECT revertido FROM auditoria_sistema WHERE id = %s", (proceso_id,))
+        assert cur.fetchone()[0] is True
+    finally:
+        conn.rollback()
+        cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = ANY(%s)", (ids,))
+        cur.execute("DELETE FROM productos WHERE id = ANY(%s)", (ids,))
+        conn.commit()
+        conn.close()
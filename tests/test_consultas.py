@@ -0,0 +1,81 @@
+"""Guardia contra regresiones N+1.
+
+Procesa y revierte cierres diarios de distintos tamaños y falla si alguna
+petición supera su presupuesto fijo de sentencias SQL o de conexiones. Como el
+presupuesto no depende del tamaño del cierre, un bucle que ejecute una
+consulta por producto hace fallar la prueba.
+"""
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+from observabilidad.bd import verificar_maximo_consultas
+
+# (máximo de sentencias, máximo de conexiones) por petición
+PRESUPUESTOS = {
+    "procesar": (15, 2),
+    "revertir": (12, 2),
+    "inventario": (2, 1),
+}
+
+
+def obtener_proceso_cierre(main, cierre_id):
+    conn = main.get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM auditoria_sistema WHERE accion = 'CIERRE_DIARIO' AND registro_id = %s", (cierre_id,))
+        return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def borrar_productos(main, codigos):
+    conn = main.get_db()
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM movimientos_inventario WHERE producto_id IN (SELECT id FROM productos WHERE codigo = ANY(%s))", (codigos,))
+        cur.execute("DELETE FROM productos WHERE codigo = ANY(%s)", (codigos,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("tamano", [10, 200])
+def test_cierre_con_presupuesto_fijo(main, usuario_id, tamano):
+    cliente = TestClient(main.app)
+    lote = uuid.uuid4().hex[:8]
+    productos = [
+        {
+            "codigo": f"N1-{lote}-{i}",
+            "nombre": f"Producto verificación {i}",
+            "categoria": "Verificación",
+            "cantidad": 5,
+            "precio_compra": 10.0,
+            "precio_venta": 15.0,
+        }
+        for i in range(tamano)
+    ]
+
+    try:
+        maximo, maximo_conexiones = PRESUPUESTOS["procesar"]
+        respuesta = verificar_maximo_consultas(
+            cliente, "POST", "/cierres-diarios/procesar", maximo, maximo_conexiones,
+            json={"productos": productos, "nombre_archivo": f"verificacion-{lote}.csv", "usuario_id": usuario_id}
+        )
+        assert respuesta.status_code == 200, respuesta.text
+        cierre_id = respuesta.json()["cierre_id"]
+
+        maximo, maximo_conexiones = PRESUPUESTOS["revertir"]
+        respuesta = verificar_maximo_consultas(
+            cliente, "POST", "/revertir-proceso", maximo, maximo_conexiones,
+            json={"proceso_id": obtener_proceso_cierre(main, cierre_id), "proceso_tipo": "CIERRE_DIARIO"}
+        )
+        assert respuesta.status_code == 200, respuesta.text
+
+        maximo, maximo_conexiones = PRESUPUESTOS["inventario"]
+        respuesta = verificar_maximo_consultas(cliente, "GET", "/inventario", maximo, maximo_conexiones)
+        assert respuesta.status_code == 200
+    finally:
+        # Revertir el cierre deja los productos que creó, con stock 0
+        borrar_productos(main, [producto["codigo"] for producto in productos])
@@ -0,0 +1,76 @@
+"""Saldo del kardex frente a cambios de stock sin movimiento.
+
+Revertir un cierre resta el stock y borra sus movimientos, así que el saldo
+de los movimientos siguientes no se puede obtener sumando cantidades: tiene
+que coincidir siempre con el stock real del producto después de cada uno.
+"""
+import uuid
+from datetime import date
+
+import psycopg2
+from fastapi.testclient import TestClient
+
+from motor_stock import descontar_stock, ejecutar_transaccion
+
+STOCK_INICIAL = 100
+
+
+def test_saldo_despues_de_revertir_cierre(main, database_url, usuario_id):
+    cliente = TestClient(main.app)
+    codigo = f"KARDEX-{uuid.uuid4().hex[:8]}"
+    conn = psycopg2.connect(database_url)
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO productos (codigo, nombre, categoria, precio_compra, precio_venta, stock_actual) VALUES (%s, 'Producto kardex', 'Prueba', 1, 2, %s) RETURNING id",
+        (codigo, STOCK_INICIAL)
+    )
+    producto_id = cur.fetchone()[0]
+    conn.commit()
+
+    def descontar(cantidad):
+        ejecutar_transaccion(conn, lambda c: descontar_stock(c, producto_id, cantidad, "Prueba kardex", usuario_id))
+
+    try:
+        descontar(5)
+
+        respuesta = cliente.post("/cierres-diarios/procesar", json={
+            "productos": [{
+                "codigo": codigo,
+                "nombre": "Producto kardex",
+                "categoria": "Prueba",
+                "cantidad": 10,
+                "precio_compra": 1.0,
+                "precio_venta": 2.0,
+            }],
+            "nombre_archivo": f"{codigo}.csv",
+            "usuario_id": usuario_id,
+        })
+        assert respuesta.status_code == 200
+        cur.execute(
+            "SELECT id FROM auditoria_sistema WHERE accion = 'CIERRE_DIARIO' AND registro_id = %s",
+            (respuesta.json()["cierre_id"],)
+        )
+        proceso_id = cur.fetchone()[0]
+        conn.commit()
+
+        respuesta = cliente.post("/revertir-proceso", json={"proceso_id": proceso_id, "proceso_tipo": "CIERRE_DIARIO"})
+        assert respuesta.status_code == 200
+
+        descontar(3)
+
+        cur.execute("SELECT stock_actual FROM productos WHERE id = %s", (producto_id,))
+        stock_actual = cur.fetchone()[0]
+        conn.commit()
+        assert stock_actual == STOCK_INICIAL - 5 - 3
+
+        for parametros in ({}, {"desde": date.today().isoformat()}):
+            respuesta = cliente.get(f"/productos/{producto_id}/movimientos", params=parametros)
+            assert respuesta.status_code == 200
+            saldos = [movimiento["saldo"] for movimiento in respuesta.json()["movimientos"]]
+            assert saldos == [STOCK_INICIAL - 5, stock_actual]
+    finally:
+        conn.rollback()
+        cur.execute("DELETE FROM movimientos_inventario WHERE producto_id = %s", (producto_id,))
+        cur.execute("DELETE FROM productos WHERE id = %s", (producto_id,))
+        conn.commit()
+        conn.close()